@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser, Namespace
+import yaml
+
+import torch
+
+from therapy_bot.benchmark import StageRecorder, StubChatbot, build_tiny_chatbot, run_benchmark, compare_results
+
+from typing import Dict
+
+
+def main(args: Namespace) -> int:
+    """Run the latency benchmark."""
+    # Initialisation
+    # Get date-time
+    date_time_session: str = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    # Read YAML file (if any)
+    if args.config_file_path is not None:
+        with open(args.config_file_path) as f:
+            configs: Dict = yaml.full_load(f)
+    else:
+        configs = {'chatbot': dict(), 'telegram': dict()}
+    # Create output directory
+    output_file_path: str = args.output_file_path if args.output_file_path is not None else os.path.join(
+        '.', 'sessions', 'benchmarks', f'benchmark_{args.backend}_{date_time_session}.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output_file_path)), exist_ok=True)
+    # Init logging
+    logging.basicConfig(level=args.log_level)
+    # Set random seed
+    torch.manual_seed(args.random_seed)
+    # Inference executor settings
+    inference: Dict = {**configs['telegram'].get('inference', dict()), 'timeouts': None}
+    if args.max_workers is not None:
+        inference['max_workers'] = args.max_workers
+    # NOTE each simulated chat waits for the answer before writing again
+    inference['max_pending'] = max(inference.get('max_pending', 32), args.n_chats)
+
+    # Run benchmark
+    recorder = StageRecorder()
+    with TemporaryDirectory() as tmp_dir_path:
+        if args.backend == 'tiny':
+            chatbot = build_tiny_chatbot(
+                tmp_dir_path, recorder=recorder, chatbot_configs=configs['chatbot'], max_new_tokens=args.max_new_tokens
+            )
+        else:
+            chatbot = StubChatbot(recorder=recorder)
+        logging.info(f"Benchmark started ({args.backend} backend, {args.n_chats} chats, {args.n_turns} turns)")
+        results = asyncio.run(run_benchmark(
+            chatbot,
+            recorder,
+            n_chats=args.n_chats,
+            n_turns=args.n_turns,
+            voice_ratio=args.voice_ratio,
+            voice_duration=args.voice_duration,
+            inference=inference,
+            random_seed=args.random_seed
+        ))
+    results = {'backend': args.backend, 'date_time': date_time_session, **results}
+    # Compare with previous results
+    if args.baseline_file_path is not None:
+        with open(args.baseline_file_path) as f:
+            results['baseline_file_path'] = args.baseline_file_path
+            results['comparison'] = compare_results(results, json.load(f))
+    # Save results
+    with open(output_file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Benchmark results saved at '{output_file_path}'")
+    for stage, stats in results['stages'].items():
+        if len(stats) > 0:
+            logging.info(
+                f"{stage}: p50 {stats['p50']:.3f} s, p95 {stats['p95']:.3f} s, p99 {stats['p99']:.3f} s "
+                f"({stats['count']} samples)"
+            )
+    logging.info(f"Throughput: {results['throughput']:.2f} turns/s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Instantiate argument parser
+    args_parser: ArgumentParser = ArgumentParser()
+    # Add arguments to parser
+    args_parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['stub', 'tiny'],
+        default='tiny',
+        help="Models to use: simulated latencies (stub) or randomly initialised tiny models (tiny)."
+    )
+    args_parser.add_argument(
+        '--config_file_path',
+        type=str,
+        default=None,
+        help="Path to the YAML file with the configuration of the service (text generation and inference settings)."
+    )
+    args_parser.add_argument(
+        '--output_file_path', type=str, default=None, help="Path to the JSON file where to store the results."
+    )
+    args_parser.add_argument(
+        '--baseline_file_path', type=str, default=None, help="Path to the JSON file with the results to compare with."
+    )
+    args_parser.add_argument('--n_chats', type=int, default=4, help="Number of concurrent chats.")
+    args_parser.add_argument('--n_turns', type=int, default=8, help="Number of user messages in each chat.")
+    args_parser.add_argument('--voice_ratio', type=float, default=0.5, help="Fraction of voice messages.")
+    args_parser.add_argument(
+        '--voice_duration', type=float, default=3.0, help="Average duration of the voice messages (in seconds)."
+    )
+    args_parser.add_argument(
+        '--max_workers', type=int, default=None, help="Number of inference threads (overrides the configuration)."
+    )
+    args_parser.add_argument('--max_new_tokens', type=int, default=32, help="Length of the generated responses.")
+    args_parser.add_argument('--random_seed', type=int, default=2307, help="Random seed.")
+    args_parser.add_argument('--log_level', type=str, default='INFO', help="Logging level.")
+    # Run benchmark
+    main(args_parser.parse_args(sys.argv[1:]))
@@ -0,0 +1,82 @@
+import os
+import sys
+from shutil import copy2
+import asyncio
+import logging
+from datetime import datetime
+from argparse import ArgumentParser, Namespace
+import yaml
+
+from therapy_bot.telegram import init_conversation_store, Frontend
+
+from typing import Dict
+
+
+def main(args: Namespace) -> int:
+    """Run the bot as a front-end process routing the updates to multiple model-worker processes."""
+    # Initialisation
+    # Get date-time
+    date_time_session: str = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    # Read YAML file
+    with open(args.config_file_path) as f:
+        configs: Dict = yaml.full_load(f)
+    if args.n_workers is not None:
+        configs.setdefault('cluster', dict())['n_workers'] = args.n_workers
+    # Create session directories
+    sessions_dir_path: str = configs['sessions_directory_path']
+    if not os.path.exists(sessions_dir_path):
+        os.mkdir(sessions_dir_path)
+    session_series_dir_path: str = os.path.join(sessions_dir_path, configs['session_series'])
+    if not os.path.exists(session_series_dir_path):
+        os.mkdir(session_series_dir_path)
+    current_session_dir_path = os.path.join(session_series_dir_path, f"{configs['session_id']}_{date_time_session}")
+    if not os.path.exists(current_session_dir_path):
+        os.mkdir(current_session_dir_path)
+    # Create file paths (each worker process writes its own log and trace files in the session directory)
+    if configs.get('log_file', False):
+        log_file_path = os.path.join(current_session_dir_path, f"{configs['session_id']}_{date_time_session}.log")
+    else:
+        log_file_path = None
+    configs_dump_path = os.path.join(current_session_dir_path, 'configs.yaml')
+    evaluations_file_path = os.path.join(
+        current_session_dir_path, f"{configs['session_id']}_{date_time_session}_evaluations.jsonl"
+    )
+    # Init logging
+    logging.basicConfig(filename=log_file_path, level=configs['log_level'])
+    # Start Logging info
+    logging.info(f"{configs['session_series']} Telegram front-end started")
+    logging.info(f"Current session directories created at '{current_session_dir_path}'")
+    if log_file_path is not None:
+        logging.info(f"Current session log created at '{log_file_path}'")
+    # Dump configs
+    copy2(args.config_file_path, configs_dump_path)
+    logging.info(f"Current session configuration dumped at '{configs_dump_path}'")
+
+    # Start
+    # Run the front-end and the workers until the process receives SIGTERM or SIGINT, then drain them
+    asyncio.run(Frontend(configs, current_session_dir_path, session_series_dir_path).run())
+    # Export the evaluations (once all the workers committed their writes)
+    conversation_store = init_conversation_store(configs, session_series_dir_path)
+    if conversation_store is not None:
+        if configs['telegram']['store'].get('export_evaluations', True):
+            n_conversations = conversation_store.export_evaluations(evaluations_file_path)
+            logging.info(f"{n_conversations} evaluated conversations exported at '{evaluations_file_path}'")
+        conversation_store.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Instantiate argument parser
+    args_parser: ArgumentParser = ArgumentParser()
+    # Add arguments to parser
+    args_parser.add_argument(
+        '--config_file_path',
+        type=str,
+        help="Path to the YAML file containing the configuration for the session."
+    )
+    args_parser.add_argument(
+        '--n_workers', type=int, default=None, help="Number of model-worker processes (overrides the configuration)."
+    )
+    # Run experiment
+    main(args_parser.parse_args(sys.argv[1:]))
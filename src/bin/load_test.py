@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser, Namespace
+import yaml
+
+from therapy_bot.benchmark import StubChatbot, FakeTelegramAPI, LoadGenerator, webhook_delivery, polling_delivery
+from therapy_bot.telegram import Frontend
+
+from typing import Dict
+
+
+def main(args: Namespace) -> int:
+    """Load-test the sharded deployment offline, against a local stand-in of the Telegram Bot API."""
+    # Initialisation
+    # Get date-time
+    date_time_session: str = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    # Read YAML file (if any)
+    if args.config_file_path is not None:
+        with open(args.config_file_path) as f:
+            configs: Dict = yaml.full_load(f)
+    else:
+        configs = {'chatbot': dict(), 'telegram': dict()}
+    # Create output directory
+    output_file_path: str = args.output_file_path if args.output_file_path is not None else os.path.join(
+        '.', 'sessions', 'benchmarks', f'load_test_{args.backend}_{args.n_workers}w_{date_time_session}.json'
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output_file_path)), exist_ok=True)
+    # Init logging
+    logging.basicConfig(level=args.log_level)
+    # Start the Bot API stand-in
+    api = FakeTelegramAPI()
+    api.start()
+    logging.info(f"Bot API stand-in listening at '{api.base_url}'")
+
+    # Run load test
+    with TemporaryDirectory() as tmp_dir_path:
+        # Deployment settings (sessions and conversation store are temporary, access is not restricted)
+        configs['log_level'] = args.log_level
+        configs['log_file'] = False
+        configs['tracing'] = dict()
+        configs['telegram'] = {
+            **{key: value for key, value in configs['telegram'].items() if key not in {'authorised_users_file', 'access'}},
+            'token': api.token,
+            'base_url': api.base_url,
+            'base_file_url': api.base_file_url
+        }
+        configs['cluster'] = {
+            **configs.get('cluster', dict()),
+            'n_workers': args.n_workers,
+            'ingress': args.ingress,
+            'host': '127.0.0.1',
+            'port': args.port,
+            'webhook_url': None,
+            'socket_dir': tmp_dir_path,
+            'health_interval': 1.0
+        }
+        frontend = Frontend(
+            configs, tmp_dir_path, tmp_dir_path, chatbot_factory=StubChatbot if args.backend == 'stub' else None
+        )
+        if args.ingress == 'webhook':
+            deliver = webhook_delivery(
+                f"http://127.0.0.1:{args.port}{frontend.webhook_path}", secret_token=frontend.secret_token
+            )
+        else:
+            deliver = polling_delivery(api)
+        load_generator = LoadGenerator(api, deliver, reply_timeout=args.reply_timeout, think_time=args.think_time)
+        results = dict()
+
+        def generate_load():
+            # Wait for the workers, run the chats, then drain the deployment
+            while frontend.status == 'starting':
+                threading.Event().wait(0.1)
+            if frontend.status != 'ok':
+                return
+            logging.info(f"Load test started ({args.n_workers} workers, {args.n_chats} chats, {args.n_turns} turns)")
+            try:
+                results.update(load_generator.run(
+                    n_chats=args.n_chats,
+                    n_turns=args.n_turns,
+                    voice_ratio=args.voice_ratio,
+                    voice_duration=args.voice_duration,
+                    random_seed=args.random_seed
+                ))
+                results["health"] = frontend.health()
+            finally:
+                frontend.stop()
+
+        threading.Thread(target=generate_load, name='load-generator', daemon=True).start()
+        asyncio.run(frontend.run())
+    api.close()
+    results = {
+        'backend': args.backend, 'n_workers': args.n_workers, 'ingress': args.ingress, 'date_time': date_time_session,
+        **results
+    }
+    # Save results
+    with open(output_file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Load test results saved at '{output_file_path}'")
+    for stage, stats in results.get('stages', dict()).items():
+        if len(stats) > 0:
+            logging.info(
+                f"{stage}: p50 {stats['p50']:.3f} s, p95 {stats['p95']:.3f} s, p99 {stats['p99']:.3f} s "
+                f"({stats['count']} samples)"
+            )
+    if 'throughput' in results:
+        logging.info(f"Throughput: {results['throughput']:.2f} turns/s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Instantiate argument parser
+    args_parser: ArgumentParser = ArgumentParser()
+    # Add arguments to parser
+    args_parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['stub', 'models'],
+        default='stub',
+        help="Models of the workers: simulated latencies (stub) or the ones in the configuration (models)."
+    )
+    args_parser.add_argument(
+        '--config_file_path',
+        type=str,
+        default=None,
+        help="Path to the YAML file with the configuration of the service."
+    )
+    args_parser.add_argument(
+        '--output_file_path', type=str, default=None, help="Path to the JSON file where to store the results."
+    )
+    args_parser.add_argument('--n_workers', type=int, default=2, help="Number of model-worker processes.")
+    args_parser.add_argument(
+        '--ingress', type=str, choices=['webhook', 'polling'], default='webhook', help="How updates reach the front-end."
+    )
+    args_parser.add_argument('--port', type=int, default=8080, help="Port of the front-end.")
+    args_parser.add_argument('--n_chats', type=int, default=8, help="Number of concurrent chats.")
+    args_parser.add_argument('--n_turns', type=int, default=8, help="Number of user messages in each chat.")
+    args_parser.add_argument('--voice_ratio', type=float, default=0.5, help="Fraction of voice messages.")
+    args_parser.add_argument(
+        '--voice_duration', type=float, default=3.0, help="Average duration of the voice messages (in seconds)."
+    )
+    args_parser.add_argument(
+        '--reply_timeout', type=float, default=300.0, help="Maximum waiting time for a reply (in seconds)."
+    )
+    args_parser.add_argument(
+        '--think_time', type=float, default=0.2, help="Pause of the users between a reply and the next message."
+    )
+    args_parser.add_argument('--random_seed', type=int, default=2307, help="Random seed.")
+    args_parser.add_argument('--log_level', type=str, default='INFO', help="Logging level.")
+    # Run load test
+    main(args_parser.parse_args(sys.argv[1:]))
@@ -6,8 +6,8 @@ from datetime import datetime
 from argparse import ArgumentParser, Namespace
 import yaml
 
-from telegram.ext import Application
-from therapy_bot.telegram import init_conversation_handler
+from therapy_bot.telegram import init_conversation_store, init_application
+from therapy_bot.chatbot.tracing import tracer
 
 from typing import Dict
 
@@ -36,6 +36,17 @@ def main(args: Namespace) -> int:
     else:
         log_file_path = None
     configs_dump_path = os.path.join(current_session_dir_path, 'configs.yaml')
+    tracing_configs: Dict = configs.get('tracing', dict())
+    if tracing_configs.get('trace_file', False):
+        trace_file_path = os.path.join(
+            current_session_dir_path, f"{configs['session_id']}_{date_time_session}_trace.jsonl"
+        )
+    else:
+        trace_file_path = None
+    store_configs: Dict = configs['telegram'].get('store', dict())
+    evaluations_file_path = os.path.join(
+        current_session_dir_path, f"{configs['session_id']}_{date_time_session}_evaluations.jsonl"
+    )
     # Init logging
     logging.basicConfig(filename=log_file_path, level=configs['log_level'])
     # Start Logging info
@@ -46,16 +57,29 @@ def main(args: Namespace) -> int:
     # Dump configs
     copy2(args.config_file_path, configs_dump_path)
     logging.info(f"Current session configuration dumped at '{configs_dump_path}'")
+    # Init tracing (disabled if neither the trace file nor the metrics endpoint are required)
+    tracer.configure(
+        trace_file_path=trace_file_path,
+        metrics_host=tracing_configs.get('metrics_host', '127.0.0.1'),
+        metrics_port=tracing_configs.get('metrics_port')
+    )
+
+    # Init conversation store
+    conversation_store = init_conversation_store(configs, session_series_dir_path)
 
     # Start
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(configs['telegram']['token']).arbitrary_callback_data(True).build()
-    # Add conversation handler
-    application.add_handler(init_conversation_handler(configs))
+    # Create the Application with the conversation handler
+    application = init_application(configs, conversation_store=conversation_store)
     # Run the bot until the user presses Ctrl-C you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since start_polling()
     # is non-blocking and will stop the bot gracefully.
     application.run_polling()
+    # Export the evaluations and close the store (pending writes are committed)
+    if conversation_store is not None:
+        if store_configs.get('export_evaluations', True):
+            n_conversations = conversation_store.export_evaluations(evaluations_file_path)
+            logging.info(f"{n_conversations} evaluated conversations exported at '{evaluations_file_path}'")
+        conversation_store.close()
 
     return 0
 
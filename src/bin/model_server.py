@@ -0,0 +1,113 @@
+import os
+import sys
+import signal
+import threading
+from shutil import copy2
+import logging
+from datetime import datetime
+from argparse import ArgumentParser, Namespace
+from urllib.parse import urlparse
+import yaml
+
+from therapy_bot.chatbot import Chatbot, ModelServer
+from therapy_bot.chatbot.tracing import tracer
+from therapy_bot.telegram.utils import STATUS_MESSAGES
+
+from typing import Dict
+
+
+def main(args: Namespace) -> int:
+    """Run the model server, the bot processes configured to use it share its models."""
+    # Initialisation
+    # Get date-time
+    date_time_session: str = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    # Read YAML file
+    with open(args.config_file_path) as f:
+        configs: Dict = yaml.full_load(f)
+    server_configs: Dict = configs.get('model_server', dict())
+    # Create session directories
+    sessions_dir_path: str = configs['sessions_directory_path']
+    if not os.path.exists(sessions_dir_path):
+        os.mkdir(sessions_dir_path)
+    session_series_dir_path: str = os.path.join(sessions_dir_path, configs['session_series'])
+    if not os.path.exists(session_series_dir_path):
+        os.mkdir(session_series_dir_path)
+    current_session_dir_path = os.path.join(
+        session_series_dir_path, f"{configs['session_id']}_model_server_{date_time_session}"
+    )
+    if not os.path.exists(current_session_dir_path):
+        os.mkdir(current_session_dir_path)
+    # Create file paths
+    if configs.get('log_file', False):
+        log_file_path = os.path.join(current_session_dir_path, f"{configs['session_id']}_{date_time_session}.log")
+    else:
+        log_file_path = None
+    configs_dump_path = os.path.join(current_session_dir_path, 'configs.yaml')
+    tracing_configs: Dict = configs.get('tracing', dict())
+    if tracing_configs.get('trace_file', False):
+        trace_file_path = os.path.join(
+            current_session_dir_path, f"{configs['session_id']}_{date_time_session}_trace.jsonl"
+        )
+    else:
+        trace_file_path = None
+    # Init logging
+    logging.basicConfig(filename=log_file_path, level=configs['log_level'])
+    # Start Logging info
+    logging.info(f"{configs['session_series']} model server started")
+    logging.info(f"Current session directories created at '{current_session_dir_path}'")
+    if log_file_path is not None:
+        logging.info(f"Current session log created at '{log_file_path}'")
+    # Dump configs
+    copy2(args.config_file_path, configs_dump_path)
+    logging.info(f"Current session configuration dumped at '{configs_dump_path}'")
+    # Init tracing (disabled if neither the trace file nor the metrics endpoint are required)
+    tracer.configure(
+        trace_file_path=trace_file_path,
+        metrics_host=tracing_configs.get('metrics_host', '127.0.0.1'),
+        metrics_port=tracing_configs.get('metrics_port')
+    )
+
+    # Start
+    # Load the models (in background, requests are served in the meanwhile) and pre-render the status messages
+    chatbot = Chatbot(mixed_precision=configs.get('mixed_precision', False), **configs['chatbot'])
+    chatbot.models.warmup()
+    chatbot.models.start()
+    if chatbot.speech_cache is not None:
+        threading.Thread(
+            target=chatbot.prerender_responses, args=(STATUS_MESSAGES,), name='speech-prerendering', daemon=True
+        ).start()
+    # Serve until the process receives SIGTERM or SIGINT
+    address = urlparse(server_configs.get('url', 'http://127.0.0.1:8090'))
+    model_server = ModelServer(
+        chatbot,
+        host=address.hostname,
+        port=address.port,
+        socket_path=address.path if address.scheme == 'unix' else None,
+        max_pending=server_configs.get('max_pending', 64),
+        max_cached_contexts=server_configs.get('max_cached_contexts', 1024)
+    )
+    stop = threading.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: stop.set())
+    model_server.start()
+    stop.wait()
+    # Complete the admitted requests, then stop
+    model_server.close(drain_timeout=server_configs.get('drain_timeout', 60.0))
+    logging.info(f"Model server statistics: {model_server.stats()}")
+    chatbot.models.close()
+    tracer.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Instantiate argument parser
+    args_parser: ArgumentParser = ArgumentParser()
+    # Add arguments to parser
+    args_parser.add_argument(
+        '--config_file_path',
+        type=str,
+        help="Path to the YAML file containing the configuration for the session."
+    )
+    # Run experiment
+    main(args_parser.parse_args(sys.argv[1:]))
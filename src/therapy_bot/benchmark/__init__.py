@@ -0,0 +1,5 @@
+from .recorder import StageRecorder
+from .backends import StubChatbot, build_tiny_chatbot
+from .harness import run_benchmark, compare_results
+from .fake_telegram import FakeTelegramAPI
+from .load_test import LoadGenerator, webhook_delivery, polling_delivery
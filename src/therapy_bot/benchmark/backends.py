@@ -0,0 +1,268 @@
+import io
+import json
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers import GPT2Config, GPT2Model, GPT2LMHeadModel, GPT2Tokenizer
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from therapy_bot.chatbot import Chatbot
+
+from .fakes import write_wav, read_wav
+from .recorder import StageRecorder
+
+from typing import List, Dict, Optional, Union
+
+
+TRANSCRIPTS: List[str] = [
+    "I have been feeling really anxious lately.",
+    "I can't sleep at night and I keep thinking about work.",
+    "My family doesn't understand what I'm going through.",
+    "Sometimes I feel like nothing I do matters.",
+    "I tried going for a walk like you suggested, it helped a bit."
+]
+
+STUB_RESPONSE: str = "I understand. That sounds really hard. How does that make you feel?"
+
+STUB_LATENCIES: Dict[str, float] = {
+    'asr': 0.3,
+    'generation': 0.2,
+    'generation_per_utterance': 0.01,
+    'gst_prediction': 0.02,
+    'tts_per_char': 0.002,
+    'vocoding_per_char': 0.001
+}
+
+TINY_GPT2_CONFIG: Dict = {'n_layer': 2, 'n_head': 2, 'n_embd': 64, 'n_positions': 1024}
+
+
+def build_tokenizer(dir_path: str) -> GPT2Tokenizer:
+    # Byte-level GPT-2 tokeniser without merges (it does not need to be downloaded)
+    vocab = {char: idx for idx, char in enumerate(bytes_to_unicode().values())}
+    vocab['<|endoftext|>'] = len(vocab)
+    with open(os.path.join(dir_path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(dir_path, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n')
+    tokenizer = GPT2Tokenizer(os.path.join(dir_path, 'vocab.json'), os.path.join(dir_path, 'merges.txt'))
+    tokenizer.save_pretrained(dir_path)
+
+    return tokenizer
+
+
+class TinyWhisper(nn.Module):
+    """
+    Randomly initialised Whisper-shaped model: spectrogram front-end, convolutional and transformer encoder,
+    auto-regressive transformer decoder.
+    """
+    def __init__(
+            self, n_mels: int = 80, d_model: int = 64, n_heads: int = 2, n_layers: int = 2, max_new_tokens: int = 16
+    ):
+        super(TinyWhisper, self).__init__()
+        self.max_new_tokens: int = max_new_tokens
+        self.mel_projection = nn.Linear(201, n_mels)
+        self.conv = nn.Sequential(
+            nn.Conv1d(n_mels, d_model, 3, padding=1),
+            nn.GELU(),
+            nn.Conv1d(d_model, d_model, 3, stride=2, padding=1),
+            nn.GELU()
+        )
+        self.encoder = nn.TransformerEncoder(
+            nn.TransformerEncoderLayer(d_model, n_heads, dim_feedforward=4 * d_model, batch_first=True), n_layers
+        )
+        self.token_embedding = nn.Embedding(256, d_model)
+        self.decoder = nn.TransformerDecoder(
+            nn.TransformerDecoderLayer(d_model, n_heads, dim_feedforward=4 * d_model, batch_first=True), n_layers
+        )
+        self.lm_head = nn.Linear(d_model, 256)
+
+    @property
+    def device(self) -> torch.device:
+        return self.lm_head.weight.device
+
+    @torch.no_grad()
+    def transcribe(self, audio: Union[str, np.ndarray], **kwargs) -> Dict:
+        if isinstance(audio, str):
+            audio, _ = read_wav(audio)
+        audio = torch.as_tensor(audio, dtype=torch.float32)
+        spectrogram = torch.stft(audio, 400, 160, window=torch.hann_window(400), return_complex=True).abs() ** 2
+        mel = self.mel_projection(spectrogram.T).clamp(min=1e-10).log10()
+        memory = self.encoder(self.conv(mel.T.unsqueeze(0)).transpose(1, 2))
+        tokens = [0]
+        for _ in range(self.max_new_tokens):
+            hidden_states = self.decoder(self.token_embedding(torch.tensor([tokens])), memory)
+            tokens.append(int(self.lm_head(hidden_states[:, -1]).argmax(dim=-1)))
+
+        return {'text': TRANSCRIPTS[len(audio) % len(TRANSCRIPTS)]}
+
+
+class TinySpeechGenerator(nn.Module):
+    """
+    Randomly initialised stand-in of the expressive speech generator, with the same interface:
+    DLDLM-shaped GST prediction, Mellotron-shaped auto-regressive acoustic model and WaveGlow-shaped vocoder.
+    """
+    def __init__(
+            self,
+            tokenizer: GPT2Tokenizer,
+            recorder: Optional[StageRecorder] = None,
+            n_mels: int = 80,
+            d_model: int = 64,
+            gst_shape: tuple = (4, 10),
+            frames_per_char: int = 5,
+            max_context_len: int = 256,
+            sampling_rate: int = 22050
+    ):
+        super(TinySpeechGenerator, self).__init__()
+        self.tokenizer: GPT2Tokenizer = tokenizer
+        self.recorder: Optional[StageRecorder] = recorder
+        self.n_mels: int = n_mels
+        self.gst_shape: tuple = gst_shape
+        self.frames_per_char: int = frames_per_char
+        self.max_context_len: int = max_context_len
+        self.sampling_rate: int = sampling_rate
+        # GST prediction
+        self.dldlm = GPT2Model(GPT2Config(vocab_size=len(tokenizer), **TINY_GPT2_CONFIG))
+        self.gst_head = nn.Linear(self.dldlm.config.n_embd, gst_shape[0] * gst_shape[1])
+        self.gst_tokens = nn.Parameter(torch.randn(gst_shape[1], d_model))
+        # Acoustic model
+        self.char_embedding = nn.Embedding(256, d_model)
+        self.text_encoder = nn.Sequential(
+            nn.Conv1d(d_model, d_model, 5, padding=2), nn.ReLU(), nn.Conv1d(d_model, d_model, 5, padding=2), nn.ReLU()
+        )
+        self.decoder_cell = nn.GRUCell(n_mels + 2 * d_model, 2 * d_model)
+        self.frame_projection = nn.Linear(2 * d_model, n_mels)
+        # Vocoder (256x up-sampling of the spectrogram frames)
+        self.vocoder = nn.Sequential(*[
+            module for i in range(4) for module in (
+                nn.ConvTranspose1d(n_mels if i == 0 else 32, 32 if i < 3 else 1, 8, stride=4, padding=2), nn.Tanh()
+            )
+        ])
+        self.eval()
+
+    def _time(self, stage: str):
+        return self.recorder.time(stage) if self.recorder is not None else nullcontext()
+
+    @torch.no_grad()
+    def generate_speech_response(
+            self,
+            response: str,
+            output: Union[str, io.IOBase],
+            dialogue: Optional[List[str]] = None,
+            gst_prediction: Optional[str] = None,
+            speaker_id: Optional[int] = None
+    ):
+        with self._time('gst_prediction'):
+            input_ids = self.tokenizer('\n'.join(dialogue) if dialogue is not None else '\n').input_ids
+            hidden_state = self.dldlm(input_ids=torch.tensor([input_ids[-self.max_context_len:]])).last_hidden_state
+            gst_weights = self.gst_head(hidden_state[:, -1]).view(*self.gst_shape).softmax(dim=-1)
+            style = gst_weights.mean(dim=0) @ self.gst_tokens
+        with self._time('tts'):
+            chars = torch.tensor([list(response.encode())])
+            encoded_text = self.text_encoder(self.char_embedding(chars).transpose(1, 2)).mean(dim=-1)
+            frame = torch.zeros(1, self.n_mels)
+            hidden_state = torch.zeros(1, self.decoder_cell.hidden_size)
+            frames = list()
+            for _ in range(self.frames_per_char * chars.size(1)):
+                decoder_input = torch.cat([frame, encoded_text, style.unsqueeze(0)], dim=-1)
+                hidden_state = self.decoder_cell(decoder_input, hidden_state)
+                frame = self.frame_projection(hidden_state)
+                frames.append(frame)
+            mel_spectrogram = torch.stack(frames, dim=-1)
+        with self._time('vocoding'):
+            audio = self.vocoder(mel_spectrogram).squeeze()
+        write_wav(output, audio.numpy(), self.sampling_rate)
+
+
+class StubWhisper:
+    def __init__(self, latency: float):
+        self.latency: float = latency
+        self.device: torch.device = torch.device('cpu')
+
+    def transcribe(self, audio: Union[str, np.ndarray], **kwargs) -> Dict:
+        time.sleep(self.latency)
+        return {'text': TRANSCRIPTS[int(time.perf_counter() * 1000) % len(TRANSCRIPTS)]}
+
+
+class StubSpeechGenerator:
+    def __init__(self, latencies: Dict[str, float], recorder: Optional[StageRecorder] = None):
+        self.latencies: Dict[str, float] = latencies
+        self.recorder: Optional[StageRecorder] = recorder
+
+    def _time(self, stage: str):
+        return self.recorder.time(stage) if self.recorder is not None else nullcontext()
+
+    def generate_speech_response(self, response: str, output: Union[str, io.IOBase], **kwargs):
+        with self._time('gst_prediction'):
+            time.sleep(self.latencies['gst_prediction'])
+        with self._time('tts'):
+            time.sleep(self.latencies['tts_per_char'] * len(response))
+        with self._time('vocoding'):
+            time.sleep(self.latencies['vocoding_per_char'] * len(response))
+        write_wav(output, np.zeros(256 * len(response), dtype=np.float32), 22050)
+
+
+class StubChatbot(Chatbot):
+    """
+    Chatbot simulating the latency of the neural networks instead of running them.
+    """
+    def __init__(
+            self,
+            recorder: Optional[StageRecorder] = None,
+            latencies: Optional[Dict[str, float]] = None,
+            chatbot_id: str = 'TherapyBot',
+            user_id: str = 'User'
+    ):
+        super(StubChatbot, self).__init__(chatbot_id=chatbot_id, user_id=user_id)
+        self.latencies: Dict[str, float] = {**STUB_LATENCIES, **(latencies if latencies is not None else dict())}
+        self.models.register('whisper', lambda: StubWhisper(self.latencies['asr']))
+        self.models.register(
+            'expressive_speech_generator', lambda: StubSpeechGenerator(self.latencies, recorder=recorder)
+        )
+
+    def generate_response(self, context: List[Dict[str, str]], *args, **kwargs) -> str:
+        time.sleep(self.latencies['generation'] + self.latencies['generation_per_utterance'] * len(context))
+        return STUB_RESPONSE
+
+
+def build_tiny_chatbot(
+        dir_path: str,
+        recorder: Optional[StageRecorder] = None,
+        chatbot_configs: Optional[Dict] = None,
+        max_new_tokens: int = 32
+) -> Chatbot:
+    # Chatbot with randomly initialised tiny models
+    # NOTE the text generation settings (batching, caches, context windows) are taken from the given configuration
+    chatbot_configs = chatbot_configs if chatbot_configs is not None else dict()
+    tokenizer = build_tokenizer(dir_path)
+    GPT2LMHeadModel(GPT2Config(vocab_size=len(tokenizer), **TINY_GPT2_CONFIG)).save_pretrained(dir_path)
+    dlm = {
+        key: value for key, value in chatbot_configs.get('dlm', dict()).items()
+        if key in ('generator_params', 'batching', 'kv_cache', 'context_window', 'speculative')
+    }
+    if dlm.get('speculative') is not None:
+        # Draft model with a single layer
+        draft_dir_path = os.path.join(dir_path, 'draft')
+        GPT2LMHeadModel(
+            GPT2Config(vocab_size=len(tokenizer), **{**TINY_GPT2_CONFIG, 'n_layer': 1})
+        ).save_pretrained(draft_dir_path)
+        dlm['speculative'] = {**dlm['speculative'], 'draft_model': draft_dir_path}
+    generator_params = dlm.get('generator_params', dict())
+    dlm['generator_params'] = {
+        **generator_params,
+        'generate_kwargs': {**generator_params.get('generate_kwargs', dict()), 'max_new_tokens': max_new_tokens}
+    }
+    dlm['ppm_dlm'] = {'model': dir_path, 'tokenizer': dir_path}
+    chatbot = Chatbot(
+        chatbot_id=chatbot_configs.get('chatbot_id', 'TherapyBot'),
+        user_id=chatbot_configs.get('user_id', 'User'),
+        dlm=dlm,
+        models={'warmup': None}
+    )
+    chatbot.models.register('whisper', TinyWhisper)
+    chatbot.models.register('expressive_speech_generator', lambda: TinySpeechGenerator(tokenizer, recorder=recorder))
+
+    return chatbot
@@ -0,0 +1,217 @@
+import json
+import time
+import threading
+from itertools import count
+from urllib.parse import parse_qsl, unquote
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from typing import List, Dict, Tuple, Optional, Any
+
+
+BOT_USER: Dict = {'id': 1, 'is_bot': True, 'first_name': 'TherapyBot', 'username': 'therapy_bot'}
+
+
+def command_update(update_id: int, chat_id: int, message_id: int, text: str) -> Dict:
+    update = text_update(update_id, chat_id, message_id, text)
+    update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+    return update
+
+
+def text_update(update_id: int, chat_id: int, message_id: int, text: str) -> Dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text
+        }
+    }
+
+
+def voice_update(update_id: int, chat_id: int, message_id: int, file_id: str, duration: int) -> Dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'voice': {'file_id': file_id, 'file_unique_id': file_id, 'duration': duration, 'mime_type': 'audio/ogg'}
+        }
+    }
+
+
+class FakeTelegramAPI:
+    """
+    Local stand-in for the Telegram Bot API, to load-test the deployment offline.
+    It serves the methods used by the bot (the sent messages are recorded per chat), the file downloads
+    and a queue of updates for long polling.
+    Point the bot to it with the `base_url` and `base_file_url` settings of the `telegram` configuration.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, token: str = '0:TEST'):
+        self.token: str = token
+        self._condition: threading.Condition = threading.Condition()
+        self._message_ids = count(1)
+        self._file_ids = count(1)
+        self._files: Dict[str, bytes] = dict()
+        self._updates: List[Dict] = list()
+        self.sent: Dict[int, List[Dict]] = dict()
+        self.calls: Dict[str, int] = dict()
+        self._server: ThreadingHTTPServer = ThreadingHTTPServer((host, port), self._handler())
+        self.host, self.port = self._server.server_address[:2]
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/bot'
+
+    @property
+    def base_file_url(self) -> str:
+        return f'http://{self.host}:{self.port}/file/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-telegram-api', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_file(self, data: bytes) -> str:
+        with self._condition:
+            file_id = f'file_{next(self._file_ids)}'
+            self._files[file_id] = data
+
+        return file_id
+
+    def push_update(self, update: Dict):
+        # Update to be fetched with getUpdates
+        with self._condition:
+            self._updates.append(update)
+            self._condition.notify_all()
+
+    def messages(self, chat_id: int, method: Optional[str] = None) -> List[Dict]:
+        with self._condition:
+            return [
+                message for message in self.sent.get(chat_id, list()) if method is None or message['method'] == method
+            ]
+
+    def wait_for_messages(self, chat_id: int, n: int, method: str = 'sendMessage', timeout: float = 60.0) -> bool:
+        # Wait until the bot sent (at least) n messages to the chat with the given method
+        def sent():
+            return sum(message['method'] == method for message in self.sent.get(chat_id, list())) >= n
+
+        with self._condition:
+            return self._condition.wait_for(sent, timeout=timeout)
+
+    def _message(self, chat_id: int, **kwargs) -> Dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            **kwargs
+        }
+
+    def call(self, method: str, params: Dict[str, Any], files: Dict[str, bytes]) -> Tuple[bool, Any]:
+        # Bot API methods (the ones not listed just succeed)
+        with self._condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == 'getMe':
+                return True, BOT_USER
+            elif method == 'getUpdates':
+                offset = int(params.get('offset', 0) or 0)
+                self._condition.wait_for(
+                    lambda: any(update['update_id'] >= offset for update in self._updates),
+                    timeout=float(params.get('timeout', 0) or 0)
+                )
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                return True, list(self._updates)
+            elif method == 'getFile':
+                file_id = params['file_id']
+                if file_id not in self._files:
+                    return False, 'Bad Request: invalid file_id'
+                return True, {
+                    'file_id': file_id,
+                    'file_unique_id': file_id,
+                    'file_size': len(self._files[file_id]),
+                    'file_path': f'voice/{file_id}.ogg'
+                }
+            elif method in ('sendMessage', 'sendVoice', 'editMessageText'):
+                chat_id = int(params['chat_id'])
+                if method == 'sendVoice':
+                    voice = files.get(params.get('voice', '').replace('attach://', ''), files.get('voice', b''))
+                    file_id = f'file_{next(self._file_ids)}'
+                    self._files[file_id] = voice
+                    message = self._message(chat_id, voice={
+                        'file_id': file_id, 'file_unique_id': file_id, 'duration': 0, 'file_size': len(voice)
+                    })
+                elif method == 'editMessageText':
+                    message = self._message(chat_id, text=params['text'])
+                    message['message_id'] = int(params['message_id'])
+                else:
+                    message = self._message(chat_id, text=params['text'])
+                self.sent.setdefault(chat_id, list()).append({'method': method, 'time': time.time(), **message})
+                self._condition.notify_all()
+                return True, message
+            else:
+                return True, True
+
+    def _handler(self):
+        api = self
+
+        class FakeTelegramHandler(BaseHTTPRequestHandler):
+            def _reply(self, code: int, body: bytes, content_type: str = 'application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # File downloads (the token in the path is URL-encoded)
+                prefix, path = f'/file/bot{api.token}/voice/', unquote(self.path)
+                file_id = path[len(prefix):-len('.ogg')] if path.startswith(prefix) else None
+                if file_id not in api._files:
+                    self.send_error(404)
+                    return
+                self._reply(200, api._files[file_id], content_type='application/octet-stream')
+
+            def do_POST(self):
+                prefix = f'/bot{api.token}/'
+                if not self.path.startswith(prefix):
+                    self._reply(401, json.dumps({'ok': False, 'error_code': 401, 'description': 'Unauthorized'}).encode())
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type = self.headers.get('Content-Type', '')
+                params, files = dict(), dict()
+                # Parameters are sent as form data (multipart when files are uploaded) or as JSON
+                if content_type.startswith('multipart/form-data'):
+                    message = BytesParser(policy=default_policy).parsebytes(
+                        f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+                    )
+                    for part in message.iter_parts():
+                        name = part.get_param('name', header='content-disposition')
+                        if part.get_filename() is not None:
+                            files[name] = part.get_payload(decode=True)
+                        else:
+                            params[name] = part.get_content()
+                elif content_type.startswith('application/json'):
+                    params = json.loads(body) if body else dict()
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                ok, result = api.call(self.path[len(prefix):].split('?')[0], params, files)
+                if ok:
+                    self._reply(200, json.dumps({'ok': True, 'result': result}).encode())
+                else:
+                    self._reply(400, json.dumps({'ok': False, 'error_code': 400, 'description': result}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        return FakeTelegramHandler
@@ -0,0 +1,90 @@
+import io
+import time
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+
+from therapy_bot.chatbot.audio import encode_voice
+
+from typing import List, Dict, Tuple, Optional, Any, Union
+
+
+def write_wav(file: Union[str, io.IOBase], audio: np.ndarray, sampling_rate: int):
+    # Save mono audio (float samples in [-1, 1]) as 16 bit PCM WAV
+    with wave.open(file, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sampling_rate)
+        wav_file.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+
+
+def read_wav(file: Union[str, io.IOBase]) -> Tuple[np.ndarray, int]:
+    with wave.open(file, 'rb') as wav_file:
+        sampling_rate = wav_file.getframerate()
+        audio = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16).astype(np.float32) / 32767
+
+    return audio, sampling_rate
+
+
+def synthetic_voice_note(duration: float, sampling_rate: int = 16000, seed: Optional[int] = None) -> bytes:
+    # Noisy harmonic signal with a speech-like envelope, encoded as OGG/Opus like Telegram voice notes
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
+    f0 = rng.uniform(100.0, 220.0)
+    audio = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 4))
+    audio *= 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(2.0, 5.0) * t))
+    audio = 0.3 * audio / np.abs(audio).max() + 0.01 * rng.standard_normal(len(t))
+
+    return encode_voice(audio, sampling_rate)
+
+
+class FakeFile:
+    def __init__(self, data: bytes):
+        self.data: bytes = data
+
+    async def download_to_drive(self, custom_path: Optional[str] = None) -> str:
+        with open(custom_path, 'wb') as f:
+            f.write(self.data)
+
+        return custom_path
+
+    async def download_to_memory(self, out: io.IOBase):
+        out.write(self.data)
+
+
+class FakeVoice:
+    def __init__(self, data: bytes, duration: int):
+        self.data: bytes = data
+        self.duration: int = duration
+
+    async def get_file(self) -> FakeFile:
+        return FakeFile(self.data)
+
+
+class FakeMessage:
+    """
+    Stand-in for the Telegram message, it records the replies of the bot with their time stamp.
+    """
+    def __init__(self, text: Optional[str] = None, voice: Optional[FakeVoice] = None):
+        self.text: Optional[str] = text
+        self.voice: Optional[FakeVoice] = voice
+        self.replies: List[Tuple[float, str, Any]] = list()
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append((time.perf_counter(), 'text', text))
+
+    async def reply_voice(self, voice: Any, **kwargs):
+        self.replies.append((time.perf_counter(), 'voice', voice))
+
+
+class FakeUpdate:
+    def __init__(self, chat_id: int, message: FakeMessage):
+        self.effective_user: SimpleNamespace = SimpleNamespace(id=chat_id)
+        self.effective_chat: SimpleNamespace = SimpleNamespace(id=chat_id)
+        self.message: FakeMessage = message
+
+
+class FakeContext:
+    def __init__(self):
+        self.chat_data: Dict = dict()
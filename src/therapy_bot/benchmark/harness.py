@@ -0,0 +1,134 @@
+import asyncio
+import random
+import time
+
+from therapy_bot.chatbot import Chatbot
+from therapy_bot.telegram import handlers
+from therapy_bot.telegram import init_conversation_handler
+
+from .fakes import FakeContext, FakeMessage, FakeUpdate, FakeVoice, synthetic_voice_note
+from .recorder import StageRecorder
+
+from typing import List, Dict, Optional
+
+
+USER_MESSAGES: List[str] = [
+    "Hi, I'm not feeling great today.",
+    "I have been feeling really anxious lately and I can't focus on anything.",
+    "It started a few weeks ago, when I changed job.",
+    "My new colleagues are nice, but I feel like I don't fit in.",
+    "I keep thinking that they will find out that I'm not good enough.",
+    "I don't know, maybe I'm just tired.",
+    "I used to go running, but I stopped when I moved here.",
+    "Yes, I think that could help."
+]
+
+
+def instrument(chatbot: Chatbot, recorder: StageRecorder):
+    # Time the calls to the models (the turn of generation is computed from the length of the context)
+    chatbot._transcribe = recorder.wrap('asr', chatbot._transcribe)
+    chatbot.generate_response = recorder.wrap(
+        'generation', chatbot.generate_response, turn=lambda context, *args, **kwargs: len(context) // 2
+    )
+    chatbot._synthesise = recorder.wrap('synthesis', chatbot._synthesise)
+
+
+async def simulate_chat(
+        chat_id: int, n_turns: int, voice_ratio: float, voice_duration: float, recorder: StageRecorder, seed: int
+) -> Dict[str, int]:
+    # Go through a whole session: start, conversation with text and voice messages, closing
+    rng = random.Random(seed)
+    context = FakeContext()
+    counts = {'turns': 0, 'rejected': 0, 'voice_replies': 0}
+    # NOTE the callbacks are called directly, the admission control and the ordering of the conversation handler
+    # are applied to each of them
+    start_bot, start_chatting, stop_chatting = (
+        handlers.ordered_per_chat(handler)
+        for handler in (handlers.start_bot, handlers.start_chatting, handlers.stop_chatting)
+    )
+    await start_bot(FakeUpdate(chat_id, FakeMessage(text='/start')), context)
+    await start_chatting(FakeUpdate(chat_id, FakeMessage(text='/begin')), context)
+    for turn in range(n_turns):
+        if rng.random() < voice_ratio:
+            stage = 'handler_voice'
+            duration = rng.uniform(0.5, 1.5) * voice_duration
+            message = FakeMessage(voice=FakeVoice(synthetic_voice_note(duration, seed=rng.getrandbits(32)), duration))
+            handler = handlers.get_voice_response
+        else:
+            stage = 'handler_text'
+            message = FakeMessage(text=USER_MESSAGES[turn % len(USER_MESSAGES)])
+            handler = handlers.get_text_response
+        start_time = time.perf_counter()
+        state = await handlers.ordered_per_chat(handler)(FakeUpdate(chat_id, message), context)
+        recorder.add(stage, time.perf_counter() - start_time, turn=turn)
+        if state is None:
+            counts['rejected'] += 1
+            continue
+        counts['turns'] += 1
+        counts['voice_replies'] += sum(kind == 'voice' for _, kind, _ in message.replies)
+        if len(message.replies) > 0:
+            recorder.add('first_reply', message.replies[0][0] - start_time, turn=turn)
+    await stop_chatting(FakeUpdate(chat_id, FakeMessage(text='/end')), context)
+
+    return counts
+
+
+async def run_benchmark(
+        chatbot: Chatbot,
+        recorder: StageRecorder,
+        n_chats: int = 4,
+        n_turns: int = 8,
+        voice_ratio: float = 0.5,
+        voice_duration: float = 3.0,
+        inference: Optional[Dict] = None,
+        random_seed: int = 2307
+) -> Dict:
+    # Drive the Telegram handlers with concurrent synthetic conversations of growing length
+    instrument(chatbot, recorder)
+    init_conversation_handler({'telegram': {'inference': inference if inference is not None else dict()}}, chatbot)
+    # Load all the models before starting, so that loading times are not mixed with the latencies
+    with recorder.time('warmup'):
+        chatbot.models.warmup(background=False)
+    start_time = time.perf_counter()
+    counts = await asyncio.gather(*[
+        simulate_chat(chat_id, n_turns, voice_ratio, voice_duration, recorder, random_seed + chat_id)
+        for chat_id in range(n_chats)
+    ])
+    wall_time = time.perf_counter() - start_time
+    handlers.inference_executor.shutdown(wait=True)
+    n_turns_served = sum(chat_counts['turns'] for chat_counts in counts)
+
+    return {
+        'settings': {
+            'n_chats': n_chats,
+            'n_turns': n_turns,
+            'voice_ratio': voice_ratio,
+            'voice_duration': voice_duration,
+            'inference': inference,
+            'random_seed': random_seed
+        },
+        'wall_time': wall_time,
+        'turns': n_turns_served,
+        'rejected': sum(chat_counts['rejected'] for chat_counts in counts),
+        'voice_replies': sum(chat_counts['voice_replies'] for chat_counts in counts),
+        'throughput': n_turns_served / wall_time,
+        'stages': recorder.summary(),
+        'generation_stats': chatbot.generation_stats(),
+        'speculation_stats': chatbot.speculation_stats(),
+        'transcription_stats': chatbot.transcription_stats(),
+        'synthesis_stats': chatbot.synthesis_stats(),
+        'models': chatbot.models.report()
+    }
+
+
+def compare_results(results: Dict, baseline: Dict, metric: str = 'p50') -> Dict:
+    # Ratio between the current and the baseline latencies (values above 1 are regressions)
+    comparison = {
+        stage: stats[metric] / baseline['stages'][stage][metric]
+        for stage, stats in results['stages'].items()
+        if metric in stats and stage in baseline['stages'] and baseline['stages'][stage].get(metric, 0.0) > 0.0
+    }
+    comparison['throughput'] = baseline['throughput'] / results['throughput'] if results['throughput'] > 0 else None
+
+    return comparison
+
@@ -0,0 +1,150 @@
+import json
+import time
+import random
+import threading
+import urllib.request
+import urllib.error
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+from .fakes import synthetic_voice_note
+from .fake_telegram import FakeTelegramAPI, command_update, text_update, voice_update
+from .harness import USER_MESSAGES
+from .recorder import StageRecorder
+
+from typing import Dict, Optional, Callable
+
+
+def webhook_delivery(
+        url: str, secret_token: Optional[str] = None, retry_interval: float = 0.2, max_retries: int = 100
+) -> Callable[[Dict], int]:
+    # Post the updates to the webhook like Telegram does (updates not acknowledged are retried)
+    def deliver(update: Dict) -> int:
+        headers = {'Content-Type': 'application/json'}
+        if secret_token is not None:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+        for retry in range(max_retries):
+            request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers, method='POST')
+            try:
+                with urllib.request.urlopen(request) as response:
+                    if response.status == 200:
+                        return retry
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+            time.sleep(retry_interval)
+        raise TimeoutError(f"Update {update['update_id']} not accepted after {max_retries} attempts")
+
+    return deliver
+
+
+def polling_delivery(api: FakeTelegramAPI) -> Callable[[Dict], int]:
+    # Queue the updates in the API stand-in, the front-end fetches them with getUpdates
+    def deliver(update: Dict) -> int:
+        api.push_update(update)
+        return 0
+
+    return deliver
+
+
+class LoadGenerator:
+    """
+    Drives a deployment pointed to the Bot API stand-in with concurrent synthetic chats.
+    Each chat waits for the (final, text) reply before sending the next message, like a user would.
+    """
+    def __init__(
+            self,
+            api: FakeTelegramAPI,
+            deliver: Callable[[Dict], int],
+            recorder: Optional[StageRecorder] = None,
+            reply_timeout: float = 300.0,
+            think_time: float = 0.2
+    ):
+        self.api: FakeTelegramAPI = api
+        self.deliver: Callable[[Dict], int] = deliver
+        self.recorder: StageRecorder = recorder if recorder is not None else StageRecorder()
+        self.reply_timeout: float = reply_timeout
+        self.think_time: float = think_time
+        self._lock: threading.Lock = threading.Lock()
+        self._update_ids = count(1)
+        self.retries: int = 0
+        self.timeouts: int = 0
+
+    def _send(self, chat_id: int, update: Dict, stage: str, turn: Optional[int] = None) -> bool:
+        n_messages = len(self.api.messages(chat_id))
+        n_replies = len(self.api.messages(chat_id, method='sendMessage'))
+        start_time = time.time()
+        retries = self.deliver(update)
+        replied = self.api.wait_for_messages(chat_id, n_replies + 1, timeout=self.reply_timeout)
+        with self._lock:
+            self.retries += retries
+            self.timeouts += not replied
+        if replied:
+            messages = self.api.messages(chat_id)[n_messages:]
+            reply_time = [message for message in messages if message['method'] == 'sendMessage'][0]['time']
+            self.recorder.add(stage, reply_time - start_time, turn=turn)
+            self.recorder.add('first_reply', messages[0]['time'] - start_time, turn=turn)
+        # NOTE the think time also gives the handler of the message the time to return after the reply,
+        # so that the next message finds the updated conversation state
+        time.sleep(self.think_time)
+
+        return replied
+
+    def _update_id(self) -> int:
+        with self._lock:
+            return next(self._update_ids)
+
+    def simulate_chat(self, chat_id: int, n_turns: int, voice_ratio: float, voice_duration: float, seed: int) -> int:
+        rng = random.Random(seed)
+        message_ids = count(1)
+        self._send(chat_id, command_update(self._update_id(), chat_id, next(message_ids), '/start'), 'command')
+        self._send(chat_id, command_update(self._update_id(), chat_id, next(message_ids), '/begin'), 'command')
+        n_replies = 0
+        for turn in range(n_turns):
+            if rng.random() < voice_ratio:
+                duration = rng.uniform(0.5, 1.5) * voice_duration
+                file_id = self.api.add_file(synthetic_voice_note(duration, seed=rng.getrandbits(32)))
+                update = voice_update(self._update_id(), chat_id, next(message_ids), file_id, int(round(duration)))
+                stage = 'reply_voice'
+            else:
+                text = USER_MESSAGES[turn % len(USER_MESSAGES)]
+                update = text_update(self._update_id(), chat_id, next(message_ids), text)
+                stage = 'reply_text'
+            n_replies += self._send(chat_id, update, stage, turn=turn)
+
+        return n_replies
+
+    def run(
+            self,
+            n_chats: int = 8,
+            n_turns: int = 8,
+            voice_ratio: float = 0.5,
+            voice_duration: float = 3.0,
+            random_seed: int = 2307
+    ) -> Dict:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_chats, thread_name_prefix='load-chat') as executor:
+            n_replies = list(executor.map(
+                lambda chat_id: self.simulate_chat(
+                    chat_id, n_turns, voice_ratio, voice_duration, random_seed + chat_id
+                ),
+                range(1, n_chats + 1)
+            ))
+        wall_time = time.perf_counter() - start_time
+
+        return {
+            'settings': {
+                'n_chats': n_chats,
+                'n_turns': n_turns,
+                'voice_ratio': voice_ratio,
+                'voice_duration': voice_duration,
+                'random_seed': random_seed
+            },
+            'wall_time': wall_time,
+            'turns': sum(n_replies),
+            'throughput': sum(n_replies) / wall_time,
+            'retries': self.retries,
+            'timeouts': self.timeouts,
+            'stages': self.recorder.summary(),
+            'api_calls': dict(self.api.calls)
+        }
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from typing import List, Dict, Tuple, Optional, Callable, Iterator
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    if len(samples) == 0:
+        return dict()
+    samples = sorted(samples)
+    summary = {'count': len(samples), 'mean': sum(samples) / len(samples), 'total': sum(samples)}
+    summary.update({f'p{p}': samples[min(len(samples) - 1, (len(samples) * p) // 100)] for p in (50, 95, 99)})
+
+    return summary
+
+
+class StageRecorder:
+    """
+    Thread-safe collection of the latencies of the processing stages.
+    Samples can be tagged with the turn of the conversation they refer to.
+    """
+    def __init__(self):
+        self._lock: threading.Lock = threading.Lock()
+        self._samples: Dict[str, List[Tuple[Optional[int], float]]] = defaultdict(list)
+
+    def add(self, stage: str, duration: float, turn: Optional[int] = None):
+        with self._lock:
+            self._samples[stage].append((turn, duration))
+
+    @contextmanager
+    def time(self, stage: str, turn: Optional[int] = None) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time, turn=turn)
+
+    def wrap(self, stage: str, func: Callable, turn: Optional[Callable[..., int]] = None) -> Callable:
+        # Time each call of the function (optionally computing the turn from the call arguments)
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.time(stage, turn=turn(*args, **kwargs) if turn is not None else None):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            samples = {stage: list(stage_samples) for stage, stage_samples in self._samples.items()}
+        summary = dict()
+        for stage, stage_samples in samples.items():
+            summary[stage] = latency_summary([duration for _, duration in stage_samples])
+            by_turn = defaultdict(list)
+            for turn, duration in stage_samples:
+                if turn is not None:
+                    by_turn[turn].append(duration)
+            if len(by_turn) > 0:
+                summary[stage]['by_turn'] = {
+                    turn: latency_summary(durations)['p50'] for turn, durations in sorted(by_turn.items())
+                }
+
+        return summary
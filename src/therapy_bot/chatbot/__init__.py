@@ -1 +1,3 @@
 from .chatbot_api import Chatbot
+from .server import ModelServer
+from .remote import RemoteChatbot, ModelServerUnavailable
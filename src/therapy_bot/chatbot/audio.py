@@ -0,0 +1,51 @@
+import io
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+from typing import List, Tuple, Union
+
+
+WHISPER_SAMPLING_RATE: int = 16000
+# Sampling rates supported by the Opus encoder
+OPUS_SAMPLING_RATES: List[int] = [8000, 12000, 16000, 24000, 48000]
+
+
+def resample(audio: np.ndarray, sampling_rate: int, target_sampling_rate: int) -> np.ndarray:
+    if sampling_rate == target_sampling_rate:
+        return audio
+    factor = gcd(sampling_rate, target_sampling_rate)
+
+    return resample_poly(audio, target_sampling_rate // factor, sampling_rate // factor).astype(np.float32)
+
+
+def read_audio(buffer: Union[bytes, io.IOBase]) -> Tuple[np.ndarray, int]:
+    # Read mono audio (float samples in [-1, 1]) from an in-memory audio file (e.g., OGG/Opus voice notes or WAV)
+    audio, sampling_rate = sf.read(
+        io.BytesIO(buffer) if isinstance(buffer, (bytes, bytearray)) else buffer, dtype='float32', always_2d=True
+    )
+
+    return audio.mean(axis=1), sampling_rate
+
+
+def decode_audio(buffer: Union[bytes, io.IOBase], sampling_rate: int = WHISPER_SAMPLING_RATE) -> np.ndarray:
+    # Decode an in-memory audio file into the array expected by Whisper (mono, 16 kHz)
+    # NOTE this replaces the ffmpeg sub-process Whisper starts when given a file path
+    audio, source_sampling_rate = read_audio(buffer)
+
+    return resample(audio, source_sampling_rate, sampling_rate)
+
+
+def encode_voice(audio: np.ndarray, sampling_rate: int) -> bytes:
+    # Encode mono audio as OGG/Opus (the format of Telegram voice messages) in memory
+    # Audio is resampled to the closest supported sampling rate not below the original one
+    target_sampling_rate = min(
+        (rate for rate in OPUS_SAMPLING_RATES if rate >= sampling_rate), default=OPUS_SAMPLING_RATES[-1]
+    )
+    audio = resample(np.clip(audio, -1.0, 1.0).astype(np.float32), sampling_rate, target_sampling_rate)
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, target_sampling_rate, format='OGG', subtype='OPUS')
+
+    return buffer.getvalue()
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from queue import Queue, Empty
+from collections import deque
+from concurrent.futures import Future
+
+from .generation import GenerationRequest
+
+from typing import List, Dict, Tuple, Deque, Callable, Any
+
+
+class BatchingStats:
+    """
+    Running statistics of the batching scheduler: batch occupancy, time spent in queue, processing time of the batches
+    and latency of the requests (queue and processing time).
+    Recent samples are kept in fixed-size windows to compute percentiles.
+    """
+    def __init__(self, max_batch_size: int, window_size: int = 1024):
+        self.max_batch_size: int = max_batch_size
+        self.n_batches: int = 0
+        self.n_requests: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._batch_sizes: Deque[int] = deque(maxlen=window_size)
+        self._queue_times: Deque[float] = deque(maxlen=window_size)
+        self._batch_times: Deque[float] = deque(maxlen=window_size)
+        self._latencies: Deque[float] = deque(maxlen=window_size)
+
+    def update(self, queue_times: List[float], batch_time: float):
+        with self._lock:
+            self.n_batches += 1
+            self.n_requests += len(queue_times)
+            self._batch_sizes.append(len(queue_times))
+            self._queue_times.extend(queue_times)
+            self._batch_times.append(batch_time)
+            self._latencies.extend(queue_time + batch_time for queue_time in queue_times)
+
+    @staticmethod
+    def _percentiles(samples: List[float]) -> Dict[str, float]:
+        if len(samples) == 0:
+            return dict()
+        samples = sorted(samples)
+        return {f'p{p}': samples[min(len(samples) - 1, (len(samples) * p) // 100)] for p in (50, 95, 99)}
+
+    def summary(self) -> Dict:
+        with self._lock:
+            batch_sizes = list(self._batch_sizes)
+            queue_times = list(self._queue_times)
+            batch_times = list(self._batch_times)
+            latencies = list(self._latencies)
+            n_batches, n_requests = self.n_batches, self.n_requests
+        return {
+            'batches': n_batches,
+            'requests': n_requests,
+            'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else 0.0,
+            'mean_occupancy': (
+                sum(batch_sizes) / (len(batch_sizes) * self.max_batch_size) if len(batch_sizes) > 0 else 0.0
+            ),
+            'queue_time': self._percentiles(queue_times),
+            'batch_time': self._percentiles(batch_times),
+            'latency': self._percentiles(latencies)
+        }
+
+
+class RequestBatcher:
+    """
+    Scheduler collecting the requests coming from different chats (and threads) and processing them together.
+    A batch is closed when it reaches the maximum size or when the waiting window of its first request expires.
+    """
+    def __init__(
+            self,
+            process_batch: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 8,
+            max_wait_ms: float = 20.0,
+            name: str = 'request'
+    ):
+        self.process_batch: Callable[[List[Any]], List[Any]] = process_batch
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait_ms / 1000.0
+        self.name: str = name
+        self.stats: BatchingStats = BatchingStats(self.max_batch_size)
+        # Request queue and scheduling thread
+        self._queue: Queue = Queue()
+        self._thread: threading.Thread = threading.Thread(target=self._loop, name=f'{name}-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, request: Any) -> Future:
+        future = Future()
+        self._queue.put((request, future, time.perf_counter()))
+
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect_batch(self) -> List[Tuple[Any, Future, float]]:
+        # Wait for the first request, then for the others until the window expires or the batch is full
+        item = self._queue.get()
+        if item is None:
+            return list()
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # Serve the current batch before stopping
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect_batch()
+            if len(batch) == 0:
+                break
+            # Skip requests whose callers are not waiting anymore
+            batch = [(request, future, t) for request, future, t in batch if future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            start_time = time.perf_counter()
+            try:
+                results = self.process_batch([request for request, _, _ in batch])
+            except Exception as e:
+                logging.error(f"Batched {self.name} processing failed: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+            self.stats.update([start_time - t for _, _, t in batch], end_time - start_time)
+            logging.debug(f"Processed {self.name} batch of {len(batch)} requests in {end_time - start_time:.3f} s")
+
+
+class GenerationBatcher(RequestBatcher):
+    """
+    Batching scheduler of the text generation requests, requests are decoded together.
+    """
+    def __init__(
+            self,
+            generate_batch: Callable[[List[GenerationRequest]], List[str]],
+            max_batch_size: int = 8,
+            max_wait_ms: float = 20.0
+    ):
+        super(GenerationBatcher, self).__init__(
+            generate_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name='generation'
+        )
+
+    def generate(self, request: GenerationRequest) -> str:
+        return self.submit(request).result()
@@ -1,3 +1,12 @@
+import io
+import copy
+import json
+import hashlib
+import logging
+from queue import Queue
+
+import numpy as np
+import soundfile as sf
 import torch
 from transformers import GPT2Model, GPT2LMHeadModel, GPT2Tokenizer
 from dialoguegst.model import DGST
@@ -6,11 +15,69 @@ from dialoguegst.speech_api import ChatSpeechGenerator
 import whisper
 from mellotron_api import load_tts, load_vocoder, load_arpabet_dict
 
+from .generation import GenerationRequest, ResponseGenerator, check_generate_kwargs
+from .speculative import SpeculationStats, SpeculativeGenerator
+from .batching import RequestBatcher, GenerationBatcher
+from .kv_cache import ConversationCache
+from .context import ContextWindow
+from .registry import ModelRegistry
+from .precision import DRIFT_PROMPTS, set_precision, output_drift
+from .tracing import tracer
+from .audio import WHISPER_SAMPLING_RATE, read_audio, decode_audio, encode_voice
+from .transcription import TranscriptionRequest, BatchTranscriber, trim_silence
+from .speech_cache import SpeechCache, quantise_style
+from .speech import (
+    BATCH_GST_PREDICTION_APPROACHES,
+    BATCH_ENCODING_MODES,
+    SpeechRequest,
+    SynthesisStats,
+    BatchSpeechSynthesiser,
+    text_to_sequence
+)
+from .utils import split_sentences, complete_sentences
+
+
+from typing import List, Dict, Optional, Hashable, Iterator, Tuple, Callable, Any, Union
+
 
-from typing import List, Dict, Optional
+def _registered_model(name: str, idx: Optional[int] = None) -> property:
+    # Access a model of the registry (loading it if needed), None if the model is not in the configuration
+    def getter(self: 'Chatbot'):
+        if name not in self.models:
+            return None
+        model = self.models.get(name)
+        return model[idx] if idx is not None else model
+
+    return property(getter)
 
 
 class Chatbot:
+    # Neural network models and modules (loaded on first use)
+    # ASR
+    whisper = _registered_model('whisper')
+    # TTS
+    mellotron = _registered_model('mellotron', 0)
+    mellotron_stft = _registered_model('mellotron', 1)
+    mellotron_hparams = _registered_model('mellotron', 2)
+    tacotron2 = _registered_model('tacotron2', 0)
+    tacotron2_stft = _registered_model('tacotron2', 1)
+    tacotron2_hparams = _registered_model('tacotron2', 2)
+    arpabet_dict = _registered_model('arpabet_dict')
+    # Vocoder
+    waveglow = _registered_model('waveglow', 0)
+    denoiser = _registered_model('waveglow', 1)
+    # Dialogue GST
+    therapy_dldlm = _registered_model('therapy_dldlm')
+    dgst = _registered_model('dgst')
+    # LM
+    ppm_dlm = _registered_model('ppm_dlm')
+    ppm_dlm_draft = _registered_model('ppm_dlm_draft')
+    # APIs
+    chatbot = _registered_model('chatbot')
+    response_generator = _registered_model('response_generator')
+    expressive_speech_generator = _registered_model('expressive_speech_generator')
+    speech_synthesiser = _registered_model('speech_synthesiser')
+
     def __init__(
             self,
             chatbot_id: str = 'AI',
@@ -19,85 +86,223 @@ class Chatbot:
             tts: Optional[Dict] = None,
             vocoder: Optional[Dict] = None,
             dgst: Optional[Dict] = None,
-            dlm: Optional[Dict] = None
+            dlm: Optional[Dict] = None,
+            models: Optional[Dict] = None,
+            precision: Optional[Dict] = None,
+            speech_cache: Optional[Dict] = None,
+            mixed_precision: bool = False
     ):
-        # Load neural network models and modules
+        # Numerical precision of the models (applied at load time)
+        precision = precision if precision is not None else dict()
+        self.mixed_precision: bool = mixed_precision
+        self.model_precisions: Dict[str, str] = precision.get('models', dict())
+        self.check_drift: bool = precision.get('check_drift', False)
+        self.drift_prompts: List[str] = precision.get('drift_prompts', DRIFT_PROMPTS)
+        self.precision_report: Dict[str, Dict] = dict()
+        # Register neural network models and modules, they are loaded on first use (or on warm-up)
+        # NOTE text models are registered first, so that they are the first to be warmed up
+        self.models: ModelRegistry = ModelRegistry(**(models if models is not None else dict()))
+        # LM
+        if dlm is not None and 'ppm_dlm' in dlm:
+            self.ppm_dlm_tokenizer: Optional[GPT2Tokenizer] = GPT2Tokenizer.from_pretrained(dlm['ppm_dlm']['tokenizer'])
+            self.models.register(
+                'ppm_dlm',
+                lambda: self._set_precision('ppm_dlm', GPT2LMHeadModel.from_pretrained(dlm['ppm_dlm']['model']).eval())
+            )
+        else:
+            self.ppm_dlm_tokenizer = None
+        # Dialogue GST
+        if dgst is not None and 'dldlm' in dgst:
+            self.therapy_dldlm_tokenizer: Optional[GPT2Tokenizer] = GPT2Tokenizer.from_pretrained(
+                dgst['dldlm']['tokenizer']
+            )
+            self.models.register(
+                'therapy_dldlm',
+                lambda: self._set_precision('therapy_dldlm', GPT2Model.from_pretrained(dgst['dldlm']['model']).eval())
+            )
+        else:
+            self.therapy_dldlm_tokenizer = None
         # ASR
         if asr is not None and 'whisper' in asr:
-            self.whisper = whisper.load_model(asr['whisper'])
+            self.models.register('whisper', lambda: self._set_precision('whisper', whisper.load_model(asr['whisper'])))
+        # Leading and trailing silence of the voice messages is trimmed before transcription
+        self.vad_params: Optional[Dict] = asr.get('vad') if asr is not None else None
+        if 'whisper' in self.models and asr.get('batching') is not None:
+            # Voice messages coming from different chats are transcribed together
+            self.models.register(
+                'transcriber',
+                lambda: BatchTranscriber(
+                    self.whisper,
+                    fp16=self.mixed_precision and self.whisper.device.type == 'cuda',
+                    **asr.get('transcription_params', dict())
+                ),
+                dependencies=['whisper']
+            )
+            self.transcription_batcher: Optional[RequestBatcher] = RequestBatcher(
+                self._transcribe_batch, name='transcription', **asr['batching']
+            )
         else:
-            self.whisper = None
+            self.transcription_batcher = None
         # TTS
         if tts is not None:
             if 'mellotron' in tts:
-                self.mellotron, self.mellotron_stft, self.mellotron_hparams = load_tts(tts['mellotron'])
-            else:
-                self.mellotron = self.mellotron_stft = self.mellotron_hparams = None
+                self.models.register('mellotron', lambda: self._trace_tts(load_tts(tts['mellotron'])))
             if 'tacotron2' in tts:
-                self.tacotron2, self.tacotron2_stft, self.tacotron2_hparams = load_tts(tts['tacotron2'], model='tacotron2')
-            else:
-                self.tacotron2 = self.tacotron2_stft = self.tacotron2_hparams = None
+                self.models.register(
+                    'tacotron2', lambda: self._trace_tts(load_tts(tts['tacotron2'], model='tacotron2'))
+                )
             if 'arpabet_dict' in tts:
-                self.arpabet_dict = load_arpabet_dict(tts['arpabet_dict'])
-            else:
-                self.arpabet_dict = None
-        else:
-            self.mellotron = self.mellotron_stft = self.mellotron_hparams = None
-            self.tacotron2 = self.tacotron2_stft = self.tacotron2_hparams = None
-            self.arpabet_dict = None
+                self.models.register('arpabet_dict', lambda: load_arpabet_dict(tts['arpabet_dict']))
         # Vocoder
         if vocoder is not None and 'waveglow' in vocoder:
-            self.waveglow, self.denoiser = load_vocoder(vocoder['waveglow'])
-        else:
-            self.waveglow = self.denoiser = None
+            self.models.register('waveglow', lambda: self._trace_vocoder(load_vocoder(vocoder['waveglow'])))
         # Dialogue GST
-        if dgst is not None:
-            if 'dldlm' in dgst:
-                self.therapy_dldlm_tokenizer: GPT2Tokenizer = GPT2Tokenizer.from_pretrained(dgst['dldlm']['tokenizer'])
-                self.therapy_dldlm: GPT2Model = GPT2Model.from_pretrained(dgst['dldlm']['model']).eval()
+        if (
+                dgst is not None and 'gst_predictor' in dgst and
+                'therapy_dldlm' in self.models and 'mellotron' in self.models
+        ):
+            self.models.register(
+                'dgst',
+                lambda: self._load_dgst(dgst['gst_predictor']['model']),
+                dependencies=['therapy_dldlm', 'mellotron']
+            )
+        # Load wrapper for text Chatbot and TTS modules
+        # APIs
+        if 'ppm_dlm' in self.models:
+            self.models.register(
+                'chatbot',
+                lambda: PPMDLMChatbot(self.ppm_dlm, self.ppm_dlm_tokenizer, **dlm.get('module_params', dict())),
+                dependencies=['ppm_dlm']
+            )
+        if 'ppm_dlm' in self.models and dlm.get('batching') is not None:
+            # Requests coming from different chats are decoded together
+            if dlm.get('kv_cache') is not None:
+                # States of each conversation are kept between turns
+                self.conversation_cache: Optional[ConversationCache] = ConversationCache(**dlm['kv_cache'])
             else:
-                self.therapy_dldlm_tokenizer = self.therapy_dldlm = None
-            if 'gst_predictor' in dgst and self.therapy_dldlm is not None and self.mellotron is not None:
-                self.dgst = DGST(
-                    self.therapy_dldlm.config,
-                    self.mellotron.gst.stl.attention.num_units,
-                    (self.mellotron.gst.stl.attention.num_heads, self.mellotron.gst.stl.embed.size(0))
+                self.conversation_cache = None
+            if dlm.get('speculative') is not None:
+                # A small draft model proposes the tokens, the PPM-DLM verifies them
+                self.speculative_params: Dict = {k: v for k, v in dlm['speculative'].items() if k != 'draft_model'}
+                self.speculation: Optional[SpeculationStats] = SpeculationStats()
+                self.models.register(
+                    'ppm_dlm_draft',
+                    lambda: self._set_precision(
+                        'ppm_dlm_draft', GPT2LMHeadModel.from_pretrained(dlm['speculative']['draft_model']).eval()
+                    )
                 )
-                try:
-                    self.dgst.load_state_dict(torch.load(dgst['gst_predictor']['model']))
-                except RuntimeError:
-                    self.dgst.load_state_dict(torch.load(dgst['gst_predictor']['model'], map_location=torch.device('cpu')))
             else:
-                self.dgst = None
+                self.speculative_params = dict()
+                self.speculation = None
+            self.models.register(
+                'response_generator',
+                self._load_response_generator,
+                dependencies=['ppm_dlm', 'ppm_dlm_draft'] if 'ppm_dlm_draft' in self.models else ['ppm_dlm']
+            )
+            self.generation_batcher: Optional[GenerationBatcher] = GenerationBatcher(
+                self._generate_batch, **dlm['batching']
+            )
         else:
-            self.dgst = self.therapy_dldlm_tokenizer = self.therapy_dldlm = None
-        # LM
-        if dlm is not None and 'ppm_dlm' in dlm:
-            self.ppm_dlm_tokenizer: GPT2Tokenizer = GPT2Tokenizer.from_pretrained(dlm['ppm_dlm']['tokenizer'])
-            self.ppm_dlm: GPT2LMHeadModel = GPT2LMHeadModel.from_pretrained(dlm['ppm_dlm']['model'])
+            if dlm is not None and dlm.get('speculative') is not None:
+                logging.warning("Speculative decoding requires the batched decoding loop (dlm.batching), ignoring it")
+            self.conversation_cache = self.generation_batcher = self.speculation = None
+        if 'dgst' in self.models or 'tacotron2' in self.models:
+            self.models.register(
+                'expressive_speech_generator',
+                lambda: ChatSpeechGenerator(
+                    self.dgst,
+                    self.therapy_dldlm_tokenizer,
+                    self.therapy_dldlm,
+                    mellotron=(self.mellotron, self.mellotron_stft, self.mellotron_hparams),
+                    tacotron2=(self.tacotron2, self.tacotron2_stft, self.tacotron2_hparams),
+                    vocoder=(self.waveglow, self.denoiser),
+                    arpabet_dict=self.arpabet_dict,
+                    **dgst.get('module_params', dict())
+                ),
+                dependencies=[
+                    name for name in ('dgst', 'therapy_dldlm', 'mellotron', 'tacotron2', 'waveglow', 'arpabet_dict')
+                    if name in self.models
+                ]
+            )
+        if dgst is not None and dgst.get('batching') is not None:
+            # Requirements of the batched synthesis that are not met (if any)
+            missing_requirements: Optional[List[str]] = [
+                requirement for requirement, met in (
+                    ("the Mellotron and the Dialogue GST", 'dgst' in self.models),
+                    ("the WaveGlow", 'waveglow' in self.models),
+                    ("the text front-end of the Mellotron API (text_to_sequence)", text_to_sequence is not None),
+                    (
+                        f"one of the GST prediction approaches {BATCH_GST_PREDICTION_APPROACHES}",
+                        dgst.get('generator_params', dict()).get('gst_prediction_approach')
+                        in BATCH_GST_PREDICTION_APPROACHES
+                    ),
+                    (
+                        f"one of the encoding modes {BATCH_ENCODING_MODES}",
+                        dgst.get('module_params', dict()).get('encoding_mode') in BATCH_ENCODING_MODES
+                    )
+                ) if not met
+            ]
         else:
-            self.ppm_dlm_tokenizer = self.ppm_dlm = None
-        # Load wrapper for text Chatbot and TTS modules
-        # APIs
-        if self.ppm_dlm_tokenizer is not None and self.ppm_dlm is not None:
-            self.chatbot: PPMDLMChatbot = PPMDLMChatbot(
-                self.ppm_dlm, self.ppm_dlm_tokenizer, **dlm.get('module_params', dict())
+            missing_requirements = None
+        if missing_requirements is not None and len(missing_requirements) == 0:
+            # Sentences coming from different chats are synthesised together
+            self.synthesis: Optional[SynthesisStats] = SynthesisStats()
+            self.models.register(
+                'speech_synthesiser',
+                lambda: BatchSpeechSynthesiser(
+                    self.therapy_dldlm,
+                    self.therapy_dldlm_tokenizer,
+                    self.dgst,
+                    (self.mellotron, self.mellotron_stft, self.mellotron_hparams),
+                    (self.waveglow, self.denoiser),
+                    arpabet_dict=self.arpabet_dict,
+                    gst_prediction=self.gst_prediction_approach,
+                    speaker_id=self.tts_speaker_id,
+                    stats=self.synthesis,
+                    **{
+                        key: value for key, value in dgst.get('module_params', dict()).items()
+                        if key in ('prefix_token', 'suffix_token', 'encoding_mode', 'max_context_len')
+                    },
+                    **dgst.get('synthesis_params', dict())
+                ),
+                dependencies=[
+                    name for name in ('dgst', 'therapy_dldlm', 'mellotron', 'waveglow', 'arpabet_dict')
+                    if name in self.models
+                ]
+            )
+            self.synthesis_batcher: Optional[RequestBatcher] = RequestBatcher(
+                self._synthesise_batch, name='synthesis', **dgst['batching']
+            )
+        else:
+            if missing_requirements is not None:
+                logging.warning(
+                    f"Batched speech synthesis requires {', '.join(missing_requirements)}, "
+                    "responses are synthesised one at a time"
+                )
+            self.synthesis = self.synthesis_batcher = None
+        # Context windows (token ids of the utterances are computed once and cached in the dialogue)
+        if self.ppm_dlm_tokenizer is not None:
+            self.ppm_dlm_context_window: Optional[ContextWindow] = ContextWindow(
+                'ppm_dlm',
+                lambda text: self.ppm_dlm_tokenizer(text).input_ids,
+                format_utterance=lambda utterance: f"{utterance['speaker']}: {utterance['text']}\n",
+                decode=lambda token_ids: self.ppm_dlm_tokenizer.decode(token_ids),
+                **dlm.get('context_window', dict())
             )
         else:
-            self.chatbot = None
-        if (self.dgst is not None and self.therapy_dldlm_tokenizer is not None and self.therapy_dldlm and self.mellotron is not None) or self.tacotron2 is not None:
-            self.expressive_speech_generator: ChatSpeechGenerator = ChatSpeechGenerator(
-                self.dgst,
-                self.therapy_dldlm_tokenizer,
-                self.therapy_dldlm,
-                mellotron=(self.mellotron, self.mellotron_stft, self.mellotron_hparams),
-                tacotron2=(self.tacotron2, self.tacotron2_stft, self.tacotron2_hparams),
-                vocoder=(self.waveglow, self.denoiser),
-                arpabet_dict=self.arpabet_dict,
-                **dgst.get('module_params', dict())
+            self.ppm_dlm_context_window = None
+        if self.therapy_dldlm_tokenizer is not None:
+            self.therapy_dldlm_context_window: Optional[ContextWindow] = ContextWindow(
+                'therapy_dldlm',
+                lambda text: self.therapy_dldlm_tokenizer(text).input_ids,
+                decode=lambda token_ids: self.therapy_dldlm_tokenizer.decode(token_ids),
+                **{
+                    'max_tokens': dgst.get('module_params', dict()).get('max_context_len'),
+                    **dgst.get('context_window', dict())
+                }
             )
         else:
-            self.expressive_speech_generator = None
+            self.therapy_dldlm_context_window = None
 
         # Additional parameters for text and speech generation
         self.chatbot_id = chatbot_id
@@ -109,56 +314,500 @@ class Chatbot:
         else:
             self.task = self.global_label = None
             self.generate_kwargs = dict()
+        if self.generation_batcher is not None:
+            # Fail at start-up rather than at the first message
+            check_generate_kwargs(self.generate_kwargs)
         self.prompt = f'{self.chatbot_id}:' if len(self.chatbot_id) > 0 else ''
         if dgst is not None and 'generator_params' in dgst:
             self.gst_prediction_approach = dgst['generator_params'].get('gst_prediction_approach')
             self.tts_speaker_id = dgst['generator_params'].get('tts_speaker_id')
+        else:
+            self.gst_prediction_approach = self.tts_speaker_id = None
+        # Cache of the synthesised responses
+        # NOTE the model version is derived from the configuration of the speech models, changing any of them
+        # (or the configured version) invalidates the previous entries
+        if speech_cache is not None and 'expressive_speech_generator' in self.models:
+            speech_cache = dict(speech_cache)
+            self.gst_levels: int = speech_cache.pop('gst_levels', 20)
+            model_version = hashlib.sha1(json.dumps(
+                [tts, vocoder, dgst, self.model_precisions, speech_cache.pop('model_version', None)],
+                sort_keys=True,
+                default=str
+            ).encode()).hexdigest()
+            self.speech_cache: Optional[SpeechCache] = SpeechCache(model_version=model_version, **speech_cache)
+        else:
+            self.speech_cache = None
+
+    def _drift_check_inputs(self, name: str) -> Tuple[Callable[[torch.nn.Module, Any], torch.Tensor], List, bool]:
+        # Forward function, fixed inputs and whether to compare the top-1 predictions for the drift check of each model
+        if name in ('ppm_dlm', 'ppm_dlm_draft'):
+            inputs = [torch.tensor([self.ppm_dlm_tokenizer(prompt).input_ids]) for prompt in self.drift_prompts]
+            return lambda model, x: model(input_ids=x.to(model.device)).logits, inputs, True
+        elif name == 'therapy_dldlm':
+            inputs = [torch.tensor([self.therapy_dldlm_tokenizer(prompt).input_ids]) for prompt in self.drift_prompts]
+            return lambda model, x: model(input_ids=x.to(model.device)).last_hidden_state, inputs, False
+        elif name == 'whisper':
+            # Fixed pseudo-random 30 s log-Mel spectrogram
+            generator = torch.Generator().manual_seed(0)
+            inputs = [torch.randn(1, whisper.audio.N_MELS, whisper.audio.N_FRAMES, generator=generator)]
+            return lambda model, x: model.encoder(x.to(model.device)), inputs, False
+        else:
+            raise ValueError(f"Drift check is not available for model '{name}'")
+
+    def _set_precision(self, name: str, model: torch.nn.Module) -> torch.nn.Module:
+        # Use configured precision, if not specified use half precision on GPU when mixed precision is enabled
+        device = next(model.parameters()).device
+        precision = self.model_precisions.get(
+            name, 'fp16' if self.mixed_precision and device.type == 'cuda' else 'fp32'
+        )
+        if precision == 'fp32':
+            return model
+        reference_model = copy.deepcopy(model) if self.check_drift else None
+        model = set_precision(model, precision)
+        if reference_model is not None:
+            drift = output_drift(reference_model, model, *self._drift_check_inputs(name))
+            self.precision_report[name] = {'precision': precision, **drift}
+            logging.info(f"Model '{name}' converted to {precision}, output drift w.r.t. fp32: {drift}")
+            del reference_model
+        else:
+            logging.info(f"Model '{name}' converted to {precision}")
+
+        return model
+
+    def _load_dgst(self, model_path: str) -> DGST:
+        dgst = DGST(
+            self.therapy_dldlm.config,
+            self.mellotron.gst.stl.attention.num_units,
+            (self.mellotron.gst.stl.attention.num_heads, self.mellotron.gst.stl.embed.size(0))
+        )
+        try:
+            dgst.load_state_dict(torch.load(model_path))
+        except RuntimeError:
+            dgst.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        # Time the style prediction of each response
+        tracer.instrument(dgst, 'gst_prediction', 'forward')
+
+        return dgst
+
+    @staticmethod
+    def _trace_tts(tts: Tuple) -> Tuple:
+        # Time the spectrogram generation of the acoustic model (the model is the first element of the tuple)
+        tracer.instrument(tts[0], 'tts', 'inference', 'inference_noattention')
+
+        return tts
+
+    @staticmethod
+    def _trace_vocoder(vocoder: Tuple) -> Tuple:
+        # Time the waveform generation of the vocoder (the model is the first element of the tuple)
+        tracer.instrument(vocoder[0], 'vocoding', 'infer')
+
+        return vocoder
+
+    def _load_response_generator(self) -> ResponseGenerator:
+        if 'ppm_dlm_draft' in self.models:
+            response_generator = SpeculativeGenerator(
+                self.ppm_dlm,
+                self.ppm_dlm_tokenizer,
+                self.ppm_dlm_draft,
+                conversation_cache=self.conversation_cache,
+                stats=self.speculation,
+                **self.speculative_params
+            )
+        else:
+            response_generator = ResponseGenerator(
+                self.ppm_dlm, self.ppm_dlm_tokenizer, conversation_cache=self.conversation_cache
+            )
+        # Pre-compute the states of the static prompt prefix
+        response_generator.set_prefix(self._build_prefix())
+
+        return response_generator
 
     def __call__(self, *args, **kwargs):
         return self.generate_response(*args, **kwargs)
 
+    def _build_prefix(self) -> str:
+        # Static part of the prompt, shared by all conversations
+        prefix = ''
+        if self.task is not None:
+            prefix += f'{self.task}\n\n'
+        if self.global_label is not None:
+            prefix += f'{self.global_label}\n\n'
+
+        return prefix
+
+    def _ppm_dlm_context_budget(self, n_prompt_tokens: int, max_new_tokens: int) -> int:
+        # Leave room in the model window for the static prefix, the response prompt and the response
+        # NOTE the dialogue gets at least half of the window left by the prompt, the response is shortened accordingly
+        # (see _ppm_dlm_generate_kwargs)
+        n_available = self.ppm_dlm.config.n_positions - n_prompt_tokens
+        if n_available <= 1:
+            raise ValueError(
+                f"The prompt ({n_prompt_tokens} tokens) does not fit the window of the PPM-DLM "
+                f"({self.ppm_dlm.config.n_positions} positions)"
+            )
+
+        return max(n_available - max_new_tokens, n_available // 2)
+
+    def _ppm_dlm_generate_kwargs(self, generate_kwargs: Dict, n_input_tokens: int) -> Dict:
+        # Shorten the response so that the prompt and the response fit the model window together
+        max_new_tokens = generate_kwargs.get('max_new_tokens', GenerationRequest.max_new_tokens)
+
+        return {
+            **generate_kwargs, 'max_new_tokens': min(max_new_tokens, self.ppm_dlm.config.n_positions - n_input_tokens)
+        }
+
+    def _build_prompt_ids(self, context: List[Dict[str, str]], max_new_tokens: int) -> List[int]:
+        # Same layout used by the PPM-DLM chatbot: task description, global labels, dialogue and response prompt
+        # NOTE each segment is encoded separately so that token ids of past turns do not change as the dialogue grows
+        # NOTE the prefix states are recomputed if the task description or the global labels have been changed
+        prefix_ids = self.response_generator.set_prefix(self._build_prefix())
+        prompt_ids = self.response_generator.encode(self.prompt)
+        context = self.ppm_dlm_context_window.fit(
+            context, max_tokens=self._ppm_dlm_context_budget(len(prefix_ids) + len(prompt_ids), max_new_tokens)
+        )
+        input_ids = prefix_ids
+        for utterance in context:
+            input_ids += self.ppm_dlm_context_window.token_ids(utterance)
+        input_ids += prompt_ids
+
+        return input_ids
+
     def generate_response(
             self,
-            context: List[Dict[str, str]]
+            context: List[Dict[str, str]],
+            generate_kwargs: Optional[Dict] = None,
+            cache_key: Optional[Hashable] = None
     ) -> str:
-        if self.chatbot is not None:
-            context = [f"{utterance['speaker']}: {utterance['text']}\n" for utterance in context]
-            response = self.chatbot.generate(
-                context,
-                prompt=self.prompt,
-                task_description=self.task,
-                global_labels=self.global_label,
-                **self.generate_kwargs
-            )
+        generate_kwargs = {**self.generate_kwargs, **(generate_kwargs if generate_kwargs is not None else dict())}
+        if self.generation_batcher is not None:
+            with tracer.span('generation') as span, self.models.use('response_generator'):
+                input_ids = self._build_prompt_ids(
+                    context, generate_kwargs.get('max_new_tokens', GenerationRequest.max_new_tokens)
+                )
+                span['prompt_tokens'] = len(input_ids)
+                generate_kwargs = self._ppm_dlm_generate_kwargs(generate_kwargs, len(input_ids))
+                response = self.generation_batcher.generate(
+                    GenerationRequest.from_generate_kwargs(input_ids, cache_key=cache_key, **generate_kwargs)
+                )
+                if tracer.enabled:
+                    span['generated_tokens'] = len(self.ppm_dlm_tokenizer(response).input_ids)
+        elif 'chatbot' in self.models:
+            with tracer.span('generation') as span:
+                n_prompt_tokens = len(self.ppm_dlm_tokenizer(self._build_prefix() + self.prompt).input_ids)
+                context = self.ppm_dlm_context_window.fit(
+                    context,
+                    max_tokens=self._ppm_dlm_context_budget(n_prompt_tokens, generate_kwargs.get('max_new_tokens', 0))
+                )
+                span['prompt_tokens'] = n_prompt_tokens + self.ppm_dlm_context_window.n_tokens(context)
+                if 'max_new_tokens' in generate_kwargs:
+                    generate_kwargs = self._ppm_dlm_generate_kwargs(generate_kwargs, span['prompt_tokens'])
+                context = [self.ppm_dlm_context_window.text(utterance) for utterance in context]
+                with self.models.use('chatbot') as chatbot:
+                    response = chatbot.generate(
+                        context,
+                        prompt=self.prompt,
+                        task_description=self.task,
+                        global_labels=self.global_label,
+                        **generate_kwargs
+                    )
+                if tracer.enabled:
+                    span['generated_tokens'] = len(self.ppm_dlm_tokenizer(response).input_ids)
         else:
             raise ValueError("Text module is not enabled in the current configuration.")
 
         return response
 
-    def transcribe_message(self, audio_file_path: str) -> str:
-        if self.whisper is not None:
-            # Use OpenAI Whisper to generate the transcription
-            result = self.whisper.transcribe(audio_file_path)
-            transcription = result['text']
+    def generate_response_stream(
+            self,
+            context: List[Dict[str, str]],
+            generate_kwargs: Optional[Dict] = None,
+            cache_key: Optional[Hashable] = None,
+            granularity: str = 'sentence'
+    ) -> Iterator[str]:
+        # Yield the response while it is decoded, each time a new token (or sentence) is complete, the last item yielded
+        # is always the whole response
+        # NOTE only the batched decoding loop can stream, otherwise the whole response is yielded at once
+        if self.generation_batcher is None:
+            yield self.generate_response(context, generate_kwargs=generate_kwargs, cache_key=cache_key)
+            return
+        generate_kwargs = {**self.generate_kwargs, **(generate_kwargs if generate_kwargs is not None else dict())}
+        with tracer.span('generation') as span, self.models.use('response_generator') as response_generator:
+            input_ids = self._build_prompt_ids(
+                context, generate_kwargs.get('max_new_tokens', GenerationRequest.max_new_tokens)
+            )
+            span['prompt_tokens'] = len(input_ids)
+            generate_kwargs = self._ppm_dlm_generate_kwargs(generate_kwargs, len(input_ids))
+            # The decoding loop (running on the thread of the batcher) passes the tokens generated so far
+            updates = Queue()
+            request = GenerationRequest.from_generate_kwargs(input_ids, cache_key=cache_key, **generate_kwargs)
+            request.on_tokens = updates.put
+            future = self.generation_batcher.submit(request)
+            future.add_done_callback(lambda _: updates.put(None))
+            partial_response = ''
+            for output_ids in iter(updates.get, None):
+                text = response_generator.decode(output_ids)
+                if granularity == 'sentence':
+                    text = complete_sentences(text)
+                if len(text) > len(partial_response):
+                    partial_response = text
+                    yield partial_response
+            response = future.result()
+            if tracer.enabled:
+                span['generated_tokens'] = len(self.ppm_dlm_tokenizer(response).input_ids)
+        yield response
+
+    def _generate_batch(self, requests: List[GenerationRequest]) -> List[str]:
+        with self.models.use('response_generator') as response_generator:
+            return response_generator.generate_batch(requests)
+
+    def invalidate_cache(self, cache_key: Hashable):
+        if self.conversation_cache is not None:
+            self.conversation_cache.invalidate(cache_key)
+
+    def generation_stats(self) -> Optional[Dict]:
+        return self.generation_batcher.stats.summary() if self.generation_batcher is not None else None
+
+    def speculation_stats(self) -> Optional[Dict]:
+        return self.speculation.summary() if self.speculation is not None else None
+
+    def _transcribe_batch(self, requests: List[TranscriptionRequest]) -> List[str]:
+        with self.models.use('transcriber') as transcriber:
+            return transcriber.transcribe_batch(requests)
+
+    def transcription_stats(self) -> Optional[Dict]:
+        return self.transcription_batcher.stats.summary() if self.transcription_batcher is not None else None
+
+    def _transcribe(self, audio: Union[str, np.ndarray]) -> str:
+        if 'whisper' in self.models:
+            with tracer.span('transcription'):
+                if self.transcription_batcher is not None:
+                    # Queue the voice message with those of the other chats
+                    if isinstance(audio, str):
+                        audio = whisper.load_audio(audio)
+                    request = TranscriptionRequest(audio)
+                    with self.models.use('transcriber') as transcriber:
+                        if transcriber.is_long(request):
+                            # Long audio is transcribed on the thread of the caller, not to hold up the batch
+                            transcription = transcriber.transcribe_long(request)
+                        else:
+                            transcription = self.transcription_batcher.submit(request).result()
+                else:
+                    # Use OpenAI Whisper to generate the transcription
+                    with self.models.use('whisper') as whisper_model:
+                        result = whisper_model.transcribe(
+                            audio, fp16=self.mixed_precision and whisper_model.device.type == 'cuda'
+                        )
+                    transcription = result['text']
         else:
             raise ValueError("Speech recognition module is not enabled in the current configuration.")
 
         return transcription
 
+    def transcribe_message(self, audio_file_path: str) -> str:
+        return self._transcribe(audio_file_path)
+
+    def transcribe_array(self, audio: np.ndarray) -> str:
+        # Audio is expected to be mono and sampled at 16 kHz
+        audio = audio.astype(np.float32)
+        if self.vad_params is not None:
+            with tracer.span('vad') as span:
+                trimmed_audio = trim_silence(audio, **self.vad_params)
+                span['trimmed_seconds'] = (len(audio) - len(trimmed_audio)) / WHISPER_SAMPLING_RATE
+            audio = trimmed_audio
+        # Nothing to transcribe if the message is empty or silent
+        if len(audio) == 0:
+            return ''
+
+        return self._transcribe(audio)
+
+    def transcribe_buffer(self, buffer: Union[bytes, io.IOBase]) -> str:
+        # Decode the audio file (e.g., an OGG/Opus voice note) in memory
+        if 'whisper' not in self.models:
+            raise ValueError("Speech recognition module is not enabled in the current configuration.")
+        with tracer.span('decoding'):
+            audio = decode_audio(buffer)
+
+        return self.transcribe_array(audio)
+
+    def _dialogue(self, context: Optional[List[Dict[str, str]]] = None) -> Optional[List[str]]:
+        # Bound the dialogue history to the context length of the DLDLM
+        if context is None or len(context) == 0:
+            return None
+        if self.therapy_dldlm_context_window is not None:
+            context = self.therapy_dldlm_context_window.fit(context)
+            return [self.therapy_dldlm_context_window.text(turn) for turn in context]
+
+        return [turn['text'] for turn in context]
+
+    def _synthesise(
+            self,
+            output: Optional[Union[str, io.IOBase]],
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None,
+            gst_weights: Optional[torch.Tensor] = None
+    ) -> Optional[Tuple[np.ndarray, int]]:
+        # Write the (WAV) audio file of the response or, without output file, return the waveform and its sampling rate
+        dialogue = self._dialogue(context)
+        # NOTE responses without dialogue context (e.g., status messages) are always synthesised by the speech
+        # generator, as the batched synthesis conditions each response on the style predicted from its context
+        if self.synthesis_batcher is not None and dialogue is not None:
+            audio, sampling_rate = self._synthesise_batched(response, dialogue, gst_weights=gst_weights)
+            if output is None:
+                return audio, sampling_rate
+            sf.write(output, audio, sampling_rate, format='WAV')
+        elif 'expressive_speech_generator' in self.models:
+            # NOTE the speech generator writes the audio file to the given file object instead of a path
+            buffer = io.BytesIO() if output is None else None
+            # If Speech generator is available generate response
+            with tracer.span('synthesis', characters=len(response['text'])):
+                with self.models.use('expressive_speech_generator') as expressive_speech_generator:
+                    expressive_speech_generator.generate_speech_response(
+                        response['text'],
+                        buffer if buffer is not None else output,
+                        dialogue=dialogue,
+                        gst_prediction=self.gst_prediction_approach,
+                        speaker_id=self.tts_speaker_id
+                    )
+            if buffer is not None:
+                buffer.seek(0)
+                return read_audio(buffer)
+        else:
+            raise ValueError("Speech synthesis module is not enabled in the current configuration.")
+
+        return None
+
+    def _synthesise_batched(
+            self,
+            response: Dict[str, str],
+            dialogue: List[str],
+            gst_weights: Optional[torch.Tensor] = None
+    ) -> Tuple[np.ndarray, int]:
+        # Queue the response with those of the other chats
+        with tracer.span('synthesis', characters=len(response['text'])):
+            with self.models.use('speech_synthesiser'):
+                return self.synthesis_batcher.submit(SpeechRequest(response['text'], dialogue, gst_weights)).result()
+
+    def _synthesise_batch(self, requests: List[SpeechRequest]) -> List[Tuple[np.ndarray, int]]:
+        with self.models.use('speech_synthesiser') as speech_synthesiser:
+            return speech_synthesiser.synthesise_batch(requests)
+
+    def synthesis_stats(self) -> Optional[Dict]:
+        if self.synthesis_batcher is None:
+            return None
+
+        return {'batching': self.synthesis_batcher.stats.summary(), 'efficiency': self.synthesis.summary()}
+
+    @property
+    def streams_responses(self) -> bool:
+        # Only the batched decoding loop streams the responses while they are decoded
+        return self.generation_batcher is not None
+
+    def batch_sizes(self) -> Dict[str, int]:
+        # Maximum batch size of the stages whose requests are batched (the other stages are missing)
+        # NOTE the callers wait for the batch to be processed, as many concurrent callers are needed to fill it
+        batchers = {
+            'transcription': self.transcription_batcher,
+            'generation': self.generation_batcher,
+            'synthesis': self.synthesis_batcher
+        }
+
+        return {stage: batcher.max_batch_size for stage, batcher in batchers.items() if batcher is not None}
+
+    def _predict_style(self, dialogue: Optional[List[str]]) -> Optional[torch.Tensor]:
+        # GST weights of the response, predicted once from the dialogue context and shared by all its sentences
+        # NOTE the style is known in advance only with the batched synthesis, otherwise the speech generator predicts
+        # it while synthesising (None for responses without dialogue context as well)
+        if dialogue is None or self.synthesis_batcher is None:
+            return None
+        with tracer.span('gst_prediction'):
+            with self.models.use('speech_synthesiser') as speech_synthesiser:
+                gst_weights, _, _ = speech_synthesiser.predict_gst([tuple(dialogue)])
+
+        return gst_weights[0]
+
+    def _speech_cache_key(
+            self, response: Dict[str, str], dialogue: Optional[List[str]], gst_weights: Optional[torch.Tensor]
+    ) -> Optional[str]:
+        # Responses with dialogue context are identified by their (quantised) style, those whose style is not known
+        # are not cached (None), since they would hardly be requested again with the very same context
+        if dialogue is not None and gst_weights is None:
+            return None
+        style = quantise_style(gst_weights, n_levels=self.gst_levels) if dialogue is not None else None
+
+        return self.speech_cache.key(response['text'], speaker_id=self.tts_speaker_id, style=style)
+
+    def cached_response_speech(self, response: Dict[str, str]) -> Optional[bytes]:
+        # Look up the voice message of a response without dialogue context (e.g., status messages), never synthesise
+        if self.speech_cache is None:
+            return None
+
+        return self.speech_cache.get(self.speech_cache.key(response['text'], speaker_id=self.tts_speaker_id))
+
+    def prerender_responses(self, texts: List[str]):
+        # Synthesise the voice messages of fixed responses, so that they are served from the cache
+        for text in texts:
+            try:
+                self.read_response_buffer({'speaker': self.chatbot_id, 'text': text})
+            except Exception as e:
+                logging.error(f"Pre-rendering of response '{text}' failed: {e}")
+        logging.info(f"{len(texts)} responses pre-rendered")
+
+    def speech_cache_stats(self) -> Optional[Dict]:
+        return self.speech_cache.summary() if self.speech_cache is not None else None
+
     def read_response(
             self,
             audio_file_path: str,
             response: Dict[str, str],
             context: Optional[List[Dict[str, str]]] = None
     ):
-        if self.expressive_speech_generator is not None:
-            # If Speech generator is available generate response
-            self.expressive_speech_generator.generate_speech_response(
-                response['text'],
-                audio_file_path,
-                dialogue=[turn['text'] for turn in context] if context is not None and len(context) > 0 else None,
-                gst_prediction=self.gst_prediction_approach,
-                speaker_id=self.tts_speaker_id
-            )
-        else:
+        self._synthesise(audio_file_path, response, context=context)
+
+    def read_response_array(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None,
+            gst_weights: Optional[torch.Tensor] = None
+    ) -> Tuple[np.ndarray, int]:
+        # Synthesise the response in memory, returning the waveform and its sampling rate
+        return self._synthesise(None, response, context=context, gst_weights=gst_weights)
+
+    def read_response_buffer(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None,
+            gst_weights: Optional[torch.Tensor] = None
+    ) -> bytes:
+        # Synthesise the response as an OGG/Opus voice message in memory (unless it is already in the cache)
+        # NOTE the style of the response can be passed if already predicted (e.g., for the other sentences)
+        key = None
+        if self.speech_cache is not None:
+            if 'expressive_speech_generator' not in self.models:
+                raise ValueError("Speech synthesis module is not enabled in the current configuration.")
+            dialogue = self._dialogue(context)
+            if gst_weights is None:
+                gst_weights = self._predict_style(dialogue)
+            key = self._speech_cache_key(response, dialogue, gst_weights)
+            audio = self.speech_cache.get(key) if key is not None else None
+            if audio is not None:
+                return audio
+        audio, sampling_rate = self.read_response_array(response, context=context, gst_weights=gst_weights)
+        with tracer.span('encoding'):
+            audio = encode_voice(audio, sampling_rate)
+        if key is not None:
+            self.speech_cache.put(key, audio)
+
+        return audio
+
+    def read_response_stream(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None
+    ) -> Iterator[bytes]:
+        # Synthesise the response one sentence at a time, yielding the audio of each sentence as soon as it is ready
+        # NOTE all sentences are synthesised with the same style, predicted once for the whole response
+        if 'expressive_speech_generator' not in self.models:
             raise ValueError("Speech synthesis module is not enabled in the current configuration.")
+        gst_weights = self._predict_style(self._dialogue(context))
+        for sentence in split_sentences(response['text']):
+            yield self.read_response_buffer({**response, 'text': sentence}, context=context, gst_weights=gst_weights)
@@ -0,0 +1,84 @@
+from typing import List, Dict, Callable, Optional
+
+
+class ContextWindow:
+    """
+    Selects the most recent utterances of a dialogue fitting a token budget.
+    The token ids of each utterance are computed only once and stored in the utterance itself,
+    under a key specific to the model consuming the dialogue.
+    The start of the window is moved forward by multiples of `trim_step` utterances,
+    this way it stays the same for several turns (and the states cached for the dialogue remain valid).
+    The last utterance is always kept, if it does not fit the budget alone only its most recent tokens are kept.
+    """
+    def __init__(
+            self,
+            key: str,
+            encode: Callable[[str], List[int]],
+            format_utterance: Callable[[Dict], str] = lambda utterance: utterance['text'],
+            decode: Optional[Callable[[List[int]], str]] = None,
+            max_tokens: Optional[int] = None,
+            trim_step: int = 1
+    ):
+        self.key: str = key
+        self.encode: Callable[[str], List[int]] = encode
+        self.format_utterance: Callable[[Dict], str] = format_utterance
+        self.decode: Optional[Callable[[List[int]], str]] = decode
+        self.max_tokens: Optional[int] = max_tokens
+        self.trim_step: int = max(1, trim_step)
+
+    def token_ids(self, utterance: Dict) -> List[int]:
+        # Encode the utterance unless the token ids of the current text are already available
+        text = self.format_utterance(utterance)
+        cached_text, token_ids = utterance.setdefault('token_ids', dict()).get(self.key, (None, None))
+        if cached_text != text:
+            token_ids = self.encode(text)
+            utterance['token_ids'][self.key] = (text, token_ids)
+
+        return token_ids
+
+    def text(self, utterance: Dict) -> str:
+        # Formatted utterance as seen by the model (only the kept tokens if the utterance was truncated)
+        if utterance.get('truncated') == self.key:
+            if self.decode is None:
+                raise ValueError("Truncated utterances can be converted back to text only if a decoder is given")
+            return self.decode(self.token_ids(utterance))
+
+        return self.format_utterance(utterance)
+
+    def truncate(self, utterance: Dict, max_tokens: int) -> Dict:
+        # Copy of the utterance keeping only its most recent tokens (the utterance in the dialogue is left unchanged)
+        token_ids = self.token_ids(utterance)
+        if len(token_ids) <= max_tokens:
+            return utterance
+
+        return {
+            **utterance,
+            'token_ids': {
+                **utterance['token_ids'],
+                self.key: (self.format_utterance(utterance), token_ids[len(token_ids) - max(max_tokens, 0):])
+            },
+            'truncated': self.key
+        }
+
+    def n_tokens(self, dialogue: List[Dict]) -> int:
+        return sum(len(self.token_ids(utterance)) for utterance in dialogue)
+
+    def fit(self, dialogue: List[Dict], max_tokens: Optional[int] = None) -> List[Dict]:
+        # Get the trailing part of the dialogue fitting the budget
+        budgets = [budget for budget in (max_tokens, self.max_tokens) if budget is not None]
+        if len(budgets) == 0 or len(dialogue) == 0:
+            return dialogue
+        max_tokens = min(budgets)
+        start = len(dialogue)
+        n_tokens = 0
+        while start > 0 and n_tokens + len(self.token_ids(dialogue[start - 1])) <= max_tokens:
+            start -= 1
+            n_tokens += len(self.token_ids(dialogue[start]))
+        if start == len(dialogue):
+            # The last utterance alone does not fit
+            return [self.truncate(dialogue[-1], max_tokens)]
+        if start > 0:
+            # Round the start of the window up to the next step
+            start = min(-(-start // self.trim_step) * self.trim_step, len(dialogue) - 1)
+
+        return dialogue[start:]
@@ -0,0 +1,251 @@
+import logging
+import threading
+from dataclasses import dataclass, field
+
+import torch
+import torch.nn.functional as F
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+from .kv_cache import ConversationCache, PastKeyValues, slice_past
+
+from typing import List, Dict, Optional, Set, Hashable, Tuple, Callable
+
+
+SUPPORTED_GENERATE_KWARGS: Set[str] = {'do_sample', 'top_p', 'top_k', 'temperature', 'max_new_tokens'}
+
+
+def check_generate_kwargs(generate_kwargs: Dict):
+    # The batched decoding loop implements only a subset of the generation parameters of Hugging Face
+    unsupported_kwargs = set(generate_kwargs) - SUPPORTED_GENERATE_KWARGS
+    if len(unsupported_kwargs) > 0:
+        raise ValueError(
+            f"Generation parameters not supported by the batched decoding loop: "
+            f"{', '.join(sorted(unsupported_kwargs))} (supported: {', '.join(sorted(SUPPORTED_GENERATE_KWARGS))})"
+        )
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: List[int]
+    cache_key: Optional[Hashable] = None
+    do_sample: bool = False
+    top_p: float = 1.0
+    top_k: int = 0
+    temperature: float = 1.0
+    max_new_tokens: int = 64
+    # Called by the decoding loop with the tokens generated so far (e.g., to stream the response)
+    on_tokens: Optional[Callable[[List[int]], None]] = None
+
+    @classmethod
+    def from_generate_kwargs(
+            cls, input_ids: List[int], cache_key: Optional[Hashable] = None, **generate_kwargs
+    ) -> 'GenerationRequest':
+        check_generate_kwargs(generate_kwargs)
+
+        return cls(input_ids, cache_key, **generate_kwargs)
+
+
+@dataclass
+class _DecodingState:
+    request: GenerationRequest
+    output_ids: List[int] = field(default_factory=list)
+    n_fed: int = 0  # Generated tokens already fed back to the model
+    done: bool = False
+
+
+def sampling_probs(
+        logits: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: torch.Tensor
+) -> torch.Tensor:
+    # Distribution of the next tokens after temperature, top-k and top-p filtering, with different parameters per row
+    # NOTE logits have shape (n_rows, vocab_size), parameters have shape (n_rows,)
+    logits = logits.float() / temperature.clamp(min=1e-5).unsqueeze(-1)
+    sorted_logits, sorted_idxs = logits.sort(dim=-1, descending=True)
+    # Top-k filtering (k = 0 disables the filter)
+    vocab_idxs = torch.arange(logits.size(-1), device=logits.device).unsqueeze(0)
+    remove_mask = (top_k.unsqueeze(-1) > 0) & (vocab_idxs >= top_k.unsqueeze(-1))
+    # Top-p (nucleus) filtering, the most probable token is always kept
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    remove_mask |= (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p.unsqueeze(-1)
+    sorted_logits = sorted_logits.masked_fill(remove_mask, -float('inf'))
+
+    return torch.zeros_like(logits).scatter(-1, sorted_idxs, sorted_logits.softmax(dim=-1))
+
+
+def sample_tokens(
+        logits: torch.Tensor,
+        do_sample: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: torch.Tensor
+) -> torch.Tensor:
+    # Sample next tokens of a batch with different decoding parameters for each row
+    # NOTE logits have shape (batch_size, vocab_size), parameters have shape (batch_size,)
+    greedy_tokens = logits.argmax(dim=-1)
+    if not do_sample.any():
+        return greedy_tokens
+    sampled_tokens = torch.multinomial(sampling_probs(logits, temperature, top_k, top_p), 1).squeeze(-1)
+
+    return torch.where(do_sample, sampled_tokens, greedy_tokens)
+
+
+class ResponseGenerator:
+    """
+    Decoding loop of the PPM-DLM working on batches of prompts.
+    Each prompt in the batch has its own decoding parameters and stops at the end of the response line.
+    If a conversation cache is provided, the key/value states of each conversation are kept between turns
+    and only the tokens not seen in the previous turn are encoded.
+    The states of the static prefix shared by all the prompts are computed once and reused by every request.
+    """
+    def __init__(
+            self,
+            model: GPT2LMHeadModel,
+            tokenizer: GPT2Tokenizer,
+            conversation_cache: Optional[ConversationCache] = None
+    ):
+        self.model: GPT2LMHeadModel = model.eval()
+        self.tokenizer: GPT2Tokenizer = tokenizer
+        self.conversation_cache: Optional[ConversationCache] = conversation_cache
+        self.pad_token_id: int = self.tokenizer.eos_token_id
+        # Responses end with a new line (or with the end of sequence)
+        new_line = self.tokenizer.byte_encoder[ord('\n')]
+        self.stop_token_ids: Set[int] = {
+            idx for token, idx in self.tokenizer.get_vocab().items() if new_line in token
+        } | {self.tokenizer.eos_token_id}
+        # Static prefix
+        self._prefix: Optional[str] = None
+        self._prefix_state: Tuple[List[int], Optional[PastKeyValues]] = (list(), None)
+        self._prefix_lock: threading.Lock = threading.Lock()
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer(text).input_ids
+
+    def decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True).split('\n')[0].strip()
+
+    @torch.no_grad()
+    def set_prefix(self, prefix: str) -> List[int]:
+        # Encode the static prefix of the prompts (task description and global labels) and keep its states
+        # NOTE states are recomputed only if the prefix changes
+        with self._prefix_lock:
+            if prefix != self._prefix:
+                prefix_ids = self.encode(prefix)
+                if len(prefix_ids) > 0:
+                    past_key_values = self.model(
+                        input_ids=torch.tensor([prefix_ids], device=self.device), use_cache=True
+                    ).past_key_values
+                else:
+                    past_key_values = None
+                self._prefix, self._prefix_state = prefix, (prefix_ids, past_key_values)
+                logging.debug(f"Static prompt prefix encoded ({len(prefix_ids)} tokens)")
+
+            return list(self._prefix_state[0])
+
+    def _prefill(self, request: GenerationRequest) -> Tuple[PastKeyValues, torch.Tensor]:
+        # Encode the prompt of a single request, reusing the cached states of the conversation or of the prefix (if any)
+        n_reused, past_key_values = 0, None
+        if self.conversation_cache is not None and request.cache_key is not None:
+            n_reused, past_key_values = self.conversation_cache.lookup(request.cache_key, request.input_ids)
+        prefix_ids, prefix_past_key_values = self._prefix_state
+        if (
+                prefix_past_key_values is not None and
+                n_reused < len(prefix_ids) < len(request.input_ids) and
+                request.input_ids[:len(prefix_ids)] == prefix_ids
+        ):
+            # The states of the prefix are shared, they are never modified in place
+            n_reused, past_key_values = len(prefix_ids), prefix_past_key_values
+        output = self.model(
+            input_ids=torch.tensor([request.input_ids[n_reused:]], device=self.device),
+            position_ids=torch.arange(n_reused, len(request.input_ids), device=self.device).unsqueeze(0),
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+
+        return output.past_key_values, output.logits[:, -1]
+
+    def _merge_past(self, past_key_values: List[PastKeyValues]) -> Tuple[PastKeyValues, torch.Tensor]:
+        # Left-pad the states of the different requests to the same length and stack them into a batch
+        lengths = [layers_past[0][0].size(2) for layers_past in past_key_values]
+        max_len = max(lengths)
+        past = tuple(
+            tuple(
+                torch.cat([
+                    F.pad(layers_past[layer_idx][i], (0, 0, max_len - length, 0))
+                    for layers_past, length in zip(past_key_values, lengths)
+                ])
+                for i in range(2)
+            )
+            for layer_idx in range(len(past_key_values[0]))
+        )
+        attention_mask = torch.tensor(
+            [[0] * (max_len - length) + [1] * length for length in lengths], device=self.device
+        )
+
+        return past, attention_mask
+
+    def _update_cache(self, states: List[_DecodingState], past_key_values: PastKeyValues, prompt_len: int):
+        # Keep the states of the prompt and of the generated tokens fed back to the model
+        for row, state in enumerate(states):
+            if state.request.cache_key is not None:
+                start = prompt_len - len(state.request.input_ids)
+                self.conversation_cache.store(
+                    state.request.cache_key,
+                    state.request.input_ids + state.output_ids[:state.n_fed],
+                    slice_past(past_key_values, start, prompt_len + state.n_fed, row=row)
+                )
+
+    @torch.no_grad()
+    def generate_batch(self, requests: List[GenerationRequest]) -> List[str]:
+        states = [_DecodingState(request) for request in requests]
+        # Decoding parameters
+        do_sample = torch.tensor([s.request.do_sample for s in states], device=self.device)
+        temperature = torch.tensor([float(s.request.temperature) for s in states], device=self.device)
+        top_k = torch.tensor([int(s.request.top_k) for s in states], device=self.device)
+        top_p = torch.tensor([float(s.request.top_p) for s in states], device=self.device)
+        # Encode prompts one by one (most of each prompt is usually cached) and stack them into a left-padded batch
+        past_key_values, logits = zip(*[self._prefill(s.request) for s in states])
+        past_key_values, attention_mask = self._merge_past(list(past_key_values))
+        logits = torch.cat(logits)
+        prompt_len = attention_mask.size(1)
+        position_ids = torch.tensor([[len(s.request.input_ids)] for s in states], device=self.device)
+        # Decode responses
+        for step in range(max(s.request.max_new_tokens for s in states)):
+            next_tokens = sample_tokens(logits, do_sample, temperature, top_k, top_p).tolist()
+            for state, token in zip(states, next_tokens):
+                if not state.done:
+                    if token in self.stop_token_ids:
+                        state.done = True
+                    else:
+                        state.output_ids.append(token)
+                        state.done = len(state.output_ids) >= state.request.max_new_tokens
+                        if state.request.on_tokens is not None:
+                            state.request.on_tokens(list(state.output_ids))
+            if all(s.done for s in states):
+                break
+            # Finished rows keep being fed with (masked) padding
+            for state in states:
+                if not state.done:
+                    state.n_fed += 1
+            next_tokens = [token if not s.done else self.pad_token_id for s, token in zip(states, next_tokens)]
+            attention_mask = torch.cat([
+                attention_mask, torch.tensor([[int(not s.done)] for s in states], device=self.device)
+            ], dim=-1)
+            output = self.model(
+                input_ids=torch.tensor(next_tokens, device=self.device).unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=position_ids + step,
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            past_key_values, logits = output.past_key_values, output.logits[:, -1]
+        # Save the states of the conversations for the next turn
+        if self.conversation_cache is not None:
+            self._update_cache(states, past_key_values, prompt_len)
+
+        return [self.decode(s.output_ids) for s in states]
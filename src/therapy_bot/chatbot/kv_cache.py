@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from typing import List, Tuple, Optional, Hashable
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def past_n_bytes(past_key_values: PastKeyValues) -> int:
+    return sum(t.numel() * t.element_size() for layer_past in past_key_values for t in layer_past)
+
+
+def slice_past(past_key_values: PastKeyValues, start: int, end: int, row: int = 0) -> PastKeyValues:
+    # Take the states of a single row between the given positions (tensors have shape (batch, heads, length, dim))
+    # NOTE the states are cloned so that they do not keep alive the tensors of the whole batch
+    return tuple(
+        tuple(t[row:row + 1, :, start:end].clone() for t in layer_past) for layer_past in past_key_values
+    )
+
+
+class ConversationCache:
+    """
+    Cache of the transformer key/value states computed for the previous turn of each conversation.
+    States are reused for the longest prefix shared with the new input, so only the new tokens need to be encoded.
+    Entries are evicted in least-recently-used order to stay within the memory budget.
+    """
+    def __init__(self, max_bytes: int = 2 ** 30, max_entries: Optional[int] = None):
+        self.max_bytes: int = max_bytes
+        self.max_entries: Optional[int] = max_entries
+        self.n_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.reused_tokens: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: Hashable, input_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(key)
+            token_ids, past_key_values, _ = entry
+        # Longest common prefix, leaving at least one token to encode to get the next token logits
+        n_reused = 0
+        for cached_token_id, token_id in zip(token_ids, input_ids[:-1]):
+            if cached_token_id != token_id:
+                break
+            n_reused += 1
+        with self._lock:
+            if n_reused == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.reused_tokens += n_reused
+        if n_reused < len(token_ids):
+            past_key_values = tuple(tuple(t[:, :, :n_reused] for t in layer_past) for layer_past in past_key_values)
+
+        return n_reused, past_key_values
+
+    def store(self, key: Hashable, token_ids: List[int], past_key_values: PastKeyValues):
+        n_bytes = past_n_bytes(past_key_values)
+        with self._lock:
+            self._pop(key)
+            if n_bytes > self.max_bytes:
+                return
+            # Evict least recently used entries
+            while len(self._entries) > 0 and (
+                    self.n_bytes + n_bytes > self.max_bytes or
+                    (self.max_entries is not None and len(self._entries) >= self.max_entries)
+            ):
+                self._pop(next(iter(self._entries)))
+            self._entries[key] = (list(token_ids), past_key_values, n_bytes)
+            self.n_bytes += n_bytes
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def _pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.n_bytes -= entry[2]
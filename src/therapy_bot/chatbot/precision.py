@@ -0,0 +1,87 @@
+import logging
+
+import torch
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+
+from typing import List, Dict, Callable, Any
+
+
+PRECISIONS: List[str] = ['fp32', 'fp16', 'bf16', 'int8']
+
+DRIFT_PROMPTS: List[str] = [
+    "User: I have been feeling really anxious lately and I can't sleep.\nTherapyBot:",
+    "User: My partner and I keep arguing about small things.\nTherapyBot:",
+    "User: I don't know why, but I feel empty most of the days.\nTherapyBot:",
+    "User: Work is overwhelming and I feel like I'm failing at everything.\nTherapyBot:"
+]
+
+
+def _to_plain_linear(module: nn.Module) -> nn.Module:
+    # Replace GPT-2 Conv1D layers and Linear sub-classes (e.g., Whisper ones) with plain Linear layers
+    # NOTE dynamic quantisation only targets plain Linear layers
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            # Conv1D weights have shape (in_features, out_features)
+            linear = nn.Linear(*child.weight.size())
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        elif isinstance(child, nn.Linear) and type(child) is not nn.Linear:
+            linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.load_state_dict(child.state_dict())
+            setattr(module, name, linear)
+        else:
+            _to_plain_linear(child)
+
+    return module
+
+
+def set_precision(model: nn.Module, precision: str) -> nn.Module:
+    # Convert weights of the model to the given precision (int8 applies dynamic quantisation to the linear layers)
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', supported values are: {', '.join(PRECISIONS)}")
+    device = next(model.parameters()).device
+    if precision == 'fp32':
+        return model.float()
+    elif precision == 'fp16':
+        if device.type != 'cuda':
+            logging.warning("Half precision is supported only on GPU, keeping full precision")
+            return model.float()
+        return model.half()
+    elif precision == 'bf16':
+        return model.to(torch.bfloat16)
+    else:
+        if device.type != 'cpu':
+            logging.warning("Dynamic quantisation is supported only on CPU, keeping full precision")
+            return model.float()
+        return torch.quantization.quantize_dynamic(_to_plain_linear(model.float()), {nn.Linear}, dtype=torch.qint8)
+
+
+@torch.no_grad()
+def output_drift(
+        reference_model: nn.Module,
+        model: nn.Module,
+        forward: Callable[[nn.Module, Any], torch.Tensor],
+        inputs: List[Any],
+        top_1: bool = True
+) -> Dict[str, float]:
+    # Compare the outputs of a (reduced precision) model with those of the full precision reference
+    max_abs_diffs, cosine_similarities, top_1_agreements = list(), list(), list()
+    for x in inputs:
+        reference_output = forward(reference_model, x).float()
+        output = forward(model, x).float()
+        max_abs_diffs.append((output - reference_output).abs().max().item())
+        cosine_similarities.append(torch.cosine_similarity(
+            output.flatten(end_dim=-2), reference_output.flatten(end_dim=-2), dim=-1
+        ).mean().item())
+        if top_1:
+            top_1_agreements.append((output.argmax(dim=-1) == reference_output.argmax(dim=-1)).float().mean().item())
+    drift = {
+        'max_abs_diff': max(max_abs_diffs),
+        'mean_cosine_similarity': sum(cosine_similarities) / len(cosine_similarities)
+    }
+    if top_1:
+        drift['top_1_agreement'] = sum(top_1_agreements) / len(top_1_agreements)
+
+    return drift
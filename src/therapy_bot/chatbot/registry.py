@@ -0,0 +1,218 @@
+import gc
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+from typing import List, Dict, Optional, Callable, Any, Iterator
+
+
+def _state_tensors(state: Any) -> Iterator[torch.Tensor]:
+    if isinstance(state, torch.Tensor):
+        yield state
+    elif isinstance(state, (tuple, list)):
+        for item in state:
+            yield from _state_tensors(item)
+
+
+def resident_bytes(obj: Any) -> int:
+    # Memory taken by the parameters and buffers of the neural networks held by the object
+    # NOTE the state dict is used to account also for the packed weights of quantised layers (shared tensors count once)
+    if isinstance(obj, torch.nn.Module):
+        tensors = {t.data_ptr(): t for t in _state_tensors(list(obj.state_dict().values()))}
+        return sum(t.numel() * t.element_size() for t in tensors.values())
+    elif isinstance(obj, (tuple, list)):
+        return sum(resident_bytes(item) for item in obj)
+    elif isinstance(obj, dict):
+        return sum(resident_bytes(item) for item in obj.values())
+    else:
+        return 0
+
+
+class _ModelEntry:
+    def __init__(
+            self, name: str, loader: Callable[[], Any], dependencies: List[str], idle_timeout: Optional[float]
+    ):
+        self.name: str = name
+        self.loader: Callable[[], Any] = loader
+        self.dependencies: List[str] = dependencies
+        self.idle_timeout: Optional[float] = idle_timeout
+        self.lock: threading.RLock = threading.RLock()
+        self.model: Optional[Any] = None
+        self.loaded: bool = False
+        self.n_users: int = 0
+        self.last_used: float = time.monotonic()
+        self.load_time: Optional[float] = None
+        self.n_loads: int = 0
+
+
+class ModelRegistry:
+    """
+    Collection of the models of the chatbot.
+    Each model is loaded the first time it is used (or when warmed up) and unloaded after it stays idle too long.
+    A model using other models lists them as dependencies: using it marks the dependencies as used
+    and unloading a dependency unloads it as well.
+    """
+    def __init__(
+            self,
+            idle_timeouts: Optional[Dict[str, float]] = None,
+            default_idle_timeout: Optional[float] = None,
+            check_interval: float = 60.0,
+            warmup: Optional[List[str]] = None
+    ):
+        self.idle_timeouts: Dict[str, float] = idle_timeouts if idle_timeouts is not None else dict()
+        self.default_idle_timeout: Optional[float] = default_idle_timeout
+        self.check_interval: float = check_interval
+        self.warmup_models: Optional[List[str]] = warmup
+        self._entries: Dict[str, _ModelEntry] = dict()
+        self._usage_lock: threading.Lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stop_event: threading.Event = threading.Event()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def register(self, name: str, loader: Callable[[], Any], dependencies: Optional[List[str]] = None):
+        self._entries[name] = _ModelEntry(
+            name,
+            loader,
+            dependencies if dependencies is not None else list(),
+            self.idle_timeouts.get(name, self.default_idle_timeout)
+        )
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._entries and self._entries[name].loaded
+
+    def _touch(self, name: str, n_users: int = 0):
+        # Mark model and its dependencies as used
+        with self._usage_lock:
+            names = [name]
+            while len(names) > 0:
+                entry = self._entries[names.pop()]
+                entry.last_used = time.monotonic()
+                entry.n_users += n_users
+                names += entry.dependencies
+
+    def get(self, name: str) -> Any:
+        entry = self._entries[name]
+        # Each model has its own lock, loading a model does not prevent using the others
+        with entry.lock:
+            if not entry.loaded:
+                start_time = time.perf_counter()
+                entry.model = entry.loader()
+                entry.load_time = time.perf_counter() - start_time
+                entry.loaded = True
+                entry.n_loads += 1
+                logging.info(
+                    f"Model '{name}' loaded in {entry.load_time:.2f} s "
+                    f"({resident_bytes(entry.model) / 2 ** 20:.1f} MiB)"
+                )
+            self._touch(name)
+
+            return entry.model
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[Any]:
+        # Models in use are not unloaded
+        self._touch(name, n_users=1)
+        try:
+            yield self.get(name)
+        finally:
+            self._touch(name, n_users=-1)
+
+    def _dependants(self, name: str) -> List[str]:
+        return [entry.name for entry in self._entries.values() if name in entry.dependencies]
+
+    def _in_use(self, name: str) -> bool:
+        return self._entries[name].n_users > 0 or any(self._in_use(dependant) for dependant in self._dependants(name))
+
+    def unload(self, name: str) -> bool:
+        # Models using this one are unloaded first
+        # NOTE only one model lock is held at a time, loaders acquire the locks of their dependencies while loading
+        if not all(self.unload(dependant) for dependant in self._dependants(name)):
+            return False
+        entry = self._entries[name]
+        with entry.lock:
+            if not entry.loaded:
+                return True
+            if self._in_use(name) or any(self.is_loaded(dependant) for dependant in self._dependants(name)):
+                return False
+            entry.model = None
+            entry.loaded = False
+        logging.info(f"Model '{name}' unloaded")
+
+        return True
+
+    def unload_idle(self) -> List[str]:
+        current_time = time.monotonic()
+        unloaded = list()
+        for entry in self._entries.values():
+            if (
+                    entry.loaded and
+                    entry.idle_timeout is not None and
+                    current_time - entry.last_used > entry.idle_timeout and
+                    self.unload(entry.name)
+            ):
+                unloaded.append(entry.name)
+        if len(unloaded) > 0:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        return unloaded
+
+    def warmup(self, names: Optional[List[str]] = None, background: bool = True) -> Optional[threading.Thread]:
+        # Load models in order (by default in registration order)
+        names = names if names is not None else (
+            self.warmup_models if self.warmup_models is not None else list(self._entries)
+        )
+        names = [name for name in names if name in self._entries]
+
+        def _warmup():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logging.error(f"Warm-up of model '{name}' failed: {e}")
+
+        if background:
+            thread = threading.Thread(target=_warmup, name='model-warmup', daemon=True)
+            thread.start()
+
+            return thread
+        else:
+            _warmup()
+
+            return None
+
+    def start(self):
+        # Start background thread unloading idle models
+        if self._reaper is None and any(entry.idle_timeout is not None for entry in self._entries.values()):
+            self._reaper = threading.Thread(target=self._reaper_loop, name='model-reaper', daemon=True)
+            self._reaper.start()
+
+    def close(self):
+        self._stop_event.set()
+        if self._reaper is not None:
+            self._reaper.join()
+            self._reaper = None
+
+    def _reaper_loop(self):
+        while not self._stop_event.wait(self.check_interval):
+            self.unload_idle()
+
+    def report(self) -> Dict[str, Dict]:
+        current_time = time.monotonic()
+        return {
+            entry.name: {
+                'loaded': entry.loaded,
+                'load_time': entry.load_time,
+                'n_loads': entry.n_loads,
+                'resident_bytes': resident_bytes(entry.model) if entry.loaded else 0,
+                'idle_time': current_time - entry.last_used,
+                'in_use': entry.n_users > 0
+            }
+            for entry in self._entries.values()
+        }
@@ -0,0 +1,281 @@
+import io
+import json
+import time
+import socket
+import logging
+import http.client
+from queue import LifoQueue, Empty, Full
+from urllib.parse import urlparse
+
+import numpy as np
+
+from .audio import read_audio
+from .utils import split_sentences
+
+from typing import List, Dict, Set, Optional, Hashable, Iterator, Tuple, Union
+
+
+# Requests running the models: once sent they are not retried, since the server may have run them already
+INFERENCE_PATHS: Set[str] = {'/generate_response', '/transcribe', '/read_response', '/prerender_responses'}
+
+
+class ModelServerUnavailable(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path: str = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteModels:
+    """
+    Stand-in of the model registry for the remote chatbot: the models are loaded, warmed up and unloaded by the server.
+    """
+    def warmup(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RemoteChatbot:
+    """
+    Client of the model server with the same interface of the chatbot, so that the bot processes do not load any model.
+    Connections to the server are kept alive and reused (up to a maximum number of idle ones).
+    Requests rejected by a busy server (or failed because it is not reachable, e.g., while it restarts) are retried,
+    after the maximum number of retries they fail with ModelServerUnavailable.
+    Requests running the models are retried only if they did not reach the server.
+    """
+    def __init__(
+            self,
+            url: str = 'http://127.0.0.1:8090',
+            chatbot_id: str = 'AI',
+            user_id: str = 'User',
+            pool_size: int = 8,
+            timeout: float = 300.0,
+            max_retries: int = 20,
+            retry_interval: float = 0.5
+    ):
+        self.url: str = url
+        self.chatbot_id: str = chatbot_id
+        self.user_id: str = user_id
+        self.timeout: float = timeout
+        self.max_retries: int = max_retries
+        self.retry_interval: float = retry_interval
+        self.models: RemoteModels = RemoteModels()
+        # NOTE the responses cached by the server are used, the speech cache of the client is always disabled
+        # (pre-rendering is done by the server at start-up)
+        self.speech_cache = None
+        # Connection pool
+        self._address = urlparse(url)
+        self._pool: LifoQueue = LifoQueue(maxsize=pool_size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._address.scheme == 'unix':
+            return UnixHTTPConnection(self._address.path, timeout=self.timeout)
+
+        return http.client.HTTPConnection(self._address.hostname, self._address.port, timeout=self.timeout)
+
+    def _acquire(self) -> http.client.HTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except Empty:
+            return self._connect()
+
+    def _release(self, connection: http.client.HTTPConnection):
+        try:
+            self._pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _request(
+            self, method: str, path: str, body: Optional[bytes] = None, content_type: str = 'application/json'
+    ) -> Tuple[int, bytes]:
+        for retry in range(self.max_retries + 1):
+            if retry > 0:
+                time.sleep(self.retry_interval)
+            connection = self._acquire()
+            try:
+                connection.request(method, path, body=body, headers={'Content-Type': content_type})
+            except (OSError, http.client.HTTPException) as e:
+                # Server not reachable or idle connection closed by the server, retry on a new connection
+                connection.close()
+                logging.debug(f"Request to model server '{self.url}{path}' failed: {e}")
+                continue
+            try:
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # The request was sent, the server may have received it
+                # NOTE the other idle connections are likely broken as well (e.g., after a restart of the server)
+                connection.close()
+                self.close()
+                logging.debug(f"Response of model server '{self.url}{path}' failed: {e}")
+                if path in INFERENCE_PATHS:
+                    raise ModelServerUnavailable(f"Model server '{self.url}' failed while serving '{path}': {e}")
+                continue
+            self._release(connection)
+            if response.status == 503:
+                continue
+            if response.status == 400:
+                raise ValueError(json.loads(data)['error'])
+            if response.status >= 300:
+                raise RuntimeError(f"Model server request '{path}' failed ({response.status}): {data.decode()}")
+            return response.status, data
+        raise ModelServerUnavailable(f"Model server '{self.url}' unavailable after {self.max_retries} retries")
+
+    def _request_json(self, path: str, request: Optional[Dict] = None) -> Dict:
+        if request is None:
+            _, data = self._request('GET', path)
+        else:
+            _, data = self._request('POST', path, body=json.dumps(request).encode())
+
+        return json.loads(data)
+
+    def _request_audio(self, path: str, request: Dict) -> Optional[bytes]:
+        status, data = self._request('POST', path, body=json.dumps(request).encode())
+
+        return data if status == 200 else None
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
+
+    def __call__(self, *args, **kwargs):
+        return self.generate_response(*args, **kwargs)
+
+    def health(self) -> Dict:
+        return self._request_json('/healthz')
+
+    def stats(self) -> Dict:
+        return self._request_json('/stats')
+
+    def generate_response(
+            self,
+            context: List[Dict[str, str]],
+            generate_kwargs: Optional[Dict] = None,
+            cache_key: Optional[Hashable] = None
+    ) -> str:
+        # NOTE the cache keys (chat ids) are shared by all the clients of the server
+        return self._request_json(
+            '/generate_response', {'context': context, 'generate_kwargs': generate_kwargs, 'cache_key': cache_key}
+        )['response']
+
+    def generate_response_stream(
+            self,
+            context: List[Dict[str, str]],
+            generate_kwargs: Optional[Dict] = None,
+            cache_key: Optional[Hashable] = None,
+            granularity: str = 'sentence'
+    ) -> Iterator[str]:
+        # NOTE responses are not streamed by the model server, the whole response is yielded at once
+        yield self.generate_response(context, generate_kwargs=generate_kwargs, cache_key=cache_key)
+
+    def invalidate_cache(self, cache_key: Hashable):
+        self._request_json('/invalidate_cache', {'cache_key': cache_key})
+
+    def generation_stats(self) -> Optional[Dict]:
+        return self.stats()['generation']
+
+    def speculation_stats(self) -> Optional[Dict]:
+        return self.stats()['speculation']
+
+    def transcription_stats(self) -> Optional[Dict]:
+        return self.stats()['transcription']
+
+    def synthesis_stats(self) -> Optional[Dict]:
+        return self.stats()['synthesis']
+
+    @property
+    def streams_responses(self) -> bool:
+        # NOTE the model server sends each response once complete
+        return False
+
+    def batch_sizes(self) -> Dict[str, int]:
+        # NOTE the batches of the server are filled by the requests of all its clients, the concurrency of each client
+        # is set by its own configuration
+        return dict()
+
+    def transcribe_message(self, audio_file_path: str) -> str:
+        # The audio file is sent to the server (which does not share the file system with the client)
+        with open(audio_file_path, 'rb') as f:
+            return self.transcribe_buffer(f.read())
+
+    def transcribe_array(self, audio: np.ndarray) -> str:
+        # Audio is expected to be mono and sampled at 16 kHz
+        _, data = self._request(
+            'POST', '/transcribe', body=audio.astype(np.float32).tobytes(), content_type='application/x-float32'
+        )
+
+        return json.loads(data)['transcription']
+
+    def transcribe_buffer(self, buffer: Union[bytes, io.IOBase]) -> str:
+        _, data = self._request(
+            'POST',
+            '/transcribe',
+            body=buffer if isinstance(buffer, (bytes, bytearray)) else buffer.read(),
+            content_type='application/octet-stream'
+        )
+
+        return json.loads(data)['transcription']
+
+    def cached_response_speech(self, response: Dict[str, str]) -> Optional[bytes]:
+        return self._request_audio('/cached_response_speech', {'response': response})
+
+    def prerender_responses(self, texts: List[str]):
+        self._request_json('/prerender_responses', {'texts': texts})
+
+    def speech_cache_stats(self) -> Optional[Dict]:
+        return self.stats()['speech_cache']
+
+    def read_response(
+            self,
+            audio_file_path: Union[str, io.IOBase],
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None
+    ):
+        audio = self._request_audio('/read_response', {'response': response, 'context': context, 'format': 'wav'})
+        if isinstance(audio_file_path, str):
+            with open(audio_file_path, 'wb') as f:
+                f.write(audio)
+        else:
+            audio_file_path.write(audio)
+
+    def read_response_array(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None
+    ) -> Tuple[np.ndarray, int]:
+        return read_audio(
+            self._request_audio('/read_response', {'response': response, 'context': context, 'format': 'wav'})
+        )
+
+    def read_response_buffer(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None
+    ) -> bytes:
+        return self._request_audio('/read_response', {'response': response, 'context': context, 'format': 'ogg'})
+
+    def read_response_stream(
+            self,
+            response: Dict[str, str],
+            context: Optional[List[Dict[str, str]]] = None
+    ) -> Iterator[bytes]:
+        # One request per sentence, so that the first sentence can be sent while the next ones are synthesised
+        # NOTE the server predicts the style of each sentence on its own (instead of once for the whole response)
+        for sentence in split_sentences(response['text']):
+            yield self.read_response_buffer({**response, 'text': sentence}, context=context)
@@ -0,0 +1,287 @@
+import io
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from .chatbot_api import Chatbot
+
+from typing import List, Dict, Set, Optional, Callable, Any
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ModelServer:
+    """
+    Serves the models of a single chatbot to many bot processes over a local HTTP API (on TCP or on a Unix socket).
+    Each request runs on its own thread, so requests coming from different processes (and chats) end up in the same
+    generation and transcription batches of the chatbot.
+    At most a fixed number of inference requests are admitted at once, the others are rejected with 503
+    (the clients retry them later), so that the queues of the batchers stay bounded.
+    The last context received for each conversation is kept, so that the token ids computed for its utterances
+    are reused by the following turns instead of encoding the whole dialogue again at each request.
+    """
+    def __init__(
+            self,
+            chatbot: Chatbot,
+            host: str = '127.0.0.1',
+            port: int = 8090,
+            socket_path: Optional[str] = None,
+            max_pending: int = 64,
+            max_cached_contexts: int = 1024
+    ):
+        self.chatbot: Chatbot = chatbot
+        self.host: str = host
+        self.port: int = port
+        self.socket_path: Optional[str] = socket_path
+        self.max_pending: int = max_pending
+        self.max_cached_contexts: int = max_cached_contexts
+        # Admission book-keeping
+        self.status: str = 'starting'
+        self.served: int = 0
+        self.rejected: int = 0
+        self.failed: int = 0
+        self._pending: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._server: Optional[socketserver.BaseServer] = None
+        # Contexts of the conversations (in least-recently-used order)
+        self._contexts: OrderedDict = OrderedDict()
+        self._contexts_lock: threading.Lock = threading.Lock()
+        # Endpoints
+        self._json_endpoints: Dict[str, Callable[[Dict], Any]] = {
+            '/generate_response': self._generate_response,
+            '/invalidate_cache': self._invalidate_cache,
+            '/prerender_responses': self._prerender_responses
+        }
+        self._audio_endpoints: Dict[str, Callable[[Dict], Optional[bytes]]] = {
+            '/read_response': self._read_response,
+            '/cached_response_speech': self._cached_response_speech
+        }
+        self.inference_endpoints: Set[str] = {
+            '/generate_response', '/transcribe', '/read_response', '/prerender_responses'
+        }
+
+    @property
+    def address(self) -> str:
+        return f'unix://{self.socket_path}' if self.socket_path is not None else f'http://{self.host}:{self.port}'
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _admit(self) -> bool:
+        with self._lock:
+            if self.status != 'ok' or self._pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self._pending += 1
+            return True
+
+    def _release(self, error: bool = False):
+        with self._lock:
+            self._pending -= 1
+            self.served += not error
+            self.failed += error
+
+    def health(self) -> Dict:
+        return {
+            'status': self.status,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+            'served': self.served,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'cached_contexts': len(self._contexts)
+        }
+
+    def info(self) -> Dict:
+        return {
+            'chatbot_id': self.chatbot.chatbot_id,
+            'user_id': self.chatbot.user_id,
+            'speech_cache': self.chatbot.speech_cache is not None
+        }
+
+    def stats(self) -> Dict:
+        return {
+            'server': self.health(),
+            'generation': self.chatbot.generation_stats(),
+            'speculation': self.chatbot.speculation_stats(),
+            'transcription': self.chatbot.transcription_stats(),
+            'synthesis': self.chatbot.synthesis_stats(),
+            'speech_cache': self.chatbot.speech_cache_stats()
+        }
+
+    def _context(self, context: List[Dict], cache_key: Optional[Any]) -> List[Dict]:
+        # Swap the received utterances with the ones of the previous request of the conversation (if any),
+        # which hold the token ids already computed by the context windows of the chatbot
+        # NOTE the requests of a conversation are sent one at a time by the bot
+        if cache_key is None:
+            return context
+        cache_key = json.dumps(cache_key)
+        with self._contexts_lock:
+            previous_context = self._contexts.pop(cache_key, list())
+        utterances = {(utterance['speaker'], utterance['text']): utterance for utterance in previous_context}
+        context = [utterances.get((utterance['speaker'], utterance['text']), utterance) for utterance in context]
+        with self._contexts_lock:
+            self._contexts[cache_key] = context
+            while len(self._contexts) > self.max_cached_contexts:
+                self._contexts.popitem(last=False)
+
+        return context
+
+    def _generate_response(self, request: Dict) -> Dict:
+        cache_key = request.get('cache_key')
+        return {
+            'response': self.chatbot.generate_response(
+                self._context(request['context'], cache_key),
+                generate_kwargs=request.get('generate_kwargs'),
+                cache_key=cache_key
+            )
+        }
+
+    def _invalidate_cache(self, request: Dict) -> Dict:
+        self.chatbot.invalidate_cache(request['cache_key'])
+        with self._contexts_lock:
+            self._contexts.pop(json.dumps(request['cache_key']), None)
+
+        return dict()
+
+    def _prerender_responses(self, request: Dict) -> Dict:
+        # Responses are synthesised in background, the request returns immediately
+        threading.Thread(
+            target=self.chatbot.prerender_responses, args=(request['texts'],), name='speech-prerendering', daemon=True
+        ).start()
+
+        return dict()
+
+    def _transcribe(self, content_type: str, body: bytes) -> Dict:
+        # Audio files (e.g., OGG/Opus voice notes) are decoded by the server, raw float32 samples are used as they are
+        if content_type == 'application/x-float32':
+            return {'transcription': self.chatbot.transcribe_array(np.frombuffer(body, dtype=np.float32))}
+
+        return {'transcription': self.chatbot.transcribe_buffer(body)}
+
+    def _read_response(self, request: Dict) -> bytes:
+        # The voice message is OGG/Opus (served from the speech cache if possible), the plain audio file is WAV
+        if request.get('format', 'ogg') == 'ogg':
+            return self.chatbot.read_response_buffer(request['response'], context=request.get('context'))
+        buffer = io.BytesIO()
+        self.chatbot.read_response(buffer, request['response'], context=request.get('context'))
+
+        return buffer.getvalue()
+
+    def _cached_response_speech(self, request: Dict) -> Optional[bytes]:
+        return self.chatbot.cached_response_speech(request['response'])
+
+    def _is_endpoint(self, path: str) -> bool:
+        return path == '/transcribe' or path in self._json_endpoints or path in self._audio_endpoints
+
+    def _http_handler(self) -> type:
+        model_server = self
+
+        class ModelServerHandler(BaseHTTPRequestHandler):
+            # Connections are kept alive, so that the clients can reuse them
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(
+                    self, code: int, body: bytes, content_type: str = 'application/json', headers: Optional[Dict] = None
+            ):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for header, value in (headers if headers is not None else dict()).items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _reply_json(self, code: int, body: Dict, headers: Optional[Dict] = None):
+                self._reply(code, json.dumps(body).encode(), headers=headers)
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/healthz':
+                    health = model_server.health()
+                    self._reply_json(200 if health['status'] == 'ok' else 503, health)
+                elif path == '/info':
+                    self._reply_json(200, model_server.info())
+                elif path == '/stats':
+                    self._reply_json(200, model_server.stats())
+                else:
+                    self._reply_json(404, {'error': f"Unknown endpoint: '{path}'"})
+
+            def do_POST(self):
+                path = self.path.split('?')[0]
+                # NOTE the body is always consumed, so that the connection can be reused
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not model_server._is_endpoint(path):
+                    self._reply_json(404, {'error': f"Unknown endpoint: '{path}'"})
+                    return
+                # Backpressure (only the inference requests are limited, the cache look-ups are always served)
+                admitted = path in model_server.inference_endpoints
+                if admitted and not model_server._admit():
+                    self._reply_json(503, {'error': "Model server busy"}, headers={'Retry-After': '1'})
+                    return
+                error = True
+                try:
+                    if path == '/transcribe':
+                        response = model_server._transcribe(self.headers.get('Content-Type', ''), body)
+                        self._reply_json(200, response)
+                    elif path in model_server._json_endpoints:
+                        self._reply_json(200, model_server._json_endpoints[path](json.loads(body)))
+                    else:
+                        audio = model_server._audio_endpoints[path](json.loads(body))
+                        if audio is not None:
+                            self._reply(200, audio, content_type='application/octet-stream')
+                        else:
+                            self._reply(204, b'')
+                    error = False
+                except ValueError as e:
+                    # Module not enabled in the configuration of the server (or malformed request)
+                    self._reply_json(400, {'error': str(e)})
+                except Exception as e:
+                    logging.error(f"Request to '{path}' failed: {e}")
+                    self._reply_json(500, {'error': str(e)})
+                finally:
+                    if admitted:
+                        model_server._release(error=error)
+
+            def log_message(self, *args):
+                pass
+
+        return ModelServerHandler
+
+    def start(self):
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self._server = ThreadingUnixHTTPServer(self.socket_path, self._http_handler())
+        else:
+            self._server = ThreadingHTTPServer((self.host, self.port), self._http_handler())
+            # Actual port (if a free one was requested)
+            self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='model-server', daemon=True).start()
+        self.status = 'ok'
+        logging.info(f"Model server listening at '{self.address}'")
+
+    def close(self, drain_timeout: float = 60.0):
+        # Reject new requests and wait for the admitted ones to complete
+        self.status = 'draining'
+        deadline = time.perf_counter() + drain_timeout
+        while self._pending > 0 and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        self.status = 'stopped'
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        logging.info("Model server stopped")
@@ -0,0 +1,258 @@
+import time
+import logging
+import threading
+from dataclasses import replace
+
+import torch
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+from .generation import GenerationRequest, ResponseGenerator, sampling_probs
+from .kv_cache import ConversationCache, PastKeyValues, slice_past
+from .tracing import tracer
+
+from typing import List, Dict, Optional, Tuple
+
+
+def crop_past(past_key_values: PastKeyValues, length: int) -> PastKeyValues:
+    # Drop the states of the rejected tokens (tensors have shape (batch, heads, length, dim))
+    # NOTE unlike slicing the states are not copied, the next forward pass concatenates them into new tensors anyway
+    if past_key_values[0][0].size(2) == length:
+        return past_key_values
+
+    return tuple(tuple(t[:, :, :length] for t in layer_past) for layer_past in past_key_values)
+
+
+class SpeculationStats:
+    """
+    Running statistics of speculative decoding: acceptance rate of the draft tokens,
+    tokens generated per verification pass of the main model and decoding throughput.
+    """
+    def __init__(self):
+        self.n_requests: int = 0
+        self.n_rounds: int = 0
+        self.n_drafted: int = 0
+        self.n_accepted: int = 0
+        self.n_generated: int = 0
+        self.decoding_time: float = 0.0
+        self.n_plain_requests: int = 0  # Requests decoded without speculation (in batches too large to speculate)
+        self._lock: threading.Lock = threading.Lock()
+
+    def update(self, n_rounds: int, n_drafted: int, n_accepted: int, n_generated: int, decoding_time: float):
+        with self._lock:
+            self.n_requests += 1
+            self.n_rounds += n_rounds
+            self.n_drafted += n_drafted
+            self.n_accepted += n_accepted
+            self.n_generated += n_generated
+            self.decoding_time += decoding_time
+
+    def update_plain(self, n_requests: int):
+        with self._lock:
+            self.n_plain_requests += n_requests
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'requests': self.n_requests,
+                'plain_requests': self.n_plain_requests,
+                'drafted_tokens': self.n_drafted,
+                'accepted_tokens': self.n_accepted,
+                'generated_tokens': self.n_generated,
+                'acceptance_rate': self.n_accepted / self.n_drafted if self.n_drafted > 0 else 0.0,
+                'tokens_per_round': self.n_generated / self.n_rounds if self.n_rounds > 0 else 0.0,
+                'tokens_per_second': self.n_generated / self.decoding_time if self.decoding_time > 0 else 0.0
+            }
+
+
+class SpeculativeGenerator(ResponseGenerator):
+    """
+    Decoding loop of the PPM-DLM with speculative sampling.
+    A small draft model (sharing the tokenizer of the PPM-DLM) proposes a few tokens at a time
+    and the PPM-DLM verifies all of them with a single forward pass.
+    Each draft token is accepted with probability min(1, p / q) (p and q are the filtered distributions of the PPM-DLM
+    and of the draft model) and the first rejected one is re-sampled from the normalised residual max(0, p - q),
+    so that the responses follow the same distribution of plain sampling (with greedy decoding they are identical).
+    Speculation pays off when the PPM-DLM is underused, batches larger than a threshold are decoded as usual.
+    """
+    def __init__(
+            self,
+            model: GPT2LMHeadModel,
+            tokenizer: GPT2Tokenizer,
+            draft_model: GPT2LMHeadModel,
+            conversation_cache: Optional[ConversationCache] = None,
+            n_draft_tokens: int = 4,
+            max_batch_size: int = 1,
+            stats: Optional[SpeculationStats] = None
+    ):
+        super(SpeculativeGenerator, self).__init__(model, tokenizer, conversation_cache=conversation_cache)
+        if draft_model.config.vocab_size != model.config.vocab_size:
+            raise ValueError(
+                f"Vocabulary of the draft model ({draft_model.config.vocab_size} tokens) "
+                f"differs from the one of the main model ({model.config.vocab_size} tokens)"
+            )
+        self.draft_model: GPT2LMHeadModel = draft_model.eval()
+        self.n_draft_tokens: int = n_draft_tokens
+        self.max_batch_size: int = max_batch_size
+        self.stats: SpeculationStats = stats if stats is not None else SpeculationStats()
+        # Static prefix (states of the draft model)
+        self._draft_prefix_state: Tuple[List[int], Optional[PastKeyValues]] = (list(), None)
+
+    @torch.no_grad()
+    def set_prefix(self, prefix: str) -> List[int]:
+        prefix_ids = super(SpeculativeGenerator, self).set_prefix(prefix)
+        with self._prefix_lock:
+            if prefix_ids != self._draft_prefix_state[0]:
+                if len(prefix_ids) > 0:
+                    past_key_values = self.draft_model(
+                        input_ids=torch.tensor([prefix_ids], device=self.draft_model.device), use_cache=True
+                    ).past_key_values
+                else:
+                    past_key_values = None
+                self._draft_prefix_state = (prefix_ids, past_key_values)
+
+        return prefix_ids
+
+    def _draft_prefill(self, input_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        # Reuse the states of the static prefix, the rest of the prompt is encoded with the first draft token
+        # NOTE the states of the conversations are not cached for the draft model, it is cheap to re-encode them
+        prefix_ids, past_key_values = self._draft_prefix_state
+        if (
+                past_key_values is not None and
+                len(prefix_ids) < len(input_ids) and
+                input_ids[:len(prefix_ids)] == prefix_ids
+        ):
+            return len(prefix_ids), past_key_values
+
+        return 0, None
+
+    @staticmethod
+    def _forward(
+            model: GPT2LMHeadModel, input_ids: List[int], n_past: int, past_key_values: Optional[PastKeyValues]
+    ) -> Tuple[PastKeyValues, torch.Tensor]:
+        output = model(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            position_ids=torch.arange(n_past, n_past + len(input_ids), device=model.device).unsqueeze(0),
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+
+        return output.past_key_values, output.logits[0]
+
+    def _speculate(self, request: GenerationRequest) -> Tuple[List[int], int, int, int]:
+        # Decoding parameters (one row for each token to verify)
+        n_rows = self.n_draft_tokens + 1
+        temperature = torch.full((n_rows,), float(request.temperature), device=self.device)
+        top_k = torch.full((n_rows,), int(request.top_k), device=self.device)
+        top_p = torch.full((n_rows,), float(request.top_p), device=self.device)
+        # Encode the prompt but its last token, which is fed to the main model together with the first draft tokens
+        past_key_values, _ = self._prefill(replace(request, input_ids=request.input_ids[:-1]))
+        n_past = len(request.input_ids) - 1
+        n_draft_past, draft_past_key_values = self._draft_prefill(request.input_ids)
+        token_ids = list(request.input_ids)
+        output_ids = list()
+        n_rounds = n_drafted = n_accepted = 0
+        done = request.max_new_tokens <= 0
+        while not done:
+            n_draft_tokens = min(self.n_draft_tokens, request.max_new_tokens - len(output_ids))
+            # Draft tokens
+            draft_ids, draft_probs = list(), list()
+            draft_input_ids = token_ids[n_draft_past:]
+            for _ in range(n_draft_tokens):
+                draft_past_key_values, logits = self._forward(
+                    self.draft_model, draft_input_ids, n_draft_past, draft_past_key_values
+                )
+                n_draft_past += len(draft_input_ids)
+                logits = logits[-1:].to(self.device)
+                if request.do_sample:
+                    probs = sampling_probs(logits, temperature[:1], top_k[:1], top_p[:1])
+                    draft_probs.append(probs)
+                    token = torch.multinomial(probs, 1).item()
+                else:
+                    token = logits.argmax(dim=-1).item()
+                draft_ids.append(token)
+                draft_input_ids = [token]
+            # Verify all the draft tokens with a single pass of the main model
+            # NOTE the last rows are the distributions of the tokens following each draft token
+            input_ids = token_ids[n_past:] + draft_ids
+            past_key_values, logits = self._forward(self.model, input_ids, n_past, past_key_values)
+            n_past += len(input_ids)
+            logits = logits[-(n_draft_tokens + 1):]
+            if request.do_sample:
+                probs = sampling_probs(
+                    logits, temperature[:n_draft_tokens + 1], top_k[:n_draft_tokens + 1], top_p[:n_draft_tokens + 1]
+                )
+                draft_probs = torch.cat(draft_probs)
+                draft_ids_tensor = torch.tensor(draft_ids, device=self.device).unsqueeze(-1)
+                p = probs[:-1].gather(-1, draft_ids_tensor).squeeze(-1)
+                q = draft_probs.gather(-1, draft_ids_tensor).squeeze(-1)
+                # Accept with probability min(1, p / q)
+                accepted = torch.rand(n_draft_tokens, device=self.device) * q < p
+                n_accepted_tokens = int(accepted.long().cumprod(dim=0).sum().item())
+                if n_accepted_tokens < n_draft_tokens:
+                    # Re-sample the rejected token from the residual distribution
+                    residual = (probs[n_accepted_tokens] - draft_probs[n_accepted_tokens]).clamp(min=0.0)
+                    if residual.sum() <= 0.0:
+                        residual = probs[n_accepted_tokens]
+                    next_token = torch.multinomial(residual / residual.sum(), 1).item()
+                else:
+                    # All draft tokens accepted, the main model gives one more token for free
+                    next_token = torch.multinomial(probs[-1], 1).item()
+            else:
+                target_ids = logits.argmax(dim=-1).tolist()
+                n_accepted_tokens = 0
+                while (
+                        n_accepted_tokens < n_draft_tokens and
+                        draft_ids[n_accepted_tokens] == target_ids[n_accepted_tokens]
+                ):
+                    n_accepted_tokens += 1
+                next_token = target_ids[n_accepted_tokens]
+            n_rounds += 1
+            n_drafted += n_draft_tokens
+            n_accepted += n_accepted_tokens
+            # Extend the response up to the end of the line (or up to the maximum length)
+            n_confirmed = len(token_ids) + n_accepted_tokens
+            n_output_ids = len(output_ids)
+            for token in draft_ids[:n_accepted_tokens] + [next_token]:
+                if token in self.stop_token_ids:
+                    done = True
+                    break
+                output_ids.append(token)
+                token_ids.append(token)
+                if len(output_ids) >= request.max_new_tokens:
+                    done = True
+                    break
+            if request.on_tokens is not None and len(output_ids) > n_output_ids:
+                request.on_tokens(list(output_ids))
+            # Drop the states of the rejected draft tokens
+            n_past = min(n_past, n_confirmed, len(token_ids))
+            past_key_values = crop_past(past_key_values, n_past)
+            n_draft_past = min(n_draft_past, n_confirmed, len(token_ids))
+            draft_past_key_values = crop_past(draft_past_key_values, n_draft_past)
+        # Save the states of the conversation for the next turn
+        if self.conversation_cache is not None and request.cache_key is not None:
+            self.conversation_cache.store(
+                request.cache_key, token_ids[:n_past], slice_past(past_key_values, 0, n_past)
+            )
+
+        return output_ids, n_rounds, n_drafted, n_accepted
+
+    @torch.no_grad()
+    def generate_speculative(self, request: GenerationRequest) -> str:
+        start_time = time.perf_counter()
+        with tracer.span('speculative_decoding') as span:
+            output_ids, n_rounds, n_drafted, n_accepted = self._speculate(request)
+            span.update(drafted_tokens=n_drafted, accepted_tokens=n_accepted, generated_tokens=len(output_ids))
+        self.stats.update(n_rounds, n_drafted, n_accepted, len(output_ids), time.perf_counter() - start_time)
+        logging.debug(
+            f"Speculative decoding: {n_accepted}/{n_drafted} draft tokens accepted, "
+            f"{len(output_ids)} tokens in {n_rounds} rounds"
+        )
+
+        return self.decode(output_ids)
+
+    def generate_batch(self, requests: List[GenerationRequest]) -> List[str]:
+        if len(requests) > self.max_batch_size:
+            self.stats.update_plain(len(requests))
+            return super(SpeculativeGenerator, self).generate_batch(requests)
+
+        return [self.generate_speculative(request) for request in requests]
@@ -0,0 +1,351 @@
+import time
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import GPT2Model, GPT2Tokenizer
+from dialoguegst.model import DGST
+
+from .tracing import tracer
+
+from typing import List, Dict, Optional, Tuple
+
+try:
+    from mellotron_api import text_to_sequence
+except ImportError:  # The text front-end is not exposed by older versions of the API
+    text_to_sequence = None
+
+
+# Value of the silent frames of the log-mel spectrograms (the magnitudes are clamped at 1e-5 before the logarithm)
+MEL_PADDING_VALUE: float = float(np.log(1e-5))
+# Approaches to the GST prediction supported by the batched synthesis
+BATCH_GST_PREDICTION_APPROACHES: List[str] = ['score']
+# Encodings of the dialogue supported by the batched synthesis
+# NOTE only the style of the response predicted from the context is supported, the encodings of the response itself
+# (closed by the suffix token) would need the whole response before the synthesis of its first sentence
+BATCH_ENCODING_MODES: List[str] = ['resp_from_ctx']
+
+
+def length_buckets(lengths: List[int], bucket_width: int, max_bucket_size: int) -> List[List[int]]:
+    # Group the indices of the items by length (longest first), the items of a bucket differ by less than the width
+    # NOTE items are sorted by decreasing length within each bucket, as required by the packed RNN of the TTS encoder
+    buckets = list()
+    for i in sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True):
+        if (
+                len(buckets) > 0 and
+                len(buckets[-1]) < max_bucket_size and
+                lengths[buckets[-1][0]] - lengths[i] < bucket_width
+        ):
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+
+    return buckets
+
+
+@dataclass
+class SpeechRequest:
+    text: str  # Sentence to synthesise
+    dialogue: List[str]  # Dialogue context (already fit to the DLDLM context)
+    gst_weights: Optional[torch.Tensor] = None  # Style of the response (predicted from the dialogue if missing)
+
+    @property
+    def dialogue_key(self) -> Tuple[str, ...]:
+        return tuple(self.dialogue)
+
+
+class SynthesisStats:
+    """
+    Running statistics of the batched speech synthesis: efficiency of each stage (share of the computation spent on
+    actual inputs instead of padding) and speed of the synthesis (seconds of speech per second of computation).
+    """
+    def __init__(self):
+        self.n_batches: int = 0
+        self.n_requests: int = 0
+        self.n_styles: int = 0  # Distinct dialogues whose style was predicted
+        self.n_tts_buckets: int = 0
+        self.n_vocoder_buckets: int = 0
+        self.audio_seconds: float = 0.0
+        self.synthesis_time: float = 0.0
+        # Used and padded units of each stage (tokens of the DLDLM, decoder steps of the TTS, frames of the vocoder)
+        self.used: Dict[str, int] = {'style': 0, 'tts': 0, 'vocoder': 0}
+        self.padded: Dict[str, int] = {'style': 0, 'tts': 0, 'vocoder': 0}
+        self._lock: threading.Lock = threading.Lock()
+
+    def update(
+            self,
+            n_requests: int,
+            n_styles: int,
+            n_tts_buckets: int,
+            n_vocoder_buckets: int,
+            used: Dict[str, int],
+            padded: Dict[str, int],
+            audio_seconds: float,
+            synthesis_time: float
+    ):
+        with self._lock:
+            self.n_batches += 1
+            self.n_requests += n_requests
+            self.n_styles += n_styles
+            self.n_tts_buckets += n_tts_buckets
+            self.n_vocoder_buckets += n_vocoder_buckets
+            for stage in self.used:
+                self.used[stage] += used[stage]
+                self.padded[stage] += padded[stage]
+            self.audio_seconds += audio_seconds
+            self.synthesis_time += synthesis_time
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'batches': self.n_batches,
+                'requests': self.n_requests,
+                'styles_per_batch': self.n_styles / self.n_batches if self.n_batches > 0 else 0.0,
+                'mean_tts_bucket_size': self.n_requests / self.n_tts_buckets if self.n_tts_buckets > 0 else 0.0,
+                'mean_vocoder_bucket_size': (
+                    self.n_requests / self.n_vocoder_buckets if self.n_vocoder_buckets > 0 else 0.0
+                ),
+                'padding_efficiency': {
+                    stage: self.used[stage] / self.padded[stage] if self.padded[stage] > 0 else 0.0
+                    for stage in self.used
+                },
+                'audio_seconds': self.audio_seconds,
+                'real_time_factor': self.audio_seconds / self.synthesis_time if self.synthesis_time > 0 else 0.0
+            }
+
+
+class BatchSpeechSynthesiser:
+    """
+    Synthesises the sentences of different chats together (only responses with dialogue context are supported).
+    The styles are predicted with a single (padded) pass of the DLDLM and of the DGST over the distinct dialogues,
+    the spectrograms are generated by the Mellotron on buckets of sentences of similar length
+    and the waveforms by the WaveGlow on buckets of spectrograms of similar length.
+    """
+    def __init__(
+            self,
+            dldlm: GPT2Model,
+            tokenizer: GPT2Tokenizer,
+            dgst: DGST,
+            tts: Tuple,
+            vocoder: Tuple,
+            arpabet_dict: Optional[Dict] = None,
+            gst_prediction: str = 'score',
+            speaker_id: Optional[int] = None,
+            prefix_token: str = '<|prior|>',
+            suffix_token: str = '<|posterior|>',
+            encoding_mode: str = 'resp_from_ctx',
+            max_context_len: int = 256,
+            bucket_width: int = 16,
+            frame_bucket_width: int = 128,
+            max_bucket_size: int = 8,
+            max_decoder_steps: int = 1000,
+            f0_frames: int = 0,
+            sigma: float = 0.666,
+            denoiser_strength: float = 0.01,
+            stats: Optional[SynthesisStats] = None
+    ):
+        if text_to_sequence is None:
+            raise ValueError("Batched speech synthesis requires the text front-end of the Mellotron API")
+        if gst_prediction not in BATCH_GST_PREDICTION_APPROACHES:
+            raise ValueError(f"GST prediction approach '{gst_prediction}' is not supported by batched speech synthesis")
+        if encoding_mode not in BATCH_ENCODING_MODES:
+            raise ValueError(f"Encoding mode '{encoding_mode}' is not supported by batched speech synthesis")
+        self.dldlm: GPT2Model = dldlm
+        self.tokenizer: GPT2Tokenizer = tokenizer
+        self.dgst: DGST = dgst
+        self.tts, self.tts_stft, self.tts_hparams = tts
+        self.waveglow, self.denoiser = vocoder
+        self.arpabet_dict: Optional[Dict] = arpabet_dict
+        self.gst_prediction: str = gst_prediction
+        self.speaker_id: int = speaker_id if speaker_id is not None else 0
+        self.prefix_token_id: int = self.tokenizer.convert_tokens_to_ids(prefix_token)
+        self.suffix_token_id: int = self.tokenizer.convert_tokens_to_ids(suffix_token)
+        self.encoding_mode: str = encoding_mode
+        self.max_context_len: int = max_context_len
+        self.bucket_width: int = bucket_width
+        self.frame_bucket_width: int = frame_bucket_width
+        self.max_bucket_size: int = max_bucket_size
+        self.max_decoder_steps: int = max_decoder_steps
+        self.f0_frames: int = f0_frames
+        self.sigma: float = sigma
+        self.denoiser_strength: float = denoiser_strength
+        self.stats: SynthesisStats = stats if stats is not None else SynthesisStats()
+
+    @property
+    def sampling_rate(self) -> int:
+        return self.tts_hparams.sampling_rate
+
+    def _encode_dialogue(self, dialogue: Tuple[str, ...]) -> List[int]:
+        # Turns are separated by the end of sequence token, the encoding of the context is the one of the prefix token
+        # (the prior of the latent of the response, as with the 'resp_from_ctx' encoding mode)
+        # NOTE the oldest tokens are dropped if the dialogue does not fit the context of the DLDLM
+        input_ids = sum((self.tokenizer(turn).input_ids + [self.tokenizer.eos_token_id] for turn in dialogue), [])
+
+        return input_ids[-(self.max_context_len - 1):] + [self.prefix_token_id]
+
+    def predict_gst(self, dialogues: List[Tuple[str, ...]]) -> Tuple[torch.Tensor, int, int]:
+        # Attention weights of the style tokens (one distribution for each head) of each dialogue
+        input_ids = [self._encode_dialogue(dialogue) for dialogue in dialogues]
+        lengths = torch.tensor([len(ids) for ids in input_ids])
+        max_length = int(lengths.max())
+        device = self.dldlm.device
+        hidden_states = self.dldlm(
+            input_ids=torch.tensor(
+                [ids + [self.tokenizer.eos_token_id] * (max_length - len(ids)) for ids in input_ids], device=device
+            ),
+            attention_mask=(torch.arange(max_length)[None] < lengths[:, None]).long().to(device)
+        ).last_hidden_state
+        context_encodings = hidden_states[torch.arange(len(dialogues)), lengths.to(device) - 1]
+        dgst_parameter = next(self.dgst.parameters())
+        scores = self.dgst(context_encodings.to(device=dgst_parameter.device, dtype=dgst_parameter.dtype))
+        attention = self.tts.gst.stl.attention
+        gst_weights = F.softmax(scores.float().view(len(dialogues), attention.num_heads, -1), dim=-1)
+
+        return gst_weights, int(lengths.sum()), len(dialogues) * max_length
+
+    def style_embeddings(self, gst_weights: torch.Tensor) -> torch.Tensor:
+        # Style embeddings from the attention weights, as the style token layer of the Mellotron would compute them
+        stl = self.tts.gst.stl
+        keys = torch.tanh(stl.embed).unsqueeze(0)  # (1, n_tokens, token_dim)
+        values = stl.attention.W_value(keys)  # (1, n_tokens, num_units)
+        values = torch.stack(torch.split(values, stl.attention.num_units // stl.attention.num_heads, dim=2), dim=0)
+        weights = gst_weights.transpose(0, 1).unsqueeze(2).to(device=values.device, dtype=values.dtype)
+        embeddings = torch.matmul(weights, values)  # (num_heads, batch, 1, num_units / num_heads)
+
+        return torch.cat(torch.split(embeddings, 1, dim=0), dim=3).squeeze(0)  # (batch, 1, num_units)
+
+    def generate_mels(
+            self, sequences: List[List[int]], style_embeddings: torch.Tensor
+    ) -> Tuple[List[torch.Tensor], int, int]:
+        # Spectrograms of a bucket of sentences (sorted by decreasing length), decoded until each one is complete
+        # NOTE the decoder of the Mellotron stops when the gate fires for the (only) sequence, in a batch each sequence
+        # is complete at its own step and the batch is decoded until the last one is
+        parameter = next(self.tts.parameters())
+        device, dtype = parameter.device, parameter.dtype
+        batch_size = len(sequences)
+        lengths = torch.tensor([len(sequence) for sequence in sequences])
+        max_length = int(lengths.max())
+        text = torch.tensor([sequence + [0] * (max_length - len(sequence)) for sequence in sequences], device=device)
+        # Encode the text and condition it on the style and speaker
+        embedded_inputs = self.tts.embedding(text).transpose(1, 2)
+        memory = self.tts.encoder(embedded_inputs, lengths)
+        embedded_speakers = self.tts.speaker_embedding(torch.full((batch_size,), self.speaker_id, device=device))
+        memory = torch.cat((
+            memory,
+            style_embeddings.to(device=device, dtype=dtype).repeat(1, memory.size(1), 1),
+            embedded_speakers[:, None].repeat(1, memory.size(1), 1)
+        ), dim=2)
+        # Decode
+        decoder = self.tts.decoder
+        decoder_input = decoder.get_go_frame(memory)
+        # NOTE the mask marks the padding of the shorter sentences, which the attention must ignore
+        padding_mask = torch.arange(max_length)[None] >= lengths[:, None]
+        decoder.initialize_decoder_states(memory, mask=padding_mask.to(device))
+        # Pitch contours are not conditioned on a reference: the contour is flat (zero) and closed by a zero end frame,
+        # its features (the same at every frame) feed the steps within the contour, the following steps get zeros
+        # NOTE the schedule follows the recalled Decoder.inference of the Mellotron and the length of the contour used
+        # by the speech generator is a parameter (f0_frames): neither is verified against the Mellotron API, which is
+        # why batched synthesis is not enabled in the default configuration
+        f0_features = F.relu(decoder.prenet_f0(torch.zeros(batch_size, 1, 1, device=device, dtype=dtype)))[:, :, 0]
+        mel_outputs, gate_outputs, alignments = list(), list(), list()
+        n_steps = torch.full((batch_size,), self.max_decoder_steps, device=device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        for step in range(self.max_decoder_steps):
+            f0 = f0_features if step < self.f0_frames + 1 else torch.zeros_like(f0_features)
+            mel_output, gate_output, alignment = decoder.decode(torch.cat((decoder.prenet(decoder_input), f0), dim=1))
+            mel_outputs.append(mel_output.squeeze(1))
+            gate_outputs.append(gate_output)
+            alignments.append(alignment)
+            stop = torch.sigmoid(gate_output.float().squeeze(1)) > decoder.gate_threshold
+            n_steps[stop & ~done] = step + 1
+            done |= stop
+            if bool(done.all()):
+                break
+            decoder_input = mel_output
+        mels, _, _ = decoder.parse_decoder_outputs(mel_outputs, gate_outputs, alignments)
+        mels = mels + self.tts.postnet(mels)
+        n_frames = (n_steps * decoder.n_frames_per_step).tolist()
+
+        return (
+            [mel[:, :n] for mel, n in zip(mels, n_frames)],
+            int(n_steps.sum()),
+            batch_size * len(mel_outputs)
+        )
+
+    def generate_waveforms(self, mels: List[torch.Tensor]) -> Tuple[List[np.ndarray], int, int]:
+        # Waveforms of a bucket of spectrograms, the padded frames are silent and their samples are dropped
+        parameter = next(self.waveglow.parameters())
+        max_frames = max(mel.size(1) for mel in mels)
+        mel_batch = torch.stack([
+            F.pad(mel, (0, max_frames - mel.size(1)), value=MEL_PADDING_VALUE) for mel in mels
+        ]).to(device=parameter.device, dtype=parameter.dtype)
+        audio = self.waveglow.infer(mel_batch, sigma=self.sigma)
+        if self.denoiser is not None and self.denoiser_strength > 0.0:
+            audio = self.denoiser(audio, strength=self.denoiser_strength)[:, 0]
+        hop_length = self.tts_hparams.hop_length
+        audio = audio.float().cpu().numpy()
+
+        return (
+            [waveform[:mel.size(1) * hop_length] for waveform, mel in zip(audio, mels)],
+            sum(mel.size(1) for mel in mels),
+            len(mels) * max_frames
+        )
+
+    @torch.no_grad()
+    def synthesise_batch(self, requests: List[SpeechRequest]) -> List[Tuple[np.ndarray, int]]:
+        start_time = time.perf_counter()
+        used, padded = dict(), dict()
+        # Styles (requests with the same dialogue, e.g., the sentences of a response, share the prediction)
+        dialogue_idxs: Dict[Tuple[str, ...], int] = dict()
+        for request in requests:
+            if request.gst_weights is None:
+                dialogue_idxs.setdefault(request.dialogue_key, len(dialogue_idxs))
+        if len(dialogue_idxs) > 0:
+            predicted_gst_weights, used['style'], padded['style'] = self.predict_gst(list(dialogue_idxs))
+        else:
+            used['style'] = padded['style'] = 0
+        style_embeddings = self.style_embeddings(torch.stack([
+            request.gst_weights.float().cpu() if request.gst_weights is not None
+            else predicted_gst_weights[dialogue_idxs[request.dialogue_key]].cpu()
+            for request in requests
+        ]))
+        # Spectrograms
+        sequences = [
+            text_to_sequence(request.text, self.tts_hparams.text_cleaners, self.arpabet_dict) for request in requests
+        ]
+        mels: List[Optional[torch.Tensor]] = [None] * len(requests)
+        tts_buckets = length_buckets([len(sequence) for sequence in sequences], self.bucket_width, self.max_bucket_size)
+        used['tts'] = padded['tts'] = 0
+        for bucket in tts_buckets:
+            with tracer.span('tts', batch_size=len(bucket)):
+                bucket_mels, bucket_used, bucket_padded = self.generate_mels(
+                    [sequences[i] for i in bucket], style_embeddings[bucket]
+                )
+            for i, mel in zip(bucket, bucket_mels):
+                mels[i] = mel
+            used['tts'] += bucket_used
+            padded['tts'] += bucket_padded
+        # Waveforms
+        waveforms: List[Optional[np.ndarray]] = [None] * len(requests)
+        vocoder_buckets = length_buckets([mel.size(1) for mel in mels], self.frame_bucket_width, self.max_bucket_size)
+        used['vocoder'] = padded['vocoder'] = 0
+        for bucket in vocoder_buckets:
+            bucket_waveforms, bucket_used, bucket_padded = self.generate_waveforms([mels[i] for i in bucket])
+            for i, waveform in zip(bucket, bucket_waveforms):
+                waveforms[i] = waveform
+            used['vocoder'] += bucket_used
+            padded['vocoder'] += bucket_padded
+        self.stats.update(
+            len(requests),
+            len(dialogue_idxs),
+            len(tts_buckets),
+            len(vocoder_buckets),
+            used,
+            padded,
+            sum(len(waveform) for waveform in waveforms) / self.sampling_rate,
+            time.perf_counter() - start_time
+        )
+
+        return [(waveform, self.sampling_rate) for waveform in waveforms]
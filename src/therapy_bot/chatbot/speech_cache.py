@@ -0,0 +1,177 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from typing import Dict, Optional, Union
+
+
+WHITESPACE_REGEX: re.Pattern = re.compile(r'\s+')
+
+
+def normalise_text(text: str) -> str:
+    # Texts that are read the same way share the cache entry (case and punctuation are kept, they change prosody)
+    return WHITESPACE_REGEX.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def quantise_style(gst_weights: Union[np.ndarray, torch.Tensor], n_levels: int = 20) -> bytes:
+    # Styles whose GST weights fall in the same quantisation bins are considered the same
+    if not isinstance(gst_weights, np.ndarray):
+        gst_weights = gst_weights.detach().float().cpu().numpy()
+
+    return np.round(gst_weights * n_levels).astype(np.int16).tobytes()
+
+
+class SpeechCache:
+    """
+    Content-addressed cache of the synthesised (encoded) speech.
+    Entries are keyed by the hash of the normalised text, speaker, style and model version.
+    Audio is kept in memory and, optionally, on disk; both tiers evict least-recently-used entries to stay within
+    their size budget.
+    """
+    def __init__(
+            self,
+            max_bytes: int = 2 ** 26,
+            dir_path: Optional[str] = None,
+            max_disk_bytes: int = 2 ** 30,
+            model_version: str = ''
+    ):
+        self.max_bytes: int = max_bytes
+        self.dir_path: Optional[str] = dir_path
+        self.max_disk_bytes: int = max_disk_bytes
+        self.model_version: str = model_version
+        self.n_bytes: int = 0
+        self.n_disk_bytes: int = 0
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._disk_entries: OrderedDict = OrderedDict()
+        if self.dir_path is not None:
+            self._load_disk_index()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, text: str, speaker_id: Optional[int] = None, style: Optional[bytes] = None) -> str:
+        digest = hashlib.sha256()
+        for field in (normalise_text(text).encode(), str(speaker_id).encode(), self.model_version.encode()):
+            digest.update(field)
+            digest.update(b'\x00')
+        digest.update(style if style is not None else b'')
+
+        return digest.hexdigest()
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.dir_path, key[:2], f'{key}.ogg')
+
+    def _load_disk_index(self):
+        # Index the files of previous sessions, least recently used first
+        os.makedirs(self.dir_path, exist_ok=True)
+        files = list()
+        for dir_path, _, file_names in os.walk(self.dir_path):
+            for file_name in file_names:
+                if file_name.endswith('.ogg'):
+                    file_stat = os.stat(os.path.join(dir_path, file_name))
+                    files.append((file_stat.st_mtime, file_name[:-len('.ogg')], file_stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk_entries[key] = size
+            self.n_disk_bytes += size
+        logging.info(f"Speech cache directory '{self.dir_path}' indexed ({len(self._disk_entries)} entries)")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return audio
+            on_disk = key in self._disk_entries
+            if on_disk:
+                self._disk_entries.move_to_end(key)
+        if on_disk:
+            try:
+                with open(self._file_path(key), 'rb') as f:
+                    audio = f.read()
+                os.utime(self._file_path(key))
+            except OSError:
+                audio = None
+        with self._lock:
+            if audio is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, audio)
+
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        with self._lock:
+            self._store(key, audio)
+            write_to_disk = self.dir_path is not None and key not in self._disk_entries
+        if write_to_disk:
+            self._write(key, audio)
+
+    def _store(self, key: str, audio: bytes):
+        # Memory tier
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.n_bytes -= len(entry)
+        if len(audio) > self.max_bytes:
+            return
+        while len(self._entries) > 0 and self.n_bytes + len(audio) > self.max_bytes:
+            _, evicted_audio = self._entries.popitem(last=False)
+            self.n_bytes -= len(evicted_audio)
+        self._entries[key] = audio
+        self.n_bytes += len(audio)
+
+    def _write(self, key: str, audio: bytes):
+        # Disk tier (files are written atomically, so that concurrent readers never see partial files)
+        file_path = self._file_path(key)
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_file_path = f'{file_path}.{threading.get_ident()}.tmp'
+            with open(tmp_file_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_file_path, file_path)
+        except OSError as e:
+            logging.warning(f"Could not write speech cache entry: {e}")
+            return
+        evicted_keys = list()
+        with self._lock:
+            if key not in self._disk_entries:
+                self._disk_entries[key] = len(audio)
+                self.n_disk_bytes += len(audio)
+            while len(self._disk_entries) > 1 and self.n_disk_bytes > self.max_disk_bytes:
+                evicted_key, size = self._disk_entries.popitem(last=False)
+                self.n_disk_bytes -= size
+                evicted_keys.append(evicted_key)
+        for evicted_key in evicted_keys:
+            try:
+                os.remove(self._file_path(evicted_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.n_bytes,
+                'disk_entries': len(self._disk_entries),
+                'disk_bytes': self.n_disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
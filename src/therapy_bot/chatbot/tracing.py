@@ -0,0 +1,218 @@
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from typing import List, Dict, Tuple, Optional, Iterator, Any, Callable
+
+
+DURATION_BUCKETS: List[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+# Attributes shared by all the spans of the message being processed (e.g., the chat id)
+# NOTE they follow the asyncio task of the handler and the worker threads it submits work to
+trace_context: ContextVar[Dict[str, Any]] = ContextVar('trace_context', default=dict())
+
+
+class _NullSpan:
+    # Used when tracing is disabled, attributes set on it are discarded
+    def __enter__(self) -> Dict[str, Any]:
+        return dict()
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SPAN: _NullSpan = _NullSpan()
+
+
+class StageMetrics:
+    """
+    Aggregated metrics of the spans (duration histograms and totals of the numeric attributes) per stage,
+    rendered in the Prometheus text exposition format.
+    """
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets: List[float] = buckets if buckets is not None else DURATION_BUCKETS
+        self._lock: threading.Lock = threading.Lock()
+        self._bucket_counts: Dict[str, List[int]] = dict()
+        self._sums: Dict[str, float] = defaultdict(float)
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._errors: Dict[str, int] = defaultdict(int)
+        self._totals: Dict[Tuple[str, str], float] = defaultdict(float)
+
+    def update(self, stage: str, duration: float, attributes: Dict[str, Any], error: bool = False):
+        with self._lock:
+            bucket_counts = self._bucket_counts.setdefault(stage, [0] * len(self.buckets))
+            for i, upper_bound in enumerate(self.buckets):
+                if duration <= upper_bound:
+                    bucket_counts[i] += 1
+            self._sums[stage] += duration
+            self._counts[stage] += 1
+            if error:
+                self._errors[stage] += 1
+            for name, value in attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._totals[(stage, name)] += value
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                '# HELP therapy_bot_stage_duration_seconds Duration of the processing stages.',
+                '# TYPE therapy_bot_stage_duration_seconds histogram'
+            ]
+            for stage, bucket_counts in sorted(self._bucket_counts.items()):
+                name = 'therapy_bot_stage_duration_seconds'
+                for upper_bound, count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{upper_bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {self._counts[stage]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {self._sums[stage]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {self._counts[stage]}')
+            lines += [
+                '# HELP therapy_bot_stage_errors_total Failed processing stages.',
+                '# TYPE therapy_bot_stage_errors_total counter'
+            ]
+            for stage in sorted(self._counts):
+                lines.append(f'therapy_bot_stage_errors_total{{stage="{stage}"}} {self._errors[stage]}')
+            for name in sorted({name for _, name in self._totals}):
+                lines += [
+                    f'# HELP therapy_bot_{name}_total Total of the {name.replace("_", " ")} attribute of the stages.',
+                    f'# TYPE therapy_bot_{name}_total counter'
+                ]
+                for (stage, attribute), value in sorted(self._totals.items()):
+                    if attribute == name:
+                        lines.append(f'therapy_bot_{name}_total{{stage="{stage}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    """
+    Records a span (stage, duration and attributes) for each processing stage of the handled messages.
+    Spans are written to a JSONL trace file and/or aggregated into metrics exposed on a local HTTP endpoint.
+    When neither is configured tracing is disabled and spans cost a single attribute check.
+    """
+    def __init__(self):
+        self.enabled: bool = False
+        self.metrics: Optional[StageMetrics] = None
+        self._trace_file = None
+        self._trace_lock: threading.Lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def configure(
+            self,
+            trace_file_path: Optional[str] = None,
+            metrics_host: str = '127.0.0.1',
+            metrics_port: Optional[int] = None,
+            buckets: Optional[List[float]] = None
+    ):
+        self.close()
+        if trace_file_path is not None:
+            self._trace_file = open(trace_file_path, 'a')
+            logging.info(f"Trace file created at '{trace_file_path}'")
+        if metrics_port is not None:
+            self.metrics = StageMetrics(buckets=buckets)
+            self._server = ThreadingHTTPServer((metrics_host, metrics_port), self._metrics_handler())
+            threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+            logging.info(f"Metrics endpoint started at 'http://{metrics_host}:{metrics_port}/metrics'")
+        self.enabled = self._trace_file is not None or self.metrics is not None
+
+    def _metrics_handler(self) -> type:
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = tracer.metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return MetricsHandler
+
+    def close(self):
+        self.enabled = False
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.metrics = None
+        with self._trace_lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    def record(self, stage: str, start_time: float, duration: float, attributes: Dict[str, Any], error: Optional[str]):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.update(stage, duration, attributes, error=error is not None)
+        if self._trace_file is not None:
+            span = {'time': start_time, 'stage': stage, 'duration': duration, **trace_context.get(), **attributes}
+            if error is not None:
+                span['error'] = error
+            line = json.dumps(span, default=str)
+            with self._trace_lock:
+                if self._trace_file is not None:
+                    self._trace_file.write(line + '\n')
+                    self._trace_file.flush()
+
+    @contextmanager
+    def _span(self, stage: str, attributes: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        start_time = time.time()
+        start_counter = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(stage, start_time, time.perf_counter() - start_counter, attributes, error)
+
+    def span(self, stage: str, **attributes):
+        # Time the enclosed block, the yielded dictionary can be used to add attributes (e.g., token counts)
+        if not self.enabled:
+            return NULL_SPAN
+        return self._span(stage, attributes)
+
+    @contextmanager
+    def message(self, **attributes) -> Iterator[Dict[str, Any]]:
+        # Root span of a handled message, its attributes are inherited by the spans of the inner stages
+        if not self.enabled:
+            yield dict()
+            return
+        token = trace_context.set({**trace_context.get(), **attributes})
+        try:
+            with self._span('message', dict()) as span:
+                yield span
+        finally:
+            trace_context.reset(token)
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        # Traced version of a function (or bound method)
+        def wrapped(*args, **kwargs):
+            with self.span(stage):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    def instrument(self, obj: Any, stage: str, *method_names: str) -> Any:
+        # Trace the given methods of an object (if it has them), used to time the stages inside third-party models
+        for method_name in method_names:
+            if hasattr(obj, method_name):
+                setattr(obj, method_name, self.wrap(stage, getattr(obj, method_name)))
+
+        return obj
+
+
+# Process-wide tracer (disabled until configured)
+tracer: Tracer = Tracer()
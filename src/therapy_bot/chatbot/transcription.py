@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+import whisper
+
+from .audio import WHISPER_SAMPLING_RATE
+
+from typing import List, Optional
+
+
+def trim_silence(
+        audio: np.ndarray,
+        sampling_rate: int = WHISPER_SAMPLING_RATE,
+        frame_ms: float = 30.0,
+        threshold_db: float = -40.0,
+        silence_db: float = -60.0,
+        padding_ms: float = 200.0
+) -> np.ndarray:
+    # Energy-based voice activity detection: drop the leading and trailing frames quieter than the threshold
+    # NOTE the threshold is relative to the loudest frame, so that the detection does not depend on the recording gain
+    # If even the loudest frame is below the silence level (in dB full scale) the whole audio is dropped
+    frame_size = max(1, int(sampling_rate * frame_ms / 1000))
+    n_frames = len(audio) // frame_size
+    if n_frames == 0:
+        return audio
+    frames = audio[:n_frames * frame_size].reshape(n_frames, frame_size)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    if energy.max() < silence_db:
+        return audio[:0]
+    voiced = np.flatnonzero(energy >= energy.max() + threshold_db)
+    padding = int(sampling_rate * padding_ms / 1000)
+    start = max(0, voiced[0] * frame_size - padding)
+    end = min(len(audio), (voiced[-1] + 1) * frame_size + padding)
+
+    return audio[start:end]
+
+
+@dataclass
+class TranscriptionRequest:
+    audio: np.ndarray  # Mono 16 kHz audio (already trimmed)
+
+    @property
+    def duration(self) -> float:
+        return len(self.audio) / WHISPER_SAMPLING_RATE
+
+
+class BatchTranscriber:
+    """
+    Transcribes voice messages of different chats together, with a single (padded) pass of the Whisper encoder
+    and a batched decoding of the transcripts.
+    Messages shorter than the minimum duration are not transcribed, those longer than the Whisper window (30 s)
+    are transcribed alone with the sliding window algorithm, by the caller instead of the batch (see `is_long`).
+    """
+    def __init__(
+            self,
+            model: whisper.Whisper,
+            language: Optional[str] = 'en',
+            fp16: bool = False,
+            min_duration: float = 0.3,
+            tokens_per_second: float = 6.0,
+            min_tokens: int = 16
+    ):
+        self.model: whisper.Whisper = model
+        self.language: Optional[str] = language
+        self.fp16: bool = fp16
+        self.min_duration: float = min_duration
+        self.tokens_per_second: float = tokens_per_second
+        self.min_tokens: int = min_tokens
+
+    def _max_tokens(self, duration: float) -> int:
+        # Bound the length of the transcripts to the duration of the audio instead of half of the text context
+        return min(self.model.dims.n_text_ctx // 2, max(self.min_tokens, int(duration * self.tokens_per_second)))
+
+    def is_long(self, request: TranscriptionRequest) -> bool:
+        # Audio longer than the Whisper window, it is not transcribed in a batch
+        return len(request.audio) > whisper.audio.N_SAMPLES
+
+    @torch.no_grad()
+    def transcribe_long(self, request: TranscriptionRequest) -> str:
+        # Sliding window transcription
+        return self.model.transcribe(request.audio, language=self.language, fp16=self.fp16)['text'].strip()
+
+    @torch.no_grad()
+    def transcribe_batch(self, requests: List[TranscriptionRequest]) -> List[str]:
+        transcriptions: List[Optional[str]] = [None] * len(requests)
+        window_idxs = list()
+        for i, request in enumerate(requests):
+            if request.duration < self.min_duration:
+                # Short audio fast path: nothing to transcribe (silence or accidental recordings)
+                transcriptions[i] = ''
+            elif self.is_long(request):
+                # Long audio: sliding window transcription
+                # NOTE it blocks the whole batch, long audio is meant to be transcribed by the caller
+                transcriptions[i] = self.transcribe_long(request)
+            else:
+                window_idxs.append(i)
+        if len(window_idxs) > 0:
+            # Audio is padded to the Whisper window, the encoder works on fixed-size inputs
+            mel = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(requests[i].audio)) for i in window_idxs
+            ]).to(self.model.device)
+            options = whisper.DecodingOptions(
+                language=self.language,
+                without_timestamps=True,
+                fp16=self.fp16,
+                sample_len=self._max_tokens(max(requests[i].duration for i in window_idxs))
+            )
+            for i, result in zip(window_idxs, whisper.decode(self.model, mel, options)):
+                transcriptions[i] = result.text.strip()
+
+        return transcriptions
@@ -0,0 +1,27 @@
+import logging
+import re
+
+import nltk
+
+from typing import List
+
+
+SENTENCE_BOUNDARY_REGEX: re.Pattern = re.compile(r'(?<=[.!?])\s+')
+
+
+def split_sentences(text: str) -> List[str]:
+    # Split text into sentences with the NLTK tokeniser (fall back to punctuation if the tokeniser is not available)
+    try:
+        sentences = nltk.sent_tokenize(text)
+    except LookupError:
+        logging.warning("NLTK sentence tokeniser not available, splitting on punctuation")
+        sentences = SENTENCE_BOUNDARY_REGEX.split(text)
+
+    return [sentence.strip() for sentence in sentences if len(sentence.strip()) > 0]
+
+
+def complete_sentences(text: str) -> str:
+    # Longest prefix of a text being generated made of complete sentences (those already followed by a space)
+    boundaries = list(SENTENCE_BOUNDARY_REGEX.finditer(text))
+
+    return text[:boundaries[-1].start()] if len(boundaries) > 0 else ''
@@ -1 +1,4 @@
-from .handlers import init_conversation_handler
+from .handlers import init_conversation_handler, start_background_tasks
+from .store import ConversationStore, SQLiteConversationStore, ConversationStorePersistence
+from .application import init_conversation_store, init_application
+from .frontend import Frontend
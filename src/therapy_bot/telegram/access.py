@@ -0,0 +1,152 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+from typing import Dict, FrozenSet, Hashable, Iterator, Optional
+
+
+class AccessDenied(Exception):
+    def __init__(self, reason: str, user_id: Hashable):
+        super(AccessDenied, self).__init__(f"Update of user {user_id} rejected ({reason})")
+        self.reason: str = reason
+        self.user_id: Hashable = user_id
+
+
+class AuthorisedUsers:
+    """
+    Allow-list of the user IDs, read from a text file (one ID per line, empty lines and '#' comments are skipped).
+    The file is checked for changes at most once every given interval and reloaded without restarting the bot,
+    if the new file cannot be read the previous list is kept.
+    """
+    def __init__(self, file_path: str, reload_interval: float = 5.0):
+        self.file_path: str = file_path
+        self.reload_interval: float = reload_interval
+        self._user_ids: FrozenSet[int] = frozenset()
+        self._mtime: Optional[float] = None
+        self._last_check: float = -float('inf')
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        if time.perf_counter() - self._last_check > self.reload_interval:
+            self.reload()
+        return user_id in self._user_ids
+
+    def reload(self) -> bool:
+        # Reload the list if the file was modified since the last load
+        self._last_check = time.perf_counter()
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+        except OSError as e:
+            logging.error(f"Could not find the authorised users file '{self.file_path}': {e}")
+            return False
+        if mtime == self._mtime:
+            return False
+        # NOTE the modification time is recorded even if the file is malformed, it is not parsed again until it changes
+        self._mtime = mtime
+        try:
+            with open(self.file_path) as f:
+                user_ids = frozenset(
+                    int(line.split('#')[0]) for line in f if len(line.split('#')[0].strip()) > 0
+                )
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not load the authorised users from '{self.file_path}', keeping the previous list: {e}")
+            return False
+        self._user_ids = user_ids
+        logging.info(f"Authorised users list loaded ({len(user_ids)} users)")
+
+        return True
+
+
+class AccessController:
+    """
+    Admission layer applied to every update before any model work is queued.
+    It enforces the allow-list (if any), a per-user token bucket (sustained rate and burst of updates)
+    and a per-user limit on the updates being processed at once.
+    Rejections only cost a few dictionary look-ups.
+    """
+    def __init__(
+            self,
+            authorised_users: Optional[AuthorisedUsers] = None,
+            rate: Optional[float] = None,
+            burst: int = 10,
+            max_concurrent: Optional[int] = None,
+            max_idle_users: int = 4096
+    ):
+        self.authorised_users: Optional[AuthorisedUsers] = authorised_users
+        self.rate: Optional[float] = rate
+        self.burst: int = burst
+        self.max_concurrent: Optional[int] = max_concurrent
+        self.max_idle_users: int = max_idle_users
+        self.admitted: int = 0
+        self.rejected: Dict[str, int] = {'unauthorised': 0, 'rate_limited': 0, 'concurrency': 0}
+        # Book-keeping of each user (accessed only from the event loop)
+        self._buckets: Dict[Hashable, Dict[str, float]] = dict()
+        self._in_flight: Dict[Hashable, int] = dict()
+        self._notified: Dict[Hashable, str] = dict()
+
+    def _take_token(self, user_id: Hashable) -> bool:
+        # Token bucket of the user, refilled at the configured rate up to the burst size
+        now = time.perf_counter()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            # Forget the users whose bucket is full anyway
+            if len(self._buckets) >= self.max_idle_users:
+                self._buckets = {
+                    user: bucket for user, bucket in self._buckets.items()
+                    if bucket['tokens'] + (now - bucket['time']) * self.rate < self.burst
+                }
+            bucket = self._buckets[user_id] = {'tokens': float(self.burst), 'time': now}
+        bucket['tokens'] = min(float(self.burst), bucket['tokens'] + (now - bucket['time']) * self.rate)
+        bucket['time'] = now
+        if bucket['tokens'] < 1.0:
+            return False
+        bucket['tokens'] -= 1.0
+
+        return True
+
+    def check(self, user_id: Hashable):
+        if self.authorised_users is not None and user_id not in self.authorised_users:
+            self.rejected['unauthorised'] += 1
+            raise AccessDenied('unauthorised', user_id)
+        if self.rate is not None and not self._take_token(user_id):
+            self.rejected['rate_limited'] += 1
+            raise AccessDenied('rate_limited', user_id)
+        if self.max_concurrent is not None and self._in_flight.get(user_id, 0) >= self.max_concurrent:
+            self.rejected['concurrency'] += 1
+            raise AccessDenied('concurrency', user_id)
+
+    def notify(self, error: AccessDenied) -> bool:
+        # Users are told about a rejection only at the first one of a streak, the following ones are dropped silently
+        if self._notified.get(error.user_id) == error.reason:
+            return False
+        if len(self._notified) >= self.max_idle_users:
+            self._notified.clear()
+        self._notified[error.user_id] = error.reason
+
+        return True
+
+    @contextmanager
+    def admit(self, user_id: Hashable) -> Iterator[None]:
+        # Check the update and hold a processing slot of the user until it is handled
+        self.check(user_id)
+        self.admitted += 1
+        self._notified.pop(user_id, None)
+        self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._in_flight[user_id] -= 1
+            if self._in_flight[user_id] == 0:
+                del self._in_flight[user_id]
+
+    def summary(self) -> Dict:
+        return {
+            'authorised_users': len(self.authorised_users) if self.authorised_users is not None else None,
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+            'in_flight': sum(self._in_flight.values())
+        }
@@ -0,0 +1,56 @@
+import os
+import logging
+
+from therapy_bot.chatbot import Chatbot
+
+from telegram.ext import Application
+from .handlers import init_conversation_handler, start_background_tasks
+from .store import ConversationStore, SQLiteConversationStore, ConversationStorePersistence
+
+from typing import Dict, Optional
+
+
+def init_conversation_store(configs: Dict, session_series_dir_path: str) -> Optional[ConversationStore]:
+    # The conversation store is shared by the sessions of the series (and by the worker processes),
+    # so that chats survive restarts (conversations and chat states are kept only in memory if not configured)
+    store_configs: Optional[Dict] = configs['telegram'].get('store')
+    if store_configs is None:
+        return None
+
+    return SQLiteConversationStore(
+        os.path.join(session_series_dir_path, store_configs.get('db_file', 'conversations.sqlite')),
+        max_batch_size=store_configs.get('max_batch_size', 256),
+        max_wait_ms=store_configs.get('max_wait_ms', 50.0)
+    )
+
+
+def init_application(
+        configs: Dict,
+        conversation_store: Optional[ConversationStore] = None,
+        chatbot: Optional[Chatbot] = None,
+        updater: bool = True
+) -> Application:
+    # Create the Application and pass it your bot's token.
+    # Updates are processed concurrently, the conversation handler keeps the order of the updates within each chat
+    application_builder = Application.builder().token(
+        configs['telegram']['token']
+    ).arbitrary_callback_data(True).concurrent_updates(True).post_init(start_background_tasks)
+    # Alternative Bot API server (e.g., a local one or the stand-in used for load tests)
+    if configs['telegram'].get('base_url') is not None:
+        application_builder = application_builder.base_url(configs['telegram']['base_url'])
+    if configs['telegram'].get('base_file_url') is not None:
+        application_builder = application_builder.base_file_url(configs['telegram']['base_file_url'])
+    # Updates can also be fed by a front-end process instead of being fetched from Telegram
+    if not updater:
+        application_builder = application_builder.updater(None)
+    if conversation_store is not None:
+        application_builder = application_builder.persistence(ConversationStorePersistence(
+            conversation_store,
+            update_interval=configs['telegram']['store'].get('persistence_update_interval', 5.0)
+        ))
+    application = application_builder.build()
+    # Add conversation handler
+    application.add_handler(init_conversation_handler(configs, chatbot=chatbot, store=conversation_store))
+    logging.info("Application instantiated")
+
+    return application
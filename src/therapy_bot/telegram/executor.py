@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from typing import Dict, Optional, Hashable, Callable, Any, AsyncIterator, Iterator
+
+
+class InferenceQueueFull(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """
+    Runs the (synchronous) model calls of the chatbot on a bounded pool of worker threads,
+    keeping the Telegram event loop free to serve the other chats.
+    Updates of the same chat are processed one at a time and in arrival order,
+    updates of different chats proceed concurrently.
+    The stages whose requests are batched by the chatbot run on their own threads, one per request of a full batch:
+    those threads mostly wait for the batch to be processed, with the shared pool only a few requests at a time
+    would be submitted and the batches would never fill.
+    """
+    def __init__(
+            self,
+            max_workers: int = 1,
+            max_pending: int = 32,
+            max_pending_per_chat: int = 2,
+            timeouts: Optional[Dict[str, float]] = None,
+            batch_sizes: Optional[Dict[str, int]] = None
+    ):
+        self.max_workers: int = max_workers
+        self.max_pending: int = max_pending
+        self.max_pending_per_chat: int = max_pending_per_chat
+        self.timeouts: Dict[str, float] = timeouts if timeouts is not None else dict()
+        # Worker pool
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='inference'
+        )
+        # Worker pools of the batched stages (no more threads than the updates admitted at once)
+        self._stage_pools: Dict[str, ThreadPoolExecutor] = {
+            stage: ThreadPoolExecutor(
+                max_workers=min(batch_size, self.max_pending), thread_name_prefix=f'inference-{stage}'
+            )
+            for stage, batch_size in (batch_sizes if batch_sizes is not None else dict()).items()
+        }
+        # Admission and ordering book-keeping (accessed only from the event loop)
+        self._pending: int = 0
+        self._chat_pending: Dict[Hashable, int] = dict()
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = dict()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @asynccontextmanager
+    async def chat_turn(self, chat_id: Hashable) -> AsyncIterator[None]:
+        # Admission control: reject extra work instead of piling it up
+        if self._pending >= self.max_pending:
+            raise InferenceQueueFull(f"Too many pending updates ({self._pending})")
+        if self._chat_pending.get(chat_id, 0) >= self.max_pending_per_chat:
+            raise InferenceQueueFull(f"Too many pending updates for chat {chat_id}")
+        # Register pending update
+        self._pending += 1
+        self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            # Locks are fair, waiting updates of the same chat are served in arrival order
+            async with lock:
+                yield
+        finally:
+            # Release pending update
+            self._pending -= 1
+            self._chat_pending[chat_id] -= 1
+            if self._chat_pending[chat_id] == 0:
+                # No one else is holding or waiting for the lock of this chat
+                del self._chat_pending[chat_id]
+                del self._chat_locks[chat_id]
+
+    def _pool_of(self, stage: str) -> ThreadPoolExecutor:
+        return self._stage_pools.get(stage, self._pool)
+
+    async def run(self, stage: str, func: Callable, *args, **kwargs) -> Any:
+        # Run function on the worker pool, waiting at most the time allowed for the stage
+        # NOTE the worker thread cannot be interrupted, on timeout it completes the call and the result is dropped
+        # NOTE the call runs in a copy of the current context, so that it inherits the tracing attributes of the caller
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._pool_of(stage), partial(context.run, func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, self.timeouts.get(stage))
+        except asyncio.TimeoutError:
+            logging.warning(f"Inference stage '{stage}' timed out after {self.timeouts.get(stage)} s")
+            raise
+
+    async def stream(self, stage: str, iterator: Iterator) -> AsyncIterator[Any]:
+        # Consume a (synchronous) iterator on the worker pool
+        # The next item is computed in background while the caller is processing the current one
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        end_of_stream = object()
+        future = loop.run_in_executor(self._pool_of(stage), context.run, next, iterator, end_of_stream)
+        while True:
+            try:
+                item = await asyncio.wait_for(future, self.timeouts.get(stage))
+            except asyncio.TimeoutError:
+                logging.warning(f"Inference stage '{stage}' timed out after {self.timeouts.get(stage)} s")
+                raise
+            if item is end_of_stream:
+                break
+            future = loop.run_in_executor(self._pool_of(stage), context.run, next, iterator, end_of_stream)
+            yield item
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+        for pool in self._stage_pools.values():
+            pool.shutdown(wait=wait)
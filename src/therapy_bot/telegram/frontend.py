@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import logging
+import tempfile
+import threading
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from therapy_bot.chatbot import Chatbot
+
+from telegram import Bot
+from telegram.error import TelegramError
+from .ipc import WorkerClient
+from .worker import run_worker
+
+from typing import List, Dict, Optional, Callable
+
+
+# Fields of the updates holding the message (and thus the chat) they refer to
+UPDATE_MESSAGE_FIELDS: List[str] = [
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query'
+]
+
+
+def update_chat_id(update: Dict) -> int:
+    # Chat of the update (or user, for the updates without chat), used as routing key
+    for field in UPDATE_MESSAGE_FIELDS:
+        if field in update:
+            message = update[field].get('message', update[field]) if field == 'callback_query' else update[field]
+            if 'chat' in message:
+                return message['chat']['id']
+            if 'from' in update[field]:
+                return update[field]['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+
+    return 0
+
+
+def shard_of(chat_id: int, n_workers: int) -> int:
+    # Each chat is always served by the same worker
+    return chat_id % n_workers
+
+
+class Frontend:
+    """
+    Lightweight front-end of the sharded deployment.
+    It receives the updates (through a webhook or by polling the Bot API) and routes them by chat id
+    to the model-worker processes over Unix sockets.
+    It also supervises the workers (health checks and restarts) and drains the whole topology on SIGTERM:
+    ingress is stopped, forwarded updates are completed by the workers, then the workers exit.
+    """
+    def __init__(
+            self,
+            configs: Dict,
+            session_dir_path: str,
+            session_series_dir_path: str,
+            chatbot_factory: Optional[Callable[[], Chatbot]] = None
+    ):
+        self.configs: Dict = configs
+        self.session_dir_path: str = session_dir_path
+        self.session_series_dir_path: str = session_series_dir_path
+        self.chatbot_factory: Optional[Callable[[], Chatbot]] = chatbot_factory
+        cluster_configs: Dict = configs.get('cluster', dict())
+        self.n_workers: int = cluster_configs.get('n_workers', 2)
+        self.ingress: str = cluster_configs.get('ingress', 'webhook')
+        self.host: str = cluster_configs.get('host', '127.0.0.1')
+        self.port: int = cluster_configs.get('port', 8080)
+        self.webhook_path: str = '/' + cluster_configs.get('webhook_path', 'telegram').strip('/')
+        self.webhook_url: Optional[str] = cluster_configs.get('webhook_url')
+        self.secret_token: Optional[str] = cluster_configs.get('secret_token')
+        self.socket_dir_path: str = cluster_configs.get('socket_dir') or tempfile.mkdtemp(prefix='therapy_bot_')
+        self.health_interval: float = cluster_configs.get('health_interval', 10.0)
+        self.startup_timeout: float = cluster_configs.get('startup_timeout', 300.0)
+        self.drain_timeout: float = cluster_configs.get('drain_timeout', 120.0)
+        self.request_timeout: float = cluster_configs.get('request_timeout', 10.0)
+        # Workers
+        self._context = multiprocessing.get_context('spawn')
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * self.n_workers
+        self.clients: List[WorkerClient] = [
+            WorkerClient(self._socket_path(shard), timeout=self.request_timeout) for shard in range(self.n_workers)
+        ]
+        self.workers_health: List[Dict] = [{'status': 'starting'} for _ in range(self.n_workers)]
+        # Ingress
+        self.status: str = 'starting'
+        self.routed: List[int] = [0] * self.n_workers
+        self.rejected: int = 0
+        self._in_flight: int = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _socket_path(self, shard: int) -> str:
+        return os.path.join(self.socket_dir_path, f'worker_{shard}.sock')
+
+    def _spawn(self, shard: int):
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                self.configs,
+                shard,
+                self._socket_path(shard),
+                self.session_dir_path,
+                self.session_series_dir_path,
+                self.chatbot_factory
+            ),
+            name=f'worker-{shard}'
+        )
+        process.start()
+        self.processes[shard] = process
+        self.workers_health[shard] = {'status': 'starting', 'shard': shard, 'pid': process.pid}
+        logging.info(f"Worker {shard} started (pid {process.pid})")
+
+    def stop(self):
+        # Thread-safe, the front-end drains and exits
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def route(self, update: Dict) -> bool:
+        # Forward the update to the worker of its chat, False if it cannot take it now (the sender should retry)
+        if self.status != 'ok':
+            self.rejected += 1
+            return False
+        shard = shard_of(update_chat_id(update), self.n_workers)
+        self._in_flight += 1
+        try:
+            response = await self.clients[shard].request({'type': 'update', 'update': update})
+            accepted = response.get('accepted', False)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.warning(f"Could not route update {update.get('update_id')} to worker {shard}: {e}")
+            accepted = False
+        finally:
+            self._in_flight -= 1
+        if accepted:
+            self.routed[shard] += 1
+        else:
+            self.rejected += 1
+
+        return accepted
+
+    async def check_health(self) -> List[Dict]:
+        for shard, client in enumerate(self.clients):
+            process = self.processes[shard]
+            if process is None or not process.is_alive():
+                self.workers_health[shard] = {'status': 'dead', 'shard': shard}
+                continue
+            try:
+                self.workers_health[shard] = await client.request({'type': 'health'})
+            except (OSError, asyncio.TimeoutError):
+                # Not listening yet (starting) or stuck
+                if self.workers_health[shard].get('status') != 'starting':
+                    self.workers_health[shard] = {'status': 'unreachable', 'shard': shard, 'pid': process.pid}
+
+        return self.workers_health
+
+    def health(self) -> Dict:
+        return {
+            'status': self.status,
+            'healthy': self.status == 'ok' and all(worker.get('status') == 'ok' for worker in self.workers_health),
+            'in_flight': self._in_flight,
+            'routed': list(self.routed),
+            'rejected': self.rejected,
+            'workers': list(self.workers_health)
+        }
+
+    async def _supervise(self):
+        # Periodic health checks, dead workers are restarted (their chats are resumed from the conversation store)
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for shard, worker in enumerate(await self.check_health()):
+                if worker['status'] == 'dead' and self.status == 'ok':
+                    logging.error(f"Worker {shard} died, restarting it")
+                    await self.clients[shard].close()
+                    self._spawn(shard)
+
+    async def _wait_workers(self):
+        deadline = time.perf_counter() + self.startup_timeout
+        while not all(worker.get('status') == 'ok' for worker in await self.check_health()):
+            if any(worker['status'] == 'dead' for worker in self.workers_health):
+                raise RuntimeError(f"Worker failed at start-up: {self.workers_health}")
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Workers not ready after {self.startup_timeout} s: {self.workers_health}")
+            await asyncio.sleep(0.1)
+
+    def _http_handler(self):
+        frontend = self
+
+        class FrontendHandler(BaseHTTPRequestHandler):
+            def _reply(self, code: int, body: Dict):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                # Health check endpoint (e.g., for the orchestrator or the load balancer)
+                if self.path.split('?')[0] != '/healthz':
+                    self.send_error(404)
+                    return
+                health = frontend.health()
+                self._reply(200 if health['healthy'] else 503, health)
+
+            def do_POST(self):
+                # Webhook endpoint, Telegram retries the updates not acknowledged with 200
+                if frontend.ingress != 'webhook' or self.path.split('?')[0] != frontend.webhook_path:
+                    self.send_error(404)
+                    return
+                secret_token = self.headers.get('X-Telegram-Bot-Api-Secret-Token')
+                if frontend.secret_token is not None and secret_token != frontend.secret_token:
+                    self.send_error(403)
+                    return
+                update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                accepted = asyncio.run_coroutine_threadsafe(frontend.route(update), frontend._loop).result()
+                self._reply(200 if accepted else 503, {'accepted': accepted})
+
+            def log_message(self, *args):
+                pass
+
+        return FrontendHandler
+
+    def _bot(self) -> Bot:
+        telegram_configs: Dict = self.configs['telegram']
+
+        return Bot(
+            telegram_configs['token'],
+            base_url=telegram_configs.get('base_url', 'https://api.telegram.org/bot'),
+            base_file_url=telegram_configs.get('base_file_url', 'https://api.telegram.org/file/bot')
+        )
+
+    async def _poll(self, bot: Bot):
+        # Long polling ingress, updates are confirmed (offset moved forward) only once a worker accepted them
+        # NOTE an update rejected by a busy or restarting worker is retried, holding back the following ones
+        offset = None
+        while self.status == 'ok':
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=10)
+            except TelegramError as e:
+                logging.warning(f"Polling failed: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            for update in updates:
+                if not await self.route(update.to_dict()):
+                    await asyncio.sleep(1.0)
+                    break
+                offset = update.update_id + 1
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(signal_number, self._stop.set)
+        # Start workers
+        os.makedirs(self.socket_dir_path, exist_ok=True)
+        for shard in range(self.n_workers):
+            self._spawn(shard)
+        supervisor = poller = None
+        try:
+            await self._wait_workers()
+            self.status = 'ok'
+            logging.info(f"{self.n_workers} workers ready")
+            supervisor = asyncio.create_task(self._supervise())
+            # Start ingress (the HTTP server also serves the health checks)
+            self._server = ThreadingHTTPServer((self.host, self.port), self._http_handler())
+            threading.Thread(target=self._server.serve_forever, name='frontend-server', daemon=True).start()
+            logging.info(f"Front-end listening at 'http://{self.host}:{self.port}' ({self.ingress} ingress)")
+            async with self._bot() as bot:
+                if self.ingress == 'webhook':
+                    if self.webhook_url is not None:
+                        await bot.set_webhook(self.webhook_url, secret_token=self.secret_token)
+                else:
+                    await bot.delete_webhook()
+                    poller = asyncio.create_task(self._poll(bot))
+                await self._stop.wait()
+        finally:
+            # Drain (also when the start-up failed, so that no worker is left behind)
+            await self.drain()
+            for task in (poller, supervisor):
+                if task is not None:
+                    task.cancel()
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+
+    async def drain(self):
+        # Stop ingress, wait for the forwarded updates to be acknowledged, then let the workers complete them and exit
+        self.status = 'draining'
+        logging.info("Front-end draining")
+        while self._in_flight > 0:
+            await asyncio.sleep(0.05)
+        for shard, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await self._loop.run_in_executor(None, process.join, self.drain_timeout)
+            if process.is_alive():
+                logging.error(f"Worker {shard} did not drain in {self.drain_timeout} s, killing it")
+                process.kill()
+                await self._loop.run_in_executor(None, process.join)
+            await self.clients[shard].close()
+        self.status = 'stopped'
+        logging.info("Front-end stopped")
@@ -1,47 +1,246 @@
+import io
+import asyncio
 import logging
-from tempfile import NamedTemporaryFile
+import threading
 
 from functools import wraps
 
-from therapy_bot.chatbot import Chatbot
+from therapy_bot.chatbot import Chatbot, RemoteChatbot, ModelServerUnavailable
+from therapy_bot.chatbot.tracing import tracer
 
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (
+    Application,
     CommandHandler,
     CallbackContext,
     ConversationHandler,
     MessageHandler,
     filters,
 )
+from .access import AuthorisedUsers, AccessController, AccessDenied
+from .executor import InferenceExecutor, InferenceQueueFull
+from .store import ConversationStore
+from .streaming import EditRateLimiter
 from .utils import EVAL_MARKUP
 from .utils import IDLE, CHAT, EVAL
+from .utils import (
+    BUSY_MESSAGE,
+    CHAT_DISABLED_MESSAGE,
+    CHAT_TIMEOUT_MESSAGE,
+    RATE_LIMITED_MESSAGE,
+    TRANSCRIPTION_DISABLED_MESSAGE,
+    TRANSCRIPTION_EMPTY_MESSAGE,
+    TRANSCRIPTION_TIMEOUT_MESSAGE,
+    UNAUTHORISED_MESSAGE,
+    STATUS_MESSAGES
+)
 
-from typing import Dict
+from typing import Dict, Optional, AsyncIterator
 
 
 # Global variables
 global therabot
 global evaluation_aspects
-global authorised_users
+global access_controller
+global inference_executor
+global conversation_store
+global history_utterances
+global edit_rate_limiter
 
 
 def restricted_access(func):
     @wraps(func)
     async def wrapped(update, context, *args, **kwargs):
-        user_id = update.effective_user.id
-        if authorised_users is not None and user_id in authorised_users:  # Check IDs only of list is provided
+        # Check the update before anything else is done (in particular, before any model work is queued)
+        if access_controller is None:  # Do not restrict access if not configured
             return await func(update, context, *args, **kwargs)
-        else:
+        try:
+            with access_controller.admit(update.effective_user.id):
+                return await func(update, context, *args, **kwargs)
+        except AccessDenied as e:
+            logging.debug(e)
+            if e.reason == 'concurrency':
+                await reply_status(update, BUSY_MESSAGE)
+            elif access_controller.notify(e):
+                # NOTE the update may be an edited message (the message of the update is then missing)
+                await update.effective_message.reply_text(
+                    UNAUTHORISED_MESSAGE if e.reason == 'unauthorised' else RATE_LIMITED_MESSAGE
+                )
+            # Keep current conversation state
+            return None
+    return wrapped
+
+
+async def reply_status(update: Update, text: str, voice: bool = True):
+    # Status messages are also read out loud to the users talking by voice (only if the voice message is pre-rendered)
+    # NOTE the voice message is skipped if it cannot be looked up (e.g., the model server is not available)
+    message = update.effective_message
+    if voice and message.voice is not None:
+        try:
+            voice_message = await asyncio.get_running_loop().run_in_executor(
+                None, therabot.cached_response_speech, {'speaker': therabot.chatbot_id, 'text': text}
+            )
+        except ModelServerUnavailable as e:
+            logging.warning(e)
+            voice_message = None
+        if voice_message is not None:
+            await message.reply_voice(voice_message)
+    await message.reply_text(text)
+
+
+async def reply_streamed_text(update: Update, responses: AsyncIterator[str]) -> str:
+    # Send the beginning of the response as soon as it is ready, then edit the message as the response grows
+    # NOTE intermediate edits exceeding the rate limits are skipped (the next one includes their text),
+    # the final one is always sent
+    chat_id = update.effective_chat.id
+    message = None
+    response = sent_response = ''
+    async for response in responses:
+        if len(response) == 0 or response == sent_response:
+            continue
+        if message is None:
+            await edit_rate_limiter.acquire(chat_id)
+            with tracer.span('upload', kind='text'):
+                message = await update.message.reply_text(response)
+            sent_response = response
+        elif edit_rate_limiter.try_acquire(chat_id):
+            with tracer.span('upload', kind='edit'):
+                await message.edit_text(response)
+            sent_response = response
+    if message is None:
+        with tracer.span('upload', kind='text'):
+            await update.message.reply_text(response)
+    elif response != sent_response:
+        await edit_rate_limiter.acquire(chat_id)
+        with tracer.span('upload', kind='edit'):
+            await message.edit_text(response)
+
+    return response
+
+
+def traced_message(func):
+    @wraps(func)
+    async def wrapped(update, context, *args, **kwargs):
+        # Spans of the stages run to handle the update are keyed by chat id
+        with tracer.message(chat_id=update.effective_chat.id, handler=func.__name__):
             return await func(update, context, *args, **kwargs)
     return wrapped
 
 
+def reset_chat_data(update: Update, context: CallbackContext, new_conversation: bool = False):
+    # Clear the data of the chat in memory and optionally open a new conversation (closing the previous one)
+    # NOTE conversations in the store are closed only by the /begin and /end commands
+    context.chat_data['conversation'] = list()
+    context.chat_data['evaluation'] = dict()
+    context.chat_data['n_utterances'] = 0
+    context.chat_data['conversation_id'] = None
+    if conversation_store is not None and new_conversation:
+        context.chat_data['conversation_id'] = conversation_store.start_conversation(update.effective_chat.id)
+
+
+def add_utterance(context: CallbackContext, utterance: Dict[str, str]):
+    # Append the utterance to the working set of the chat, the write to the store happens in background
+    context.chat_data['conversation'].append(utterance)
+    if conversation_store is not None:
+        conversation_store.add_utterance(
+            context.chat_data['conversation_id'], context.chat_data['n_utterances'], utterance
+        )
+    context.chat_data['n_utterances'] += 1
+    # Bound the working set, older utterances are only kept in the store
+    # NOTE trimming is done in steps of many utterances, the cached states of the chat are dropped only when it happens
+    if history_utterances is not None and len(context.chat_data['conversation']) > 2 * history_utterances:
+        del context.chat_data['conversation'][:-history_utterances]
+
+
+async def invalidate_cache(chat_id: int):
+    # Drop the cached states of the conversation (off the event loop, the chatbot may be a remote one)
+    await asyncio.get_running_loop().run_in_executor(None, therabot.invalidate_cache, chat_id)
+
+
+def add_score(context: CallbackContext, aspect: str, score: int):
+    context.chat_data['evaluation'][aspect] = score
+    if conversation_store is not None:
+        conversation_store.add_score(context.chat_data['conversation_id'], aspect, score)
+
+
+def restored_chat_data(func):
+    @wraps(func)
+    async def wrapped(update, context, *args, **kwargs):
+        # After a restart (or a move to another process) the chat state is resumed but its data are not in memory:
+        # reload the last turns of the open conversation from the store
+        if context.chat_data.get('conversation') is None:
+            reset_chat_data(update, context)
+            if conversation_store is not None:
+                chat_data = await asyncio.get_running_loop().run_in_executor(
+                    None, conversation_store.load_conversation, update.effective_chat.id, history_utterances
+                )
+                if chat_data is not None:
+                    context.chat_data.update(chat_data)
+                    logging.info(
+                        f"Restored conversation {chat_data['conversation_id']} "
+                        f"({chat_data['n_utterances']} utterances) of chat {update.effective_chat.id}"
+                    )
+        return await func(update, context, *args, **kwargs)
+    return wrapped
+
+
+def ordered_per_chat(func):
+    @wraps(func)
+    async def wrapped(update, context, *args, **kwargs):
+        try:
+            # Updates of the same chat are served one at a time, in arrival order
+            async with inference_executor.chat_turn(update.effective_chat.id):
+                return await func(update, context, *args, **kwargs)
+        except (InferenceQueueFull, ModelServerUnavailable) as e:
+            logging.warning(e)
+            await reply_status(update, BUSY_MESSAGE, voice=not isinstance(e, ModelServerUnavailable))
+            # Keep current conversation state
+            return None
+    return wrapped
+
+
+class OrderedConversationHandler(ConversationHandler):
+    """
+    Conversation handler serving the updates of each chat one at a time, in arrival order.
+    The callback of an update is selected only on its turn, once the previous updates of the chat are done:
+    with concurrent updates the state would otherwise be read before it is changed
+    (e.g., a message sent right after /begin would be handled as if the conversation was not started).
+    """
+    def check_update(self, update: object) -> Optional[object]:
+        # Take all the messages of the users, the callback (if any) is selected on the turn of the update
+        # NOTE messages not handled in the state of the chat go through the access checks too, then they are dropped
+        if isinstance(update, Update) and update.effective_message is not None and update.effective_user is not None:
+            return super(OrderedConversationHandler, self).check_update(update) or True
+
+        return super(OrderedConversationHandler, self).check_update(update)
+
+    async def handle_update(
+            self, update: Update, application: Application, check_result: object, context: CallbackContext
+    ) -> Optional[object]:
+        return await dispatch_update(update, context, self, application)
+
+
 @restricted_access
+@ordered_per_chat
+async def dispatch_update(
+        update: Update, context: CallbackContext, conversation_handler: ConversationHandler, application: Application
+) -> Optional[object]:
+    # Select the callback now, the state of the chat may have changed while waiting for the turn
+    check_result = super(OrderedConversationHandler, conversation_handler).check_update(update)
+    if check_result is None:
+        return None
+
+    return await super(OrderedConversationHandler, conversation_handler).handle_update(
+        update, application, check_result, context
+    )
+
+
+@traced_message
 async def start_bot(update: Update, context: CallbackContext) -> int:
     # Start chatbot and give user instructions
     # Init context
-    context.chat_data['conversation'] = list()
-    context.chat_data['evaluation'] = dict()
+    reset_chat_data(update, context)
+    await invalidate_cache(update.effective_chat.id)
     # Give user instructions
     await update.message.reply_text(
         "Welcome to TherapyBot. "
@@ -53,12 +252,12 @@ async def start_bot(update: Update, context: CallbackContext) -> int:
     return IDLE
 
 
-@restricted_access
+@traced_message
 async def start_chatting(update: Update, context: CallbackContext) -> int:
     # Start conversation
     # Init context
-    context.chat_data['conversation'] = list()
-    context.chat_data['evaluation'] = dict()
+    reset_chat_data(update, context, new_conversation=True)
+    await invalidate_cache(update.effective_chat.id)
     # Signal conversation start
     await update.message.reply_text(
         "Conversation mode started."
@@ -67,94 +266,128 @@ async def start_chatting(update: Update, context: CallbackContext) -> int:
     return CHAT
 
 
-@restricted_access
+@traced_message
+@restored_chat_data
 async def get_text_response(update: Update, context: CallbackContext) -> int:
     # Generate a written response message to a text message
-    # Get message text and append it to the context
-    message = update.message.text
-    context.chat_data['conversation'].append({'speaker': therabot.user_id, 'text': message})
+    # Get message text, it is added to the conversation together with the response
+    # NOTE the models get a copy of the conversation: on timeout the worker thread is still using it while the next
+    # update of the chat is served, and the turn is not recorded
+    utterance = {'speaker': therabot.user_id, 'text': update.message.text}
+    conversation = context.chat_data['conversation'] + [utterance]
     try:
         # Generate response using neural chatbot
-        response = therabot(context.chat_data['conversation'])
-        logging.debug(f'Generated text response. Response text: "{message}", Context: {context.chat_data["conversation"]}')
-        context.chat_data['conversation'].append({'speaker': therabot.chatbot_id, 'text': response})
+        if edit_rate_limiter is not None:
+            # Send the response while it is generated (the response is added to the conversation once complete)
+            # NOTE if generation fails midway, the part already sent is not added to the conversation
+            response = await reply_streamed_text(update, inference_executor.stream(
+                'generation', therabot.generate_response_stream(conversation, cache_key=update.effective_chat.id)
+            ))
+        else:
+            response = await inference_executor.run(
+                'generation', therabot, conversation, cache_key=update.effective_chat.id
+            )
+        # NOTE arguments are formatted only if the message is actually logged
+        logging.debug('Generated text response. Response text: "%s", Context: %s', response, conversation)
     except ValueError as e:
         logging.error(e)
-        await update.message.reply_text(
-            "I'm sorry, the chatting service is not enabled in the current configuration. "
-            "Stop the chatbot and try again later."
-        )
+        await reply_status(update, CHAT_DISABLED_MESSAGE)
 
         return CHAT
-    # Send response text to user
-    await update.message.reply_text(response)
+    except asyncio.TimeoutError:
+        await reply_status(update, CHAT_TIMEOUT_MESSAGE)
+
+        return CHAT
+    add_utterance(context, utterance)
+    add_utterance(context, {'speaker': therabot.chatbot_id, 'text': response})
+    # Send response text to user (unless it has already been streamed)
+    if edit_rate_limiter is None:
+        with tracer.span('upload', kind='text'):
+            await update.message.reply_text(response)
 
     return CHAT
 
 
-@restricted_access
+@traced_message
+@restored_chat_data
 async def get_voice_response(update: Update, context: CallbackContext) -> int:
     # Generate a written and spoken response message to a voice message
-    # Save voice message into temporary file
-    with NamedTemporaryFile(suffix='.ogg') as voice_message:
+    # Download voice message into memory
+    with tracer.span('download'):
         voice_file = await update.message.voice.get_file()
-        await voice_file.download_to_drive(voice_message.name)
-        # Reset file cursor to be sure
-        voice_message.seek(0)
-        try:
-            # Get message text and append it to the context
-            message = therabot.transcribe_message(voice_message.name)
-            logging.debug(f'Transcribed voice message. Transcripton text: "{message}"')
-            context.chat_data['conversation'].append({'speaker': therabot.user_id, 'text': message})
-        except ValueError as e:
-            logging.error(e)
-            # Signal to the user that the transcription module is not avaialble
-            await update.message.reply_text(
-                "I'm sorry, the transcription service is not enabled in the current configuration. "
-                "You're welcome to write a text message."
-            )
-            return CHAT
+        voice_message = io.BytesIO()
+        await voice_file.download_to_memory(voice_message)
     try:
-        # Generate response using neural chatbot
-        response = therabot(context.chat_data['conversation'])
-        logging.debug(f'Generated text response. Response text: "{message}", Context: {context.chat_data["conversation"]}')
-        context.chat_data['conversation'].append({'speaker': therabot.chatbot_id, 'text': response})
+        # Get message text and append it to the context
+        message = await inference_executor.run('transcription', therabot.transcribe_buffer, voice_message.getvalue())
+        logging.debug('Transcribed voice message. Transcripton text: "%s"', message)
     except ValueError as e:
         logging.error(e)
-        await update.message.reply_text(
-            "I'm sorry, the chatting service is not enabled in the current configuration. "
-            "Stop the chatbot and try again later."
+        # Signal to the user that the transcription module is not avaialble
+        await reply_status(update, TRANSCRIPTION_DISABLED_MESSAGE)
+        return CHAT
+    except asyncio.TimeoutError:
+        await reply_status(update, TRANSCRIPTION_TIMEOUT_MESSAGE)
+        return CHAT
+    # Silent (or empty) voice messages are not added to the conversation
+    if len(message.strip()) == 0:
+        await reply_status(update, TRANSCRIPTION_EMPTY_MESSAGE)
+        return CHAT
+    # The transcription is added to the conversation together with the response (on timeout the turn is not recorded)
+    utterance = {'speaker': therabot.user_id, 'text': message}
+    conversation = context.chat_data['conversation'] + [utterance]
+    try:
+        # Generate response using neural chatbot
+        response = await inference_executor.run(
+            'generation', therabot, conversation, cache_key=update.effective_chat.id
         )
+        # NOTE arguments are formatted only if the message is actually logged
+        logging.debug('Generated text response. Response text: "%s", Context: %s', response, conversation)
+    except ValueError as e:
+        logging.error(e)
+        await reply_status(update, CHAT_DISABLED_MESSAGE)
 
         return CHAT
+    except asyncio.TimeoutError:
+        await reply_status(update, CHAT_TIMEOUT_MESSAGE)
+
+        return CHAT
+    add_utterance(context, utterance)
+    add_utterance(context, {'speaker': therabot.chatbot_id, 'text': response})
     # Synthesise response speech
-    # Save voice response into temporary file
-    # TODO handle long responses splitting into multiple files (use nltk sentence tokeniser and iterate over result)
-    with NamedTemporaryFile(suffix='.ogg') as voice_response:
-        try:
-            # Synthesise speech
-            therabot.read_response(
-                voice_response.name,
-                context.chat_data['conversation'][-1],
-                context=context.chat_data['conversation'][:-1]
-            )
-            logging.debug(f'Generated voice response.')
-            # Reset file cursor to be sure
-            voice_response.seek(0)
+    # Voice response is synthesised and sent one sentence at a time, the next sentence is synthesised while sending
+    try:
+        async for voice_response in inference_executor.stream(
+                'synthesis',
+                therabot.read_response_stream(
+                    context.chat_data['conversation'][-1], context=context.chat_data['conversation'][:-1]
+                )
+        ):
             # Send response voice message to user
-            await update.message.reply_voice(voice_response)
-        except ValueError as e:
-            logging.error(e)
-            pass
+            with tracer.span('upload', kind='voice'):
+                await update.message.reply_voice(voice_response)
+        logging.debug('Generated voice response.')
+    except ValueError as e:
+        logging.error(e)
+        pass
+    except (asyncio.TimeoutError, ModelServerUnavailable):
+        # Fall back to text only response
+        pass
     # Send response text to user
-    await update.message.reply_text(response)
+    with tracer.span('upload', kind='text'):
+        await update.message.reply_text(response)
 
     return CHAT
 
 
-@restricted_access
+@traced_message
+@restored_chat_data
 async def stop_chatting(update: Update, context: CallbackContext) -> int:
     # Close conversation mode and start evaluation
+    # Drop cached states of the conversation
+    await invalidate_cache(update.effective_chat.id)
+    if conversation_store is not None:
+        conversation_store.end_conversation(update.effective_chat.id)
     # Send closing message
     # Signal conversation start
     await update.message.reply_text(
@@ -177,20 +410,20 @@ async def stop_chatting(update: Update, context: CallbackContext) -> int:
         await update.message.reply_text(
             "You can start another conversation with the /begin command or use the /stop command to stop the bot."
         )
-        # TODO add data collection under consent?
-        ...
+        # NOTE the utterances have already been written to the conversation store by add_utterance
         # Reset context
-        context.chat_data['conversation'] = list()
-        context.chat_data['evaluation'] = dict()
+        reset_chat_data(update, context)
 
         return IDLE
 
-@restricted_access
+
+@traced_message
+@restored_chat_data
 async def evaluate_agent(update: Update, context: CallbackContext) -> int:
     # Do evaluation until all aspects have been rated, then close conversation
     # Gather the latest score
     score = int(update.message.text)
-    context.chat_data['evaluation'][evaluation_aspects[len(context.chat_data['evaluation'])]['id']] = score
+    add_score(context, evaluation_aspects[len(context.chat_data['evaluation'])]['id'], score)
     # Check if evaluation is finished
     if len(evaluation_aspects) == len(context.chat_data['evaluation']):
         # Send closing messages
@@ -201,11 +434,9 @@ async def evaluate_agent(update: Update, context: CallbackContext) -> int:
         await update.message.reply_text(
             "You can start another conversation with the /begin command or use the /stop command to stop the bot."
         )
-        # TODO add data collection under consent?
-        ...
+        # NOTE the scores have already been written to the conversation store by add_score
         # Reset context
-        context.chat_data['conversation'] = list()
-        context.chat_data['evaluation'] = dict()
+        reset_chat_data(update, context)
 
         return IDLE
     else:
@@ -220,12 +451,14 @@ async def evaluate_agent(update: Update, context: CallbackContext) -> int:
         return EVAL
 
 
-@restricted_access
+@traced_message
 async def stop_bot(update: Update, context: CallbackContext):
     # Start chatbot and give user instructions
     # Init context
+    reset_chat_data(update, context)
     context.chat_data['conversation'] = None
     context.chat_data['evaluation'] = None
+    await invalidate_cache(update.effective_chat.id)
     # Close communication
     await update.message.reply_text(
         "Thanks for using our TherapyBot, see you next time! "
@@ -235,22 +468,79 @@ async def stop_bot(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
-def init_conversation_handler(configs: Dict):
-    global therabot, evaluation_aspects, authorised_users
-    # Init chatbot
-    therabot = Chatbot(**configs['chatbot'])
+async def start_background_tasks(application: Application):
+    # Warm-up the models in background (the bot answers in the meanwhile) and start unloading the idle ones
+    therabot.models.warmup()
+    therabot.models.start()
+    logging.info("Model warm-up started")
+    # Pre-render the voice messages of the status messages
+    if therabot.speech_cache is not None:
+        threading.Thread(
+            target=therabot.prerender_responses, args=(STATUS_MESSAGES,), name='speech-prerendering', daemon=True
+        ).start()
+
+
+def init_conversation_handler(
+        configs: Dict, chatbot: Optional[Chatbot] = None, store: Optional[ConversationStore] = None
+):
+    global therabot, evaluation_aspects, access_controller, inference_executor, conversation_store, history_utterances
+    global edit_rate_limiter
+    # Init chatbot (unless an already built one is provided)
+    # NOTE if the model server is used, the models are not loaded by the bot process
+    model_server_configs: Dict = configs.get('model_server', dict())
+    if chatbot is not None:
+        therabot = chatbot
+    elif model_server_configs.get('remote', False):
+        therabot = RemoteChatbot(
+            url=model_server_configs['url'],
+            chatbot_id=configs['chatbot'].get('chatbot_id', 'AI'),
+            user_id=configs['chatbot'].get('user_id', 'User'),
+            **model_server_configs.get('client', dict())
+        )
+    else:
+        therabot = Chatbot(mixed_precision=configs.get('mixed_precision', False), **configs['chatbot'])
+    # Init executor to run the models out of the event loop
+    # NOTE the stages batched by the chatbot get as many threads as the requests in a batch
+    inference_executor = InferenceExecutor(
+        **configs['telegram'].get('inference', dict()), batch_sizes=therabot.batch_sizes()
+    )
+    logging.debug("Inference executor instantiated")
+    # Text responses are streamed with message edits, if configured
+    streaming_configs: Optional[Dict] = configs['telegram'].get('streaming')
+    edit_rate_limiter = EditRateLimiter(**streaming_configs) if streaming_configs is not None else None
+    if streaming_configs is not None and not therabot.streams_responses:
+        logging.warning(
+            "Text responses are not streamed by the chatbot (it requires the batched decoding loop and a local "
+            "chatbot), each response is sent once complete"
+        )
     evaluation_aspects = configs['telegram'].get('evaluation_aspects')
     # Load list of authorised users if any, else do not restrict access
+    # NOTE the list is reloaded when the file changes, without restarting the bot
+    access_configs: Dict = configs['telegram'].get('access', dict())
     authorised_users_file_path = configs['telegram'].get('authorised_users_file')
     if authorised_users_file_path is not None:
-        with open(authorised_users_file_path) as f:
-            authorised_users = {int(i) for i in f}
+        authorised_users = AuthorisedUsers(
+            authorised_users_file_path, reload_interval=access_configs.get('reload_interval', 5.0)
+        )
         logging.debug("Authorised users list loaded")
     else:
         authorised_users = None
         logging.debug("Running without user restrictions")
+    # Per-user rate and concurrency limits (if any)
+    if authorised_users is not None or len(access_configs) > 0:
+        access_controller = AccessController(
+            authorised_users=authorised_users,
+            **{key: value for key, value in access_configs.items() if key != 'reload_interval'}
+        )
+    else:
+        access_controller = None
+    # Persistent storage of the conversations (if any, else the chats live only in memory)
+    conversation_store = store
+    history_utterances = configs['telegram'].get('store', dict()).get('history_utterances')
     # Add conversation handler with the states IDLE, CHAT and EVAL
-    conv_handler = ConversationHandler(
+    # NOTE when the conversations are stored, the state of each chat is persisted too and resumed after a restart
+    # NOTE updates are processed concurrently, the handler keeps the order of the updates within each chat
+    conv_handler = OrderedConversationHandler(
         entry_points=[CommandHandler('start', start_bot)],
         states={
             IDLE: [CommandHandler('begin', start_chatting)],
@@ -262,6 +552,8 @@ def init_conversation_handler(configs: Dict):
             EVAL: [MessageHandler(filters.TEXT, evaluate_agent)]  # Evaluation message
         },
         fallbacks=[CommandHandler('stop', stop_bot)],  # Any other message is ignored
+        name='therapy_bot',
+        persistent=conversation_store is not None
     )
     logging.info("Conversational handler instantiated")
 
@@ -0,0 +1,65 @@
+import json
+import asyncio
+
+from typing import Dict, Optional
+
+
+# Messages between the front-end and the worker processes are JSON objects, one per line, over Unix sockets
+# NOTE the limit of the stream readers must hold the largest message (updates are at most a few KiB)
+STREAM_LIMIT: int = 2 ** 20
+
+
+async def send_message(writer: asyncio.StreamWriter, message: Dict):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+async def receive_message(reader: asyncio.StreamReader) -> Optional[Dict]:
+    # None signals that the other side closed the connection
+    line = await reader.readline()
+    if not line:
+        return None
+
+    return json.loads(line)
+
+
+class WorkerClient:
+    """
+    Connection of the front-end to a worker process.
+    Requests are sent one at a time on the connection and each gets a response
+    (the worker only acknowledges the updates, they are processed in background).
+    """
+    def __init__(self, socket_path: str, timeout: float = 10.0):
+        self.socket_path: str = socket_path
+        self.timeout: float = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=STREAM_LIMIT)
+
+    async def request(self, message: Dict) -> Dict:
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                await send_message(self._writer, message)
+                response = await asyncio.wait_for(receive_message(self._reader), self.timeout)
+                if response is None:
+                    raise ConnectionResetError(f"Worker at '{self.socket_path}' closed the connection")
+            except (OSError, asyncio.TimeoutError):
+                # Reconnect at the next request (e.g., the worker was restarted)
+                await self.close()
+                raise
+
+        return response
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
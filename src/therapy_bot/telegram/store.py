@@ -0,0 +1,285 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from queue import Queue, Empty
+from concurrent.futures import Future
+
+from telegram.ext import DictPersistence, PersistenceInput
+
+from typing import List, Dict, Tuple, Optional, Any, MutableMapping
+
+
+SCHEMA: List[str] = [
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, started_at REAL NOT NULL, ended_at REAL)",
+    "CREATE INDEX IF NOT EXISTS conversations_chat ON conversations (chat_id, started_at)",
+    "CREATE TABLE IF NOT EXISTS utterances ("
+    "conversation_id TEXT NOT NULL, idx INTEGER NOT NULL, speaker TEXT NOT NULL, text TEXT NOT NULL, "
+    "created_at REAL NOT NULL, PRIMARY KEY (conversation_id, idx)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS evaluations ("
+    "conversation_id TEXT NOT NULL, aspect TEXT NOT NULL, score INTEGER NOT NULL, created_at REAL NOT NULL, "
+    "PRIMARY KEY (conversation_id, aspect)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS handler_states ("
+    "name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key)) WITHOUT ROWID"
+]
+
+
+class ConversationStore(ABC):
+    """
+    Interface of the persistent storage of the conversations, of their evaluation and of the state of the chats.
+    Writes are asynchronous (they are only queued by the caller), reads see all the writes queued before them.
+    """
+    @abstractmethod
+    def start_conversation(self, chat_id: int) -> str:
+        ...
+
+    @abstractmethod
+    def end_conversation(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    def add_utterance(self, conversation_id: str, idx: int, utterance: Dict[str, str]):
+        ...
+
+    @abstractmethod
+    def add_score(self, conversation_id: str, aspect: str, score: int):
+        ...
+
+    @abstractmethod
+    def update_handler_state(self, name: str, key: Tuple, state: Optional[Any]):
+        ...
+
+    @abstractmethod
+    def load_conversation(self, chat_id: int, n_utterances: Optional[int] = None) -> Optional[Dict]:
+        # Open conversation of the chat (if any) with its last utterances and its scores
+        ...
+
+    @abstractmethod
+    def load_handler_states(self, name: str) -> Dict[Tuple, Any]:
+        ...
+
+    @abstractmethod
+    def export_evaluations(self, file_path: str) -> int:
+        ...
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Conversation store backed by a SQLite database in WAL mode (readers do not block the writer and vice versa).
+    Writes are queued and committed in batches by a background thread, off the event loop.
+    """
+    def __init__(self, db_file_path: str, max_batch_size: int = 256, max_wait_ms: float = 50.0):
+        self.db_file_path: str = db_file_path
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait_ms / 1000.0
+        self._local: threading.local = threading.local()
+        # Init database
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        # Write queue and writer thread
+        self._queue: Queue = Queue()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._write_loop, name='conversation-store', daemon=True
+        )
+        self._thread.start()
+        logging.info(f"Conversation store opened at '{self.db_file_path}'")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Each thread uses its own connection
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file_path)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+    def _write(self, statement: str, parameters: Tuple):
+        self._queue.put((statement, parameters))
+
+    def _write_loop(self):
+        connection = self._connection()
+        stop = False
+        while not stop:
+            # Wait for the first write, then collect the others until the batch is full or the window expires
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size and batch[-1] is not None and not isinstance(batch[-1], Future):
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except Empty:
+                    break
+            # The batch is committed in a single transaction, each write has its own savepoint so that a failed write
+            # is rolled back alone and the writes of the other chats are kept
+            try:
+                connection.execute('BEGIN')
+                for item in batch:
+                    if isinstance(item, tuple):
+                        connection.execute('SAVEPOINT write')
+                        try:
+                            connection.execute(*item)
+                        except sqlite3.Error as e:
+                            connection.execute('ROLLBACK TO SAVEPOINT write')
+                            logging.error(f"Conversation store write failed: {e} (statement: '{item[0]}')")
+                        connection.execute('RELEASE SAVEPOINT write')
+                connection.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Conversation store batch commit failed: {e}")
+                connection.rollback()
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, Future):
+                    item.set_result(None)
+        connection.close()
+
+    def start_conversation(self, chat_id: int) -> str:
+        conversation_id = uuid.uuid4().hex
+        self.end_conversation(chat_id)
+        self._write(
+            'INSERT INTO conversations (id, chat_id, started_at) VALUES (?, ?, ?)', (conversation_id, chat_id, time.time())
+        )
+
+        return conversation_id
+
+    def end_conversation(self, chat_id: int):
+        self._write(
+            'UPDATE conversations SET ended_at = ? WHERE chat_id = ? AND ended_at IS NULL', (time.time(), chat_id)
+        )
+
+    def add_utterance(self, conversation_id: str, idx: int, utterance: Dict[str, str]):
+        self._write(
+            'INSERT OR REPLACE INTO utterances (conversation_id, idx, speaker, text, created_at) VALUES (?, ?, ?, ?, ?)',
+            (conversation_id, idx, utterance['speaker'], utterance['text'], time.time())
+        )
+
+    def add_score(self, conversation_id: str, aspect: str, score: int):
+        self._write(
+            'INSERT OR REPLACE INTO evaluations (conversation_id, aspect, score, created_at) VALUES (?, ?, ?, ?)',
+            (conversation_id, aspect, score, time.time())
+        )
+
+    def update_handler_state(self, name: str, key: Tuple, state: Optional[Any]):
+        if state is None:
+            self._write('DELETE FROM handler_states WHERE name = ? AND key = ?', (name, json.dumps(key)))
+        else:
+            self._write(
+                'INSERT OR REPLACE INTO handler_states (name, key, state) VALUES (?, ?, ?)',
+                (name, json.dumps(key), json.dumps(state))
+            )
+
+    def load_conversation(self, chat_id: int, n_utterances: Optional[int] = None) -> Optional[Dict]:
+        self.flush()
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT id FROM conversations WHERE chat_id = ? ORDER BY started_at DESC LIMIT 1', (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        conversation_id, = row
+        # Last utterances (in chronological order)
+        utterances = connection.execute(
+            'SELECT idx, speaker, text FROM utterances WHERE conversation_id = ? ORDER BY idx DESC LIMIT ?',
+            (conversation_id, n_utterances if n_utterances is not None else -1)
+        ).fetchall()[::-1]
+        n_total = connection.execute(
+            'SELECT COALESCE(MAX(idx) + 1, 0) FROM utterances WHERE conversation_id = ?', (conversation_id,)
+        ).fetchone()[0]
+        scores = connection.execute(
+            'SELECT aspect, score FROM evaluations WHERE conversation_id = ? ORDER BY created_at', (conversation_id,)
+        ).fetchall()
+
+        return {
+            'conversation_id': conversation_id,
+            'conversation': [{'speaker': speaker, 'text': text} for _, speaker, text in utterances],
+            'n_utterances': n_total,
+            'evaluation': dict(scores)
+        }
+
+    def load_handler_states(self, name: str) -> Dict[Tuple, Any]:
+        self.flush()
+        rows = self._connection().execute('SELECT key, state FROM handler_states WHERE name = ?', (name,)).fetchall()
+
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    def export_evaluations(self, file_path: str) -> int:
+        # Export the evaluated conversations (one JSON object per line with the dialogue and the scores)
+        self.flush()
+        connection = self._connection()
+        conversations = connection.execute(
+            'SELECT DISTINCT c.id, c.chat_id, c.started_at, c.ended_at '
+            'FROM conversations c JOIN evaluations e ON e.conversation_id = c.id ORDER BY c.started_at'
+        ).fetchall()
+        with open(file_path, 'w') as f:
+            for conversation_id, chat_id, started_at, ended_at in conversations:
+                utterances = connection.execute(
+                    'SELECT speaker, text FROM utterances WHERE conversation_id = ? ORDER BY idx', (conversation_id,)
+                ).fetchall()
+                scores = connection.execute(
+                    'SELECT aspect, score FROM evaluations WHERE conversation_id = ?', (conversation_id,)
+                ).fetchall()
+                f.write(json.dumps({
+                    'conversation_id': conversation_id,
+                    'chat_id': chat_id,
+                    'started_at': started_at,
+                    'ended_at': ended_at,
+                    'conversation': [{'speaker': speaker, 'text': text} for speaker, text in utterances],
+                    'evaluation': dict(scores)
+                }) + '\n')
+
+        return len(conversations)
+
+    def flush(self):
+        # Wait until all the queued writes are committed
+        if threading.current_thread() is self._thread or not self._thread.is_alive():
+            return
+        future = Future()
+        self._queue.put(future)
+        future.result()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class ConversationStorePersistence(DictPersistence):
+    """
+    Persistence of the states of the conversation handlers in the conversation store,
+    so that chats resume where they were after a restart (or on another process).
+    The other data are not persisted.
+    """
+    def __init__(self, conversation_store: ConversationStore, update_interval: float = 5.0):
+        super(ConversationStorePersistence, self).__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.conversation_store: ConversationStore = conversation_store
+
+    async def get_conversations(self, name: str) -> MutableMapping[Tuple, object]:
+        # NOTE reading the store (and waiting for the queued writes) blocks, so it is done off the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.conversation_store.load_handler_states, name
+        )
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]):
+        # Writes are only queued, this does not block
+        self.conversation_store.update_handler_state(name, key, new_state)
+
+    async def flush(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.conversation_store.flush)
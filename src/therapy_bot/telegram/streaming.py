@@ -0,0 +1,60 @@
+import time
+import asyncio
+
+from typing import Dict, Hashable
+
+
+class EditRateLimiter:
+    """
+    Keeps the messages sent while streaming the responses within the limits of the Bot API:
+    at most one message (or edit) per chat every given interval and a maximum overall rate (token bucket).
+    Intermediate edits can be skipped when they would exceed the limits, final ones wait for their turn.
+    """
+    def __init__(self, min_edit_interval: float = 1.0, max_edits_per_second: float = 25.0):
+        self.min_edit_interval: float = min_edit_interval
+        self.max_edits_per_second: float = max_edits_per_second
+        self.n_skipped: int = 0
+        # Book-keeping (accessed only from the event loop)
+        self._tokens: float = max_edits_per_second
+        self._last_refill: float = time.perf_counter()
+        self._last_edit: Dict[Hashable, float] = dict()
+
+    def _refill(self, now: float):
+        self._tokens = min(
+            self.max_edits_per_second, self._tokens + (now - self._last_refill) * self.max_edits_per_second
+        )
+        self._last_refill = now
+
+    def _wait_time(self, chat_id: Hashable) -> float:
+        now = time.perf_counter()
+        self._refill(now)
+        chat_wait_time = self._last_edit.get(chat_id, -float('inf')) + self.min_edit_interval - now
+        bucket_wait_time = (1.0 - self._tokens) / self.max_edits_per_second
+
+        return max(chat_wait_time, bucket_wait_time, 0.0)
+
+    def _take(self, chat_id: Hashable):
+        now = time.perf_counter()
+        self._tokens -= 1.0
+        self._last_edit[chat_id] = now
+        # Forget the chats that can edit again anyway
+        if len(self._last_edit) > 1024:
+            self._last_edit = {
+                chat: edit_time for chat, edit_time in self._last_edit.items()
+                if edit_time + self.min_edit_interval > now
+            }
+
+    def try_acquire(self, chat_id: Hashable) -> bool:
+        if self._wait_time(chat_id) > 0.0:
+            self.n_skipped += 1
+            return False
+        self._take(chat_id)
+
+        return True
+
+    async def acquire(self, chat_id: Hashable):
+        wait_time = self._wait_time(chat_id)
+        while wait_time > 0.0:
+            await asyncio.sleep(wait_time)
+            wait_time = self._wait_time(chat_id)
+        self._take(chat_id)
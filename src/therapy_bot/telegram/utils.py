@@ -5,3 +5,42 @@ IDLE, CHAT, EVAL = range(3)
 
 EVAL_KEYBOARD = [[str(i + 1)] for i in range(5)]
 EVAL_MARKUP = ReplyKeyboardMarkup(EVAL_KEYBOARD, one_time_keyboard=True)
+
+# Status messages sent while chatting
+# NOTE their voice messages are pre-rendered at start-up, they are read out loud to the users talking by voice
+BUSY_MESSAGE = (
+    "I'm sorry, I'm still working on the previous messages. "
+    "Please wait for my answer before writing again."
+)
+CHAT_DISABLED_MESSAGE = (
+    "I'm sorry, the chatting service is not enabled in the current configuration. "
+    "Stop the chatbot and try again later."
+)
+CHAT_TIMEOUT_MESSAGE = "I'm sorry, it is taking me too long to answer. Please, try again in a moment."
+TRANSCRIPTION_DISABLED_MESSAGE = (
+    "I'm sorry, the transcription service is not enabled in the current configuration. "
+    "You're welcome to write a text message."
+)
+TRANSCRIPTION_TIMEOUT_MESSAGE = (
+    "I'm sorry, it is taking me too long to understand your voice message. "
+    "You're welcome to write a text message."
+)
+TRANSCRIPTION_EMPTY_MESSAGE = (
+    "I'm sorry, I couldn't hear anything in your voice message. "
+    "Could you try recording it again?"
+)
+STATUS_MESSAGES = [
+    BUSY_MESSAGE,
+    CHAT_DISABLED_MESSAGE,
+    CHAT_TIMEOUT_MESSAGE,
+    TRANSCRIPTION_DISABLED_MESSAGE,
+    TRANSCRIPTION_TIMEOUT_MESSAGE,
+    TRANSCRIPTION_EMPTY_MESSAGE
+]
+# Messages sent to the rejected users
+# NOTE they are sent only as text and only once in a row, the updates are rejected before any work is done
+UNAUTHORISED_MESSAGE = "I'm sorry, you are not authorised to use this chatbot."
+RATE_LIMITED_MESSAGE = (
+    "I'm sorry, you are sending me too many messages. "
+    "Please, slow down a bit, the next messages are ignored for a while."
+)
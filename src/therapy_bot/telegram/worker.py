@@ -0,0 +1,150 @@
+import os
+import time
+import signal
+import asyncio
+import logging
+
+from therapy_bot.chatbot import Chatbot
+from therapy_bot.chatbot.tracing import tracer
+
+from telegram import Update
+from telegram.ext import Application
+from . import handlers
+from .application import init_conversation_store, init_application
+from .ipc import STREAM_LIMIT, send_message, receive_message
+
+from typing import Dict, Optional, Callable
+
+
+class UpdateWorker:
+    """
+    Model-worker process of a sharded deployment.
+    It receives the updates of its chats from the front-end over a Unix socket and processes them with its own
+    Application (and its own models), so that the state of each chat stays local to the worker.
+    On SIGTERM (or SIGINT) it stops accepting updates, completes the pending ones and exits.
+    """
+    def __init__(self, application: Application, shard: int, socket_path: str):
+        self.application: Application = application
+        self.shard: int = shard
+        self.socket_path: str = socket_path
+        self.status: str = 'starting'
+        self.received: int = 0
+        self.start_time: float = time.time()
+        self._stop: Optional[asyncio.Event] = None
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = dict()
+
+    def drain(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def health(self) -> Dict:
+        return {
+            'status': self.status,
+            'shard': self.shard,
+            'pid': os.getpid(),
+            'uptime': time.time() - self.start_time,
+            'received': self.received,
+            'queued': self.application.update_queue.qsize(),
+            'pending': handlers.inference_executor.pending,
+            'access': handlers.access_controller.summary() if handlers.access_controller is not None else None
+        }
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = asyncio.current_task()
+        self._connections[connection] = writer
+        try:
+            while True:
+                message = await receive_message(reader)
+                if message is None:
+                    break
+                if message['type'] == 'update':
+                    # Updates are only queued, the Application processes them concurrently (in order within each chat)
+                    if self.status == 'ok':
+                        await self.application.update_queue.put(Update.de_json(message['update'], self.application.bot))
+                        self.received += 1
+                        response = {'accepted': True}
+                    else:
+                        response = {'accepted': False, 'status': self.status}
+                elif message['type'] == 'health':
+                    response = self.health()
+                else:
+                    response = {'error': f"Unknown message type: '{message['type']}'"}
+                await send_message(writer, response)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(connection, None)
+            writer.close()
+
+    async def serve(self):
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, self.drain)
+        # Start application (there is no updater, the updates come from the front-end)
+        await self.application.initialize()
+        if self.application.post_init is not None:
+            await self.application.post_init(self.application)
+        await self.application.start()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_connection, self.socket_path, limit=STREAM_LIMIT)
+        self.status = 'ok'
+        logging.info(f"Worker {self.shard} listening at '{self.socket_path}'")
+        await self._stop.wait()
+        # Drain: reject new updates, complete the queued and running ones
+        self.status = 'draining'
+        logging.info(f"Worker {self.shard} draining ({self.application.update_queue.qsize()} queued updates)")
+        server.close()
+        await self.application.stop()
+        await self.application.shutdown()
+        for writer in list(self._connections.values()):
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.status = 'stopped'
+        logging.info(f"Worker {self.shard} stopped")
+
+
+def run_worker(
+        configs: Dict,
+        shard: int,
+        socket_path: str,
+        session_dir_path: str,
+        session_series_dir_path: str,
+        chatbot_factory: Optional[Callable[[], Chatbot]] = None
+):
+    # Entry point of the worker processes
+    # Init logging
+    if configs.get('log_file', False):
+        log_file_path = os.path.join(session_dir_path, f'worker_{shard}.log')
+    else:
+        log_file_path = None
+    logging.basicConfig(
+        filename=log_file_path, level=configs['log_level'], format=f'%(levelname)s:worker_{shard}:%(name)s:%(message)s'
+    )
+    # Init tracing (each worker has its own trace file and metrics endpoint)
+    tracing_configs: Dict = configs.get('tracing', dict())
+    tracer.configure(
+        trace_file_path=os.path.join(
+            session_dir_path, f'worker_{shard}_trace.jsonl'
+        ) if tracing_configs.get('trace_file', False) else None,
+        metrics_host=tracing_configs.get('metrics_host', '127.0.0.1'),
+        metrics_port=tracing_configs['metrics_port'] + shard if tracing_configs.get('metrics_port') else None
+    )
+    # Init application
+    # NOTE all the workers share the conversation store, each one only writes the chats it is assigned
+    conversation_store = init_conversation_store(configs, session_series_dir_path)
+    application = init_application(
+        configs,
+        conversation_store=conversation_store,
+        chatbot=chatbot_factory() if chatbot_factory is not None else None,
+        updater=False
+    )
+    # Serve until drained
+    asyncio.run(UpdateWorker(application, shard, socket_path).serve())
+    handlers.inference_executor.shutdown()
+    if conversation_store is not None:
+        conversation_store.close()
+    tracer.close()
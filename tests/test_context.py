@@ -0,0 +1,34 @@
+from therapy_bot.benchmark.backends import build_tiny_chatbot
+from therapy_bot.chatbot.context import ContextWindow
+
+from typing import List, Dict
+
+
+def encode(text: str) -> List[int]:
+    return list(text.encode())
+
+
+def decode(token_ids: List[int]) -> str:
+    return bytes(token_ids).decode()
+
+
+def test_long_utterance_is_truncated():
+    context_window = ContextWindow('bytes', encode, decode=decode, max_tokens=16)
+    dialogue: List[Dict] = [{'speaker': 'User', 'text': 'Hi.'}, {'speaker': 'User', 'text': 'a' * 10 + 'b' * 20}]
+    fitted_dialogue = context_window.fit(dialogue)
+    assert len(fitted_dialogue) == 1
+    assert context_window.token_ids(fitted_dialogue[0]) == encode('b' * 16)
+    assert context_window.text(fitted_dialogue[0]) == 'b' * 16
+    # The utterance of the dialogue keeps all its tokens
+    assert context_window.n_tokens(dialogue[-1:]) == 30
+    assert context_window.text(dialogue[-1]) == 'a' * 10 + 'b' * 20
+
+
+def test_long_utterance_fits_model_window(tmp_path):
+    # A single utterance longer than the window of the model, with a response longer than the window as well
+    chatbot = build_tiny_chatbot(str(tmp_path), chatbot_configs={'dlm': {'batching': {'max_batch_size': 2}}})
+    n_positions = chatbot.ppm_dlm.config.n_positions
+    context = [{'speaker': 'User', 'text': 'I feel anxious. ' * (n_positions // 8)}]
+    response = chatbot.generate_response(context, generate_kwargs={'max_new_tokens': n_positions})
+    assert isinstance(response, str)
+    chatbot.models.close()
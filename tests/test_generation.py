@@ -0,0 +1,113 @@
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from therapy_bot.benchmark.backends import TINY_GPT2_CONFIG, build_tiny_chatbot, build_tokenizer
+from therapy_bot.chatbot.generation import GenerationRequest, ResponseGenerator, check_generate_kwargs
+from therapy_bot.chatbot.kv_cache import ConversationCache
+from therapy_bot.chatbot.speculative import SpeculativeGenerator
+
+from typing import List, Tuple
+
+
+PREFIX: str = 'The following is a conversation with a therapist.\n\n'
+TURNS: List[Tuple[str, str]] = [
+    ('User: Hi, I have been feeling anxious lately.\nTherapyBot:', 'User: It started with my new job.\nTherapyBot:'),
+    ('User: I cannot sleep at night.\nTherapyBot:', 'User: I keep thinking about work.\nTherapyBot:')
+]
+
+
+@pytest.fixture(scope='module')
+def tokenizer(tmp_path_factory):
+    return build_tokenizer(str(tmp_path_factory.mktemp('tokenizer')))
+
+
+def tiny_gpt2(tokenizer, n_layer: int = 2, seed: int = 0) -> GPT2LMHeadModel:
+    # NOTE the large initialisation range makes the (random) next token distributions peaked, so that responses are
+    # not cut short by the new line tokens and greedy decoding is not decided by rounding errors
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(tokenizer), **{**TINY_GPT2_CONFIG, 'n_layer': n_layer}, initializer_range=0.5)
+
+    return GPT2LMHeadModel(config).eval()
+
+
+def chat(response_generator: ResponseGenerator, max_new_tokens: int = 16) -> List[List[str]]:
+    # Two turns of two conversations decoded in the same batches, the responses are appended to the prompts
+    prefix_ids = response_generator.set_prefix(PREFIX)
+    prompts = [list(prefix_ids) for _ in TURNS]
+    responses = list()
+    for turn in range(2):
+        for prompt, conversation in zip(prompts, TURNS):
+            prompt += response_generator.encode(conversation[turn])
+        requests = [
+            GenerationRequest(list(prompt), cache_key=chat_id, max_new_tokens=max_new_tokens)
+            for chat_id, prompt in enumerate(prompts)
+        ]
+        turn_responses = response_generator.generate_batch(requests)
+        for prompt, response in zip(prompts, turn_responses):
+            prompt += response_generator.encode(f' {response}\n')
+        responses.append(turn_responses)
+
+    return responses
+
+
+def test_cached_generation_matches_uncached(tokenizer):
+    model = tiny_gpt2(tokenizer)
+    cache = ConversationCache()
+    uncached_responses = chat(ResponseGenerator(model, tokenizer))
+    cached_responses = chat(ResponseGenerator(model, tokenizer, conversation_cache=cache))
+    assert cached_responses == uncached_responses
+    assert all(len(response) > 0 for turn_responses in cached_responses for response in turn_responses)
+    # The second turn of each conversation reuses the states of the first one
+    assert cache.hits == len(TURNS)
+
+
+def test_batched_greedy_generation_matches_generate(tokenizer):
+    model = tiny_gpt2(tokenizer)
+    response_generator = ResponseGenerator(model, tokenizer)
+    prefix_ids = response_generator.set_prefix(PREFIX)
+    for conversation in TURNS:
+        input_ids = prefix_ids + response_generator.encode(conversation[0])
+        response, = response_generator.generate_batch([GenerationRequest(input_ids, max_new_tokens=16)])
+        output_ids = model.generate(
+            torch.tensor([input_ids]),
+            do_sample=False,
+            max_new_tokens=16,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id
+        )
+        assert response == response_generator.decode(output_ids[0, len(input_ids):].tolist())
+
+
+@pytest.mark.parametrize('n_draft_tokens', [1, 3, 5])
+def test_greedy_speculative_generation_matches_plain(tokenizer, n_draft_tokens):
+    model = tiny_gpt2(tokenizer)
+    draft_model = tiny_gpt2(tokenizer, n_layer=1, seed=1)
+    plain_responses = chat(ResponseGenerator(model, tokenizer))
+    speculative_generator = SpeculativeGenerator(
+        model,
+        tokenizer,
+        draft_model,
+        conversation_cache=ConversationCache(),
+        n_draft_tokens=n_draft_tokens,
+        max_batch_size=len(TURNS)
+    )
+    speculative_responses = chat(speculative_generator)
+    assert speculative_responses == plain_responses
+    assert speculative_generator.stats.n_requests == 2 * len(TURNS)
+
+
+def test_unsupported_generate_kwargs_are_rejected():
+    check_generate_kwargs({'do_sample': True, 'top_p': 0.9, 'max_new_tokens': 16})
+    with pytest.raises(ValueError, match='num_beams, repetition_penalty'):
+        check_generate_kwargs({'do_sample': True, 'repetition_penalty': 1.2, 'num_beams': 4})
+    with pytest.raises(ValueError):
+        GenerationRequest.from_generate_kwargs([0, 1, 2], num_beams=4)
+
+
+def test_unsupported_generate_kwargs_fail_at_start_up(tmp_path):
+    chatbot_configs = {
+        'dlm': {'generator_params': {'generate_kwargs': {'num_beams': 4}}, 'batching': {'max_batch_size': 2}}
+    }
+    with pytest.raises(ValueError, match='num_beams'):
+        build_tiny_chatbot(str(tmp_path), chatbot_configs=chatbot_configs)
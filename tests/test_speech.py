@@ -0,0 +1,180 @@
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+import torch
+from torch import nn
+from transformers import GPT2Config, GPT2Model
+
+pytest.importorskip('dialoguegst.model')
+
+from therapy_bot.chatbot import speech
+from therapy_bot.chatbot.speech import BatchSpeechSynthesiser, SpeechRequest
+
+from typing import List
+
+
+# NOTE the stand-in modules are written after the assumed structure of the Mellotron and of the WaveGlow, the tests
+# check the consistency of the batched synthesis (padding, masking, buckets and shared styles) with itself, the parity
+# with the speech generator of the Dialogue GST API is not checked
+# Shapes of the stand-in modules: heads and tokens of the style token layer, sizes of text encodings and spectrograms
+N_HEADS: int = 2
+N_TOKENS: int = 4
+N_UNITS: int = 8
+N_MELS: int = 3
+REQUESTS: List[SpeechRequest] = [
+    SpeechRequest('Hello there.', ['Hi.', 'How are you?']),
+    SpeechRequest('That sounds really hard.', ['Hi.', 'How are you?']),
+    SpeechRequest('Tell me more about it', ['I lost my job.', 'I am sorry.', 'It was a shock.']),
+    SpeechRequest('Ok.', ['Fine.']),
+    SpeechRequest('Hmm', ['I do not know.'])
+]
+
+
+class Tokenizer:
+    eos_token_id: int = 0
+
+    def __call__(self, text: str) -> SimpleNamespace:
+        return SimpleNamespace(input_ids=[ord(c) % 90 + 3 for c in text])
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return {'<|prior|>': 1, '<|posterior|>': 2}[token]
+
+
+class StyleTokenLayer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = nn.Parameter(torch.randn(N_TOKENS, 6))
+        self.attention = nn.Module()
+        self.attention.W_value = nn.Linear(6, N_UNITS, bias=False)
+        self.attention.num_units = N_UNITS
+        self.attention.num_heads = N_HEADS
+
+
+class Encoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.projection = nn.Linear(5, 5)
+
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        # NOTE the packed RNN of the Mellotron requires the sequences sorted by decreasing length
+        assert lengths.tolist() == sorted(lengths.tolist(), reverse=True)
+        return self.projection(x.transpose(1, 2))
+
+
+class Decoder(nn.Module):
+    # Spectrogram frames depend on the (masked) memory, the step and the pitch features, the gate fires after a number
+    # of steps proportional to the length of the text
+    gate_threshold: float = 0.5
+    n_frames_per_step: int = 1
+
+    def __init__(self):
+        super().__init__()
+        self.prenet = nn.Linear(N_MELS, N_MELS)
+        self.prenet_f0 = nn.Conv1d(1, 2, 1)
+
+    def get_go_frame(self, memory: torch.Tensor) -> torch.Tensor:
+        return torch.zeros(memory.size(0), N_MELS)
+
+    def initialize_decoder_states(self, memory: torch.Tensor, mask: torch.Tensor):
+        self.lengths = (~mask).sum(1)
+        self.context = (memory * (~mask)[..., None]).sum(1) / self.lengths[:, None]
+        self.step = 0
+        self.f0s = list()
+
+    def decode(self, decoder_input: torch.Tensor):
+        self.step += 1
+        self.f0s.append(decoder_input[:, N_MELS:])
+        mel_output = self.context[:, :N_MELS] + 0.01 * self.step + self.f0s[-1].sum(1, keepdim=True)
+        gate_output = (self.step >= 2 * self.lengths).float()[:, None] * 10.0 - 5.0
+        return mel_output, gate_output, None
+
+    def parse_decoder_outputs(self, mel_outputs, gate_outputs, alignments):
+        return torch.stack(mel_outputs, dim=2), torch.stack(gate_outputs, dim=1), None
+
+
+class Mellotron(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(60, 5)
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.gst = nn.Module()
+        self.gst.stl = StyleTokenLayer()
+        self.speaker_embedding = nn.Embedding(3, 4)
+        self.postnet = nn.Identity()
+
+
+class WaveGlow(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.parameter = nn.Parameter(torch.zeros(1))
+
+    def infer(self, mels: torch.Tensor, sigma: float) -> torch.Tensor:
+        # NOTE the hop length is 4 samples
+        return mels.mean(1).repeat_interleave(4, dim=1)
+
+
+@pytest.fixture
+def synthesiser(monkeypatch) -> BatchSpeechSynthesiser:
+    monkeypatch.setattr(
+        speech, 'text_to_sequence', lambda text, cleaners, arpabet_dict: [ord(c) % 50 + 1 for c in text]
+    )
+    torch.manual_seed(0)
+    dldlm = GPT2Model(GPT2Config(n_layer=1, n_embd=16, n_head=2, vocab_size=100)).eval()
+    hparams = SimpleNamespace(sampling_rate=100, hop_length=4, text_cleaners=list())
+
+    return BatchSpeechSynthesiser(
+        dldlm,
+        Tokenizer(),
+        nn.Linear(16, N_HEADS * N_TOKENS),
+        (Mellotron().eval(), None, hparams),
+        (WaveGlow(), None),
+        bucket_width=4,
+        frame_bucket_width=8,
+        max_bucket_size=3,
+        f0_frames=2
+    )
+
+
+def test_batched_synthesis_matches_batch_of_one(synthesiser):
+    batched_audio = synthesiser.synthesise_batch(REQUESTS)
+    single_audio = [synthesiser.synthesise_batch([request])[0] for request in REQUESTS]
+    for (batched_waveform, sampling_rate), (single_waveform, _), request in zip(batched_audio, single_audio, REQUESTS):
+        assert sampling_rate == 100
+        assert len(batched_waveform) == len(single_waveform) == 2 * len(request.text) * 4
+        assert np.allclose(batched_waveform, single_waveform, atol=1e-5)
+    # Sentences with the same dialogue share the style prediction
+    assert synthesiser.stats.summary()['styles_per_batch'] == (4 + len(REQUESTS)) / (1 + len(REQUESTS))
+
+
+def test_given_style_skips_prediction(synthesiser):
+    gst_weights, _, _ = synthesiser.predict_gst([REQUESTS[0].dialogue_key])
+    (predicted_waveform, _), = synthesiser.synthesise_batch([REQUESTS[0]])
+    (given_waveform, _), = synthesiser.synthesise_batch(
+        [SpeechRequest(REQUESTS[0].text, REQUESTS[0].dialogue, gst_weights=gst_weights[0])]
+    )
+    assert np.allclose(predicted_waveform, given_waveform, atol=1e-5)
+    assert synthesiser.stats.n_styles == 1
+
+
+def test_flat_pitch_schedule(synthesiser):
+    # The features of the flat pitch contour (and of its end frame) feed the first steps, the following ones get zeros
+    synthesiser.synthesise_batch(REQUESTS[:2])
+    decoder = synthesiser.tts.decoder
+    f0_features = torch.relu(decoder.prenet_f0.bias).expand(2, -1)
+    assert bool((f0_features > 0).any()) and len(decoder.f0s) > synthesiser.f0_frames + 1
+    for step, f0 in enumerate(decoder.f0s):
+        assert torch.allclose(f0, f0_features if step <= synthesiser.f0_frames else torch.zeros_like(f0_features))
+
+
+def test_unsupported_encoding_mode(synthesiser):
+    with pytest.raises(ValueError):
+        BatchSpeechSynthesiser(
+            synthesiser.dldlm,
+            synthesiser.tokenizer,
+            synthesiser.dgst,
+            (synthesiser.tts, None, synthesiser.tts_hparams),
+            (synthesiser.waveglow, None),
+            encoding_mode='resp'
+        )